@@ -0,0 +1,276 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from mock_server import MockServer, MockServerState
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Importer command line options of each benchmarked configuration
+VARIANTS = {
+    'default': [],
+    'batch': ['--batch-upload'],
+    'sharded': ['--processes', '4'],
+    'sharded-batch': ['--processes', '4', '--batch-upload'],
+    'curl': ['--transport', 'curl']
+}
+
+def write_urls(path: str, rows: int, duplicate_rate: float = 0.0, seed: int = 0) -> None:
+    """Write a synthetic CSV input file with one URL per row.
+
+    Args:
+        path (str): The file to write.
+        rows (int): Number of rows below the header.
+        duplicate_rate (float): Fraction of rows repeating the domain of an earlier row.
+        seed (int): Seed for choosing the duplicates.
+    """
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('url\n')
+        for start in range(0, rows, 10000):
+            f.writelines(
+                f'https://www.company{rng.randrange(i) if i and rng.random() < duplicate_rate else i}.example/about\n'
+                for i in range(start, min(start + 10000, rows))
+            )
+
+def input_file(workdir: str, rows: int, duplicate_rate: float) -> str:
+    """Return the synthetic input file for a row count, writing it on first use."""
+    path = os.path.join(workdir, f'urls_{rows}_{duplicate_rate:g}.csv')
+    if not os.path.exists(path):
+        write_urls(f'{path}.tmp', rows, duplicate_rate)
+        os.replace(f'{path}.tmp', path)
+    return path
+
+def peak_rss_mb(usage: resource.struct_rusage) -> float:
+    """Return `ru_maxrss` in MB; Linux reports it in KB and macOS in bytes."""
+    return round(usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def run_scenario(scenario: Dict[str, Any], results) -> None:
+    """Run the importer once in this worker process and put its measurements on `results`.
+
+    The importer is imported here, after changing to the work directory,
+    so that its log file and any state it creates stay there and every
+    scenario starts with a fresh `CONFIG`. Throughput and latency come from
+    the progress snapshot written at the end of the run; peak RSS and CPU
+    time from `getrusage` for this process and its children (shard workers
+    or curl).
+
+    Args:
+        scenario (Dict[str, Any]): The scenario built by `run_benchmark`.
+        results: A multiprocessing queue receiving the result dictionary.
+    """
+    os.chdir(scenario['workdir'])
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    import importcopy
+
+    config = importcopy.CONFIG
+    config['API_URL'] = scenario['api_url']
+    config['SERVER_URL'] = scenario['server_url']
+    config['METRICS']['SNAPSHOT_INTERVAL'] = 3600
+    for name in ('API', 'SERVER'):
+        config['RATE_LIMIT'][name].update(RATE=scenario['rate'], BURST=scenario['rate'], MAX_RATE=None)
+    name = scenario['name']
+    snapshot_path = f'{name}.snapshot.json'
+    argv = [
+        '--input', scenario['input'], '--engine', scenario['engine'], '--no-cache',
+        '--journal', f'{name}.journal', '--dead-letters', f'{name}.dead_letters.ndjson',
+        '--snapshot', snapshot_path, '--fresh'
+    ] + VARIANTS[scenario['variant']]
+
+    result = {key: scenario[key] for key in ('engine', 'variant', 'rows')}
+    started = time.perf_counter()
+    try:
+        importcopy.main(argv)
+    except Exception as e:
+        result['error'] = str(e)
+    wall = time.perf_counter() - started
+    with open(snapshot_path, 'r', encoding='utf-8') as f:
+        summary = json.load(f)['report']
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+    result.update({
+        'wall_seconds': round(wall, 3),
+        'rows_per_second': round(scenario['rows'] / wall, 1),
+        'success_count': summary['success_count'],
+        'error_count': summary['error_count'],
+        'dead_letters': summary.get('dead_letters', 0),
+        'latency': summary['latency'],
+        'peak_rss_mb': peak_rss_mb(own),
+        'children_peak_rss_mb': peak_rss_mb(children),
+        'cpu_user_seconds': round(own.ru_utime + children.ru_utime, 3),
+        'cpu_system_seconds': round(own.ru_stime + children.ru_stime, 3),
+        'cpu_percent': round(100 * cpu / wall, 1)
+    })
+    results.put(result)
+
+def compare(result: Dict[str, Any], baseline: List[Dict[str, Any]]) -> None:
+    """Add the change in throughput against the matching scenario of a previous run to `result`."""
+    for previous in baseline:
+        if all(previous.get(key) == result[key] for key in ('engine', 'variant', 'rows')):
+            if previous.get('rows_per_second'):
+                result['baseline_rows_per_second'] = previous['rows_per_second']
+                result['throughput_change'] = round(result['rows_per_second'] / previous['rows_per_second'] - 1, 4)
+            return
+
+def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    """Run every combination of row count, engine and variant against local mock servers.
+
+    One `MockServer` plays agent.ai and another our server, each with its
+    own latency and fault injection. Every scenario runs the real importer
+    in a fresh process started with `spawn`.
+
+    Args:
+        args (argparse.Namespace): The parsed command line options.
+
+    Returns:
+        Dict[str, Any]: The benchmark document with the environment, the
+        mock settings and one result per scenario.
+    """
+    workdir = args.workdir or tempfile.mkdtemp(prefix='importer-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    baseline = []
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+
+    api = MockServer(state=MockServerState(
+        latency=args.api_latency, error_rate=args.api_error_rate, throttle_rate=args.api_throttle_rate,
+        retry_after=args.retry_after, keep_records=False, seed=args.seed
+    )).start()
+    server = MockServer(state=MockServerState(
+        latency=args.server_latency, error_rate=args.server_error_rate, throttle_rate=args.server_throttle_rate,
+        retry_after=args.retry_after, keep_records=False, seed=args.seed
+    )).start()
+    context = multiprocessing.get_context('spawn')
+    document = {
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()
+        },
+        'mock': {
+            'api': {'latency': args.api_latency, 'error_rate': args.api_error_rate,
+                    'throttle_rate': args.api_throttle_rate},
+            'server': {'latency': args.server_latency, 'error_rate': args.server_error_rate,
+                       'throttle_rate': args.server_throttle_rate},
+            'retry_after': args.retry_after,
+            'rate': args.rate
+        },
+        'results': []
+    }
+    try:
+        for rows in args.rows:
+            path = input_file(workdir, rows, args.duplicate_rate)
+            for engine in args.engine:
+                for variant in args.variant:
+                    before = {'api': dict(api.state.requests), 'server': dict(server.state.requests)}
+                    accepted = server.state.accepted
+                    scenario = {
+                        'name': f'{engine}-{variant}-{rows}', 'engine': engine, 'variant': variant, 'rows': rows,
+                        'input': path, 'workdir': workdir, 'rate': args.rate,
+                        'api_url': f'{api.url}/api/company/lite', 'server_url': server.url
+                    }
+                    results = context.Queue()
+                    process = context.Process(target=run_scenario, args=(scenario, results))
+                    process.start()
+                    result = None
+                    # Read the result before joining, so a full queue pipe cannot block the worker's exit
+                    while result is None and process.is_alive():
+                        try:
+                            result = results.get(timeout=1)
+                        except queue.Empty:
+                            pass
+                    process.join()
+                    if result is None:
+                        try:
+                            result = results.get_nowait()
+                        except queue.Empty:
+                            result = {key: scenario[key] for key in ('engine', 'variant', 'rows')}
+                            result['error'] = f'benchmark process exited with code {process.exitcode}'
+                    result['mock_requests'] = {
+                        name: {key: mock.state.requests[key] - before[name][key] for key in mock.state.requests}
+                        for name, mock in (('api', api), ('server', server))
+                    }
+                    result['records_accepted'] = server.state.accepted - accepted
+                    compare(result, baseline)
+                    document['results'].append(result)
+                    print(format_result(result), file=sys.stderr)
+    finally:
+        api.stop()
+        server.stop()
+    return document
+
+def format_result(result: Dict[str, Any]) -> str:
+    """Return a one-line human-readable summary of a scenario result."""
+    if 'wall_seconds' not in result:
+        return f"{result['engine']:>6} {result['variant']:<14} {result['rows']:>9} rows  FAILED: {result.get('error')}"
+    fetch = result['latency'].get('fetch', {})
+    line = (
+        f"{result['engine']:>6} {result['variant']:<14} {result['rows']:>9} rows  "
+        f"{result['rows_per_second']:>9.1f} rows/s  fetch p50 {fetch.get('p50', 0):.3f}s p99 {fetch.get('p99', 0):.3f}s  "
+        f"rss {result['peak_rss_mb']:.0f} MB  cpu {result['cpu_percent']:.0f}%"
+    )
+    if 'throughput_change' in result:
+        line += f"  {result['throughput_change']:+.1%} vs baseline"
+    return line
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse the command line options of the benchmark."""
+    parser = argparse.ArgumentParser(description="Benchmark the importer against local mock servers.")
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000],
+                        help="Input sizes to benchmark, e.g. 10000 1000000 10000000")
+    parser.add_argument('--engine', nargs='+', choices=['thread', 'async'], default=['thread', 'async'])
+    parser.add_argument('--variant', nargs='+', choices=sorted(VARIANTS), default=['default', 'batch'],
+                        help="Importer configurations to benchmark")
+    parser.add_argument('--api-latency', default='lognormal:50:0.5',
+                        help="agent.ai latency: const:MS, uniform:MIN:MAX, exp:MEAN or lognormal:MEDIAN:SIGMA")
+    parser.add_argument('--server-latency', default='lognormal:10:0.5', help="Server latency, same format")
+    parser.add_argument('--api-error-rate', type=float, default=0.0, help="Fraction of agent.ai requests answered with 503")
+    parser.add_argument('--api-throttle-rate', type=float, default=0.0, help="Fraction of agent.ai requests answered with 429")
+    parser.add_argument('--server-error-rate', type=float, default=0.0, help="Fraction of uploads answered with 503")
+    parser.add_argument('--server-throttle-rate', type=float, default=0.0, help="Fraction of uploads answered with 429")
+    parser.add_argument('--retry-after', type=float, default=1, help="Retry-After seconds sent with a 429")
+    parser.add_argument('--rate', type=float, default=100000,
+                        help="Rate limit in calls per second for both services, high so it does not dominate")
+    parser.add_argument('--duplicate-rate', type=float, default=0.0,
+                        help="Fraction of input rows repeating an earlier domain")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for latency and fault injection")
+    parser.add_argument('--workdir', help="Directory for input files, journals and logs (a new temporary one by default)")
+    parser.add_argument('--baseline', help="Earlier benchmark JSON to compare throughput against")
+    parser.add_argument('--output', default='-', help="File receiving the JSON results, '-' for stdout")
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Run the benchmark and write its results as JSON.
+
+    A one-line summary of each scenario is printed to stderr as it
+    finishes; the full results go to `--output`, so successive runs can be
+    compared with `--baseline`.
+
+    Args:
+        argv (Optional[List[str]]): Command line arguments, defaults to `sys.argv`.
+    """
+    args = parse_args(argv)
+    document = run_benchmark(args)
+    text = json.dumps(document, indent=2)
+    if args.output == '-':
+        print(text)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+
+if __name__ == '__main__':
+    main()
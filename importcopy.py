@@ -1,16 +1,35 @@
+import abc
+import codecs
 import csv
+import email.utils
 import subprocess
-import concurrent.futures
 import json
-import pandas as pd
 import time
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlencode
 import logging
+import logging.handlers
+import atexit
 from datetime import datetime
 import os
-from typing import List, Dict, Any, Optional
-import backoff
-from ratelimit import limits, sleep_and_retry
+import argparse
+import base64
+import bisect
+import hashlib
+import itertools
+import math
+import multiprocessing
+import asyncio
+import http.client
+import queue
+import random
+import sqlite3
+import ssl
+import struct
+import threading
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import defaultdict
+from typing import List, Dict, Any, Callable, Iterator, Optional
 
 # Configuration
 CONFIG = {
@@ -35,90 +54,976 @@ CONFIG = {
         'sec-fetch-site': 'same-site',
         'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36'
     },
-    'MAX_WORKERS': 1000,
-    'MAX_RETRIES': 3
+    'MAX_WORKERS': 1000,  # fetch-stage threads in the thread engine
+    'MAX_RETRIES': 3,
+    'RATE_LIMIT': {
+        'API': {
+            'RATE': 1000 / 60,  # agent.ai calls per second
+            'BURST': 20,  # calls that may be made back to back after an idle period
+            'MIN_RATE': 1.0,  # floor for the adaptive rate
+            'MAX_RATE': None  # ceiling for the adaptive rate, defaults to RATE
+        },
+        'SERVER': {
+            'RATE': 1000.0,  # uploads per second to our server
+            'BURST': 200,
+            'MIN_RATE': 10.0,
+            'MAX_RATE': None
+        },
+        'INCREASE': 1.0,  # calls per second added to the rate per second of successful traffic
+        'DECREASE': 0.5,  # factor applied to the rate on a 429, 5xx or transport error
+        'DECREASE_INTERVAL': 1.0,  # seconds between two decreases of the same bucket
+        'LATENCY_TARGET': 5.0,  # seconds; slower responses reduce the rate slightly
+        'MAX_RETRY_AFTER': 300,  # upper bound in seconds for an honoured Retry-After
+        'STATE_DIR': None  # share bucket state with other processes on this host through files here
+    },
+    'RETRY': {
+        # Per failure class: attempts per request (None means MAX_RETRIES) and the base
+        # and cap in seconds of the jittered exponential delay between them
+        'TIMEOUT': {'TRIES': None, 'BASE_DELAY': 1.0, 'MAX_DELAY': 30.0},
+        'CONNECTION': {'TRIES': None, 'BASE_DELAY': 1.0, 'MAX_DELAY': 30.0},
+        'THROTTLED': {'TRIES': None, 'BASE_DELAY': 0.5, 'MAX_DELAY': 10.0},  # on top of any Retry-After
+        'SERVER_ERROR': {'TRIES': None, 'BASE_DELAY': 1.0, 'MAX_DELAY': 30.0},
+        'CLIENT_ERROR': {'TRIES': 1, 'BASE_DELAY': 1.0, 'MAX_DELAY': 1.0},  # 4xx other than 408 and 429
+        'PAYLOAD': {'TRIES': 2, 'BASE_DELAY': 0.5, 'MAX_DELAY': 5.0}  # 2xx with a truncated or non-JSON body
+    },
+    'CIRCUIT_BREAKER': {
+        'FAILURE_THRESHOLD': 20,  # consecutive timeouts, connection errors or 5xx that open a host's circuit
+        'RESET_TIMEOUT': 10,  # seconds an open circuit pauses requests before letting a probe through
+        'MAX_RESET_TIMEOUT': 300,  # the pause doubles after every failed probe, up to this
+        'HALF_OPEN_REQUESTS': 1,  # probe requests in flight while half-open
+        'MAX_OPEN_TIME': 1800  # seconds paused requests wait before they fail; None waits forever
+    },
+    'DEAD_LETTER': {
+        'PATH': 'dead_letters.ndjson',  # domains that failed in the last run, usable as --input of a retry run
+        'FAILURE_CLASSES': ['timeout', 'connection', 'throttled', 'server_error', 'payload', 'circuit_open']
+    },
+    'REPORT': {
+        'TRACK_DOMAINS': False,  # keep the sets of processed and failed domains in memory
+        'MAX_DOMAINS': 100000  # upper bound for each of those sets
+    },
+    'LOGGING': {
+        'PATH': None,  # log file, defaults to api_calls_<start time>.log
+        'LEVEL': 'INFO',
+        'FORMAT': 'text',  # 'text' or 'json' (one object per line with structured fields)
+        'ASYNC': True,  # hand records to a background writer thread instead of writing in the caller
+        'QUEUE_SIZE': 100000,  # records buffered for the writer; DEBUG and INFO records beyond this are dropped
+        'MAX_BYTES': 0,  # rotate the file once it reaches this size; 0 never rotates
+        'BACKUP_COUNT': 5,  # rotated files kept
+        'SUCCESS_SAMPLE_RATE': 1.0  # fraction of per-request success lines written
+    },
+    'METRICS': {
+        'PORT': None,  # serve /metrics and /snapshot on this localhost port when set
+        'SNAPSHOT_PATH': None,  # write a JSON progress snapshot to this file when set
+        'SNAPSHOT_INTERVAL': 30  # seconds between snapshots
+    },
+    'CACHE': {
+        'ENABLED': True,  # reuse agent.ai responses across runs
+        'PATH': 'api_cache.sqlite3',
+        'TTL': 7 * 24 * 3600,  # seconds a valid response is served without refetching
+        'NEGATIVE_TTL': 24 * 3600,  # seconds an empty or invalid response is remembered
+        'MAX_ENTRIES': 5000000,  # oldest entries beyond this are evicted
+        'SERVE_STALE': True  # serve expired entries when the API fails
+    },
+    'INCREMENTAL': {
+        'ENABLED': False,  # fetch only domains not fetched within MAX_AGE and upload only changed records
+        'PATH': 'import_state.sqlite3',  # last fetch time and hash of the last uploaded record per domain
+        'MAX_AGE': 7 * 24 * 3600,  # seconds after which a domain is fetched again
+        'FLUSH_INTERVAL': 1.0  # seconds between batched writes to the state file
+    },
+    'DEDUP': {
+        'ENABLED': True,  # skip repeated domains before any network I/O
+        'MAX_EXACT': 2000000,  # domains held in an exact set before switching to a Bloom filter
+        'BLOOM_CAPACITY': 50000000,  # expected distinct domains once the Bloom filter is in use
+        'BLOOM_ERROR_RATE': 0.001  # fraction of new domains wrongly treated as duplicates
+    },
+    'JOURNAL': {
+        'PATH': 'progress.journal',  # append-only record of fetch and upload outcomes per domain
+        'FSYNC_INTERVAL': 1.0  # seconds between batched fsyncs
+    },
+    'ASYNC': {
+        'MAX_INFLIGHT_FETCHES': 500,  # concurrent agent.ai requests in the async engine
+        'MAX_INFLIGHT_UPLOADS': 200  # concurrent server uploads in the async engine
+    },
+    'BATCH_UPLOAD': {
+        'ENABLED': False,  # upload through the bulk endpoint instead of one request per record
+        'ENDPOINT': '/crawler/institution/bulk',
+        'FORMAT': 'json',  # 'json' (array) or 'ndjson' (one record per line)
+        'SIZE': 200,  # records per batch
+        'MAX_WAIT_MS': 500  # send a partial batch once its oldest record waited this long
+    },
+    'PIPELINE': {
+        'QUEUE_SIZE': 1000,  # capacity of each stage's input queue
+        'MAP_WORKERS': 4,  # mapping-stage workers
+        'UPLOAD_WORKERS': 200,  # upload-stage threads in the thread engine
+        'STATS_INTERVAL': 30  # seconds between queue-depth log lines
+    },
+    'INPUT': {
+        'FORMAT': None,  # 'csv', 'ndjson', 'text' or 'parquet'; detected from the file name when unset
+        'COLUMN': 0,  # CSV/Parquet column or NDJSON field holding the URL, by name or zero-based index
+        'ENCODING': 'utf-8'
+    },
+    'MAPPING': {
+        'PATH': None,  # JSON file with the field mapping, defaults to COMPANY_MAPPING
+        'JSON_BACKEND': 'auto'  # 'auto' (orjson if installed), 'orjson' or 'json' for parsing API responses
+    },
+    'SINKS': {
+        'OUTPUTS': [],  # mirror mapped records to these 'kind:path' sinks, e.g. 'sqlite:records.sqlite3'
+        'UPLOAD': True,  # upload mapped records to the server; off to only fill the sinks
+        'BATCH_SIZE': 1000,  # records written to a sink at a time
+        'ROTATE_RECORDS': 1000000  # records per NDJSON or Parquet file
+    },
+    'SHARDS': {
+        'PROCESSES': 1,  # worker processes; above 1 the input is split between them by domain
+        'REPORT_INTERVAL': 5  # seconds between report updates sent by each worker to the coordinator
+    },
+    'TOKEN': {
+        'REFRESH_INTERVAL': 3600,  # token lifetime in seconds when the token carries no JWT expiry
+        'REFRESH_MARGIN': 300,  # refresh in the background this many seconds before expiry
+        'BACKGROUND_REFRESH': True
+    },
+    'HTTP': {
+        'TRANSPORT': 'native',  # 'native' (pooled, in-process) or 'curl' (subprocess fallback)
+        'POOL_SIZE': 100,  # keep-alive connections per host
+        'TIMEOUT': 30,  # seconds, applied to connect and read
+        'HTTP2': True  # use HTTP/2 when httpx with h2 support is installed
+    }
 }
 
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    filename=f'api_calls_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'
-)
+LOG_PATH = f'api_calls_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Set up logging until main() applies CONFIG['LOGGING'] with configure_logging();
+# the file is only created once something is logged
+logging.basicConfig(level=logging.INFO, format=LOG_FORMAT, handlers=[logging.FileHandler(LOG_PATH, delay=True)])
+
+# LogRecord attributes, everything else on a record was passed through `extra=`
+_LOG_RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+class JSONLogFormatter(logging.Formatter):
+    """Format log records as one JSON object per line.
+
+    Besides time, level, process, thread and message, every field passed
+    with `extra=` becomes a key of its own, so lines can be filtered by
+    `domain`, `stage` or `status` without parsing the message.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'process': record.process,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _LOG_RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Put log records on a bounded queue for the writer thread without formatting them.
+
+    Unlike `QueueHandler`, records are queued as they are: the message is
+    merged with its arguments and formatted on the writer thread, so a log
+    call costs the caller little more than creating the record. When the
+    queue is full, DEBUG and INFO records are dropped and counted, while
+    warnings and errors wait for room.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if record.levelno >= logging.WARNING:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+_log_listener = None
+_log_queue_handler = None
+
+def configure_logging() -> None:
+    """Replace the handlers of the root logger according to `CONFIG['LOGGING']`.
+
+    With `ASYNC`, the thousand upload threads only put records on a queue
+    and a `QueueListener` thread formats them and writes the file, so no
+    caller waits for the handler lock or the disk. With `MAX_BYTES`, the
+    file is rotated by size. Calling this again, e.g. in a shard worker,
+    first stops the previous writer.
+    """
+    global _log_listener, _log_queue_handler
+    settings = CONFIG['LOGGING']
+    shutdown_logging()
+    path = settings['PATH'] or LOG_PATH
+    if settings['MAX_BYTES']:
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=settings['MAX_BYTES'], backupCount=settings['BACKUP_COUNT'], encoding='utf-8', delay=True
+        )
+    else:
+        handler = logging.FileHandler(path, encoding='utf-8', delay=True)
+    handler.setFormatter(JSONLogFormatter() if settings['FORMAT'] == 'json' else logging.Formatter(LOG_FORMAT))
+
+    root = logging.getLogger()
+    for previous in root.handlers[:]:
+        root.removeHandler(previous)
+        previous.close()
+    if settings['ASYNC']:
+        _log_queue_handler = LogQueueHandler(queue.Queue(settings['QUEUE_SIZE']))
+        _log_listener = logging.handlers.QueueListener(_log_queue_handler.queue, handler)
+        _log_listener.start()
+        root.addHandler(_log_queue_handler)
+    else:
+        root.addHandler(handler)
+    root.setLevel(settings['LEVEL'])
+
+def shutdown_logging() -> None:
+    """Write out every queued record and stop the writer thread.
+
+    The file handler is attached to the root logger directly afterwards,
+    so records logged later are still written, synchronously.
+    """
+    global _log_listener, _log_queue_handler
+    if _log_listener is None:
+        return
+    listener, handler = _log_listener, _log_queue_handler
+    _log_listener = _log_queue_handler = None
+    if handler.dropped:
+        logging.warning(f"Dropped {handler.dropped} log records because the log queue was full")
+    root = logging.getLogger()
+    for target in listener.handlers:
+        root.addHandler(target)
+    root.removeHandler(handler)
+    listener.stop()
+
+atexit.register(shutdown_logging)
+
+def log_success(message: str, *args: Any, **fields: Any) -> None:
+    """Log a per-request success at INFO, keeping `CONFIG['LOGGING']['SUCCESS_SAMPLE_RATE']` of them.
+
+    Unsampled calls return before a record is created. Sampled records
+    carry the rate as `sample_rate` so JSON lines can be scaled back up;
+    the run report keeps the exact counts.
+
+    Args:
+        message (str): The message, with `%` placeholders for `args`.
+        *args: Values formatted into the message by the writer.
+        **fields: Structured fields for the JSON format, e.g. `domain`.
+    """
+    rate = CONFIG['LOGGING']['SUCCESS_SAMPLE_RATE']
+    if rate < 1:
+        if random.random() >= rate:
+            return
+        fields['sample_rate'] = rate
+    logging.info(message, *args, extra=fields)
+
+class TransportError(Exception):
+    """Raised when an HTTP request could not be completed by the transport."""
+
+class CircuitOpenError(TransportError):
+    """Raised instead of sending a request while the circuit breaker of its host stays open."""
+
+class HTTPResponse:
+    def __init__(self, status: int, body: str, headers: Optional[Dict[str, str]] = None):
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+
+    @property
+    def ok(self) -> bool:
+        """Return True if the response has a 2xx or 3xx status code."""
+        return 200 <= self.status < 400
+
+class HTTPClient:
+    def __init__(self, pool_size: int = 100, timeout: float = 30):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._idle: Dict[tuple, queue.LifoQueue] = {}
+        self._slots: Dict[tuple, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+        self._ssl_context = ssl.create_default_context()
+
+    def _pool_for(self, key: tuple) -> tuple[queue.LifoQueue, threading.BoundedSemaphore]:
+        """Return the idle-connection queue and slot semaphore for a host.
+
+        Pools are created lazily the first time a host is contacted. The
+        semaphore bounds the number of connections that may be open to the
+        host at the same time, so callers beyond the pool size wait for a
+        connection to be released instead of opening new sockets.
+
+        Args:
+            key (tuple): A (scheme, host, port) tuple identifying the host.
+
+        Returns:
+            tuple[queue.LifoQueue, threading.BoundedSemaphore]: The idle
+            connection queue and the semaphore guarding the host's slots.
+        """
+        with self._lock:
+            if key not in self._idle:
+                self._idle[key] = queue.LifoQueue()
+                self._slots[key] = threading.BoundedSemaphore(self.pool_size)
+            return self._idle[key], self._slots[key]
+
+    def _connect(self, key: tuple) -> http.client.HTTPConnection:
+        scheme, host, port = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout, context=self._ssl_context)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def request(self, method: str, url: str, headers: Optional[Dict[str, str]] = None,
+                body: Optional[str] = None) -> HTTPResponse:
+        """Send an HTTP request over a pooled keep-alive connection.
+
+        This method takes an idle connection to the target host from the pool
+        (or opens a new one if none is idle), sends the request and reads the
+        full response body. Connections are returned to the pool unless the
+        server asked to close them. If a reused connection turns out to have
+        been closed by the server while idle, the request is sent once more
+        on a fresh connection.
+
+        Args:
+            method (str): The HTTP method, e.g. 'POST'.
+            url (str): The absolute URL to request.
+            headers (Optional[Dict[str, str]]): Request headers.
+            body (Optional[str]): The request body, encoded as UTF-8.
+
+        Returns:
+            HTTPResponse: The status, decoded body and headers of the response.
+
+        Raises:
+            TransportError: If the request could not be completed.
+        """
+        parsed = urlparse(url)
+        scheme = parsed.scheme or 'http'
+        port = parsed.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parsed.hostname, port)
+        path = parsed.path or '/'
+        if parsed.query:
+            path = f'{path}?{parsed.query}'
+        payload = body.encode('utf-8') if body is not None else None
+
+        idle, slots = self._pool_for(key)
+        slots.acquire()
+        try:
+            for attempt in range(2):
+                try:
+                    conn = idle.get_nowait()
+                    reused = True
+                except queue.Empty:
+                    conn = self._connect(key)
+                    reused = False
+                try:
+                    conn.request(method, path, body=payload, headers=headers or {})
+                    resp = conn.getresponse()
+                    data = resp.read()
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                    conn.close()
+                    if reused and attempt == 0:
+                        continue
+                    raise TransportError(f"{method} {url} failed: {str(e)}") from e
+                except (OSError, http.client.HTTPException) as e:
+                    conn.close()
+                    raise TransportError(f"{method} {url} failed: {str(e)}") from e
+
+                if resp.will_close:
+                    conn.close()
+                else:
+                    idle.put(conn)
+                charset = resp.headers.get_content_charset() or 'utf-8'
+                return HTTPResponse(resp.status, data.decode(charset, errors='replace'), dict(resp.headers))
+        finally:
+            slots.release()
+
+    def close(self) -> None:
+        """Close all idle pooled connections."""
+        with self._lock:
+            for idle in self._idle.values():
+                while True:
+                    try:
+                        idle.get_nowait().close()
+                    except queue.Empty:
+                        break
+
+class HTTP2Client:
+    def __init__(self, pool_size: int = 100, timeout: float = 30):
+        import httpx  # optional dependency, only needed for HTTP/2
+        self._client = httpx.Client(
+            http2=True,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        )
+        self._errors = (httpx.HTTPError,)
+
+    def request(self, method: str, url: str, headers: Optional[Dict[str, str]] = None,
+                body: Optional[str] = None) -> HTTPResponse:
+        """Send an HTTP request through the shared httpx client.
+
+        Requests to the same host are multiplexed over a single HTTP/2
+        connection when the server supports it, and fall back to pooled
+        HTTP/1.1 keep-alive connections otherwise.
+
+        Args:
+            method (str): The HTTP method, e.g. 'POST'.
+            url (str): The absolute URL to request.
+            headers (Optional[Dict[str, str]]): Request headers.
+            body (Optional[str]): The request body, encoded as UTF-8.
+
+        Returns:
+            HTTPResponse: The status, decoded body and headers of the response.
+
+        Raises:
+            TransportError: If the request could not be completed.
+        """
+        try:
+            resp = self._client.request(method, url, headers=headers, content=body)
+        except self._errors as e:
+            raise TransportError(f"{method} {url} failed: {str(e)}") from e
+        return HTTPResponse(resp.status_code, resp.text, dict(resp.headers))
+
+    def close(self) -> None:
+        """Close the underlying httpx client and its connections."""
+        self._client.close()
+
+def curl_command(method: str, url: str, headers: Optional[Dict[str, str]], body: Optional[str],
+                 timeout: float) -> List[str]:
+    """Build the curl argv for a request, writing the response headers before the body and the status code after it."""
+    command = ['curl', '--silent', '--show-error', '--location', url, '-X', method,
+               '--max-time', str(timeout), '--dump-header', '-', '--write-out', '\n%{http_code}']
+    for k, v in (headers or {}).items():
+        command += ['-H', f'{k}: {v}']
+    if body is not None:
+        command += ['--data-raw', body]
+    return command
+
+def parse_curl_output(stdout: str) -> HTTPResponse:
+    """Split curl output produced by `curl_command` into headers, body and status code.
+
+    curl writes one header block for every response it received, interim
+    1xx responses and followed redirects first. The headers of the block
+    with the final status are kept, with lower-case names as in
+    `AsyncHTTPClient`, so that e.g. `Retry-After` is honoured.
+    """
+    output, _, status = stdout.rpartition('\n')
+    headers = {}
+    while output.startswith('HTTP/'):
+        block, separator, rest = output.partition('\r\n\r\n')
+        if not separator:
+            break
+        lines = block.split('\r\n')
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        output = rest
+        if lines[0].split(None, 2)[1:2] == [status]:
+            break
+    return HTTPResponse(int(status) if status.isdigit() else 0, output, headers)
+
+class CurlTransport:
+    def __init__(self, timeout: float = 30):
+        self.timeout = timeout
+
+    def request(self, method: str, url: str, headers: Optional[Dict[str, str]] = None,
+                body: Optional[str] = None) -> HTTPResponse:
+        """Send an HTTP request by running a `curl` subprocess.
+
+        This is the original transport, kept as a fallback for hosts where the
+        in-process client misbehaves. The response headers are read from
+        curl's `--dump-header` output before the body, and the status from
+        its `--write-out` output after it.
+
+        Args:
+            method (str): The HTTP method, e.g. 'POST'.
+            url (str): The absolute URL to request.
+            headers (Optional[Dict[str, str]]): Request headers.
+            body (Optional[str]): The raw request body.
+
+        Returns:
+            HTTPResponse: The status, body and headers of the response.
+
+        Raises:
+            TransportError: If curl exits with a non-zero status.
+        """
+        try:
+            # Bytes rather than text, so the CRLFs separating the header blocks are kept
+            result = subprocess.run(curl_command(method, url, headers, body, self.timeout),
+                                    capture_output=True, check=True)
+        except subprocess.CalledProcessError as e:
+            raise TransportError(f"{method} {url} failed: {e.stderr.decode(errors='replace').strip() or str(e)}") from e
+        return parse_curl_output(result.stdout.decode('utf-8', errors='replace'))
+
+    def close(self) -> None:
+        pass
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+def create_http_client(settings: Dict[str, Any]):
+    """Create an HTTP transport from the given settings.
+
+    The 'curl' transport runs one subprocess per request, as the importer
+    originally did. The 'native' transport keeps per-host pools of keep-alive
+    connections in-process and uses HTTP/2 when it is enabled and httpx with
+    h2 support is installed.
+
+    Args:
+        settings (Dict[str, Any]): The `CONFIG['HTTP']` settings.
+
+    Returns:
+        The transport object, exposing `request()` and `close()`.
+    """
+    if settings['TRANSPORT'] == 'curl':
+        return CurlTransport(timeout=settings['TIMEOUT'])
+    if settings.get('HTTP2'):
+        try:
+            return HTTP2Client(pool_size=settings['POOL_SIZE'], timeout=settings['TIMEOUT'])
+        except ImportError:
+            logging.debug("httpx with HTTP/2 support not installed, using HTTP/1.1 keep-alive pool")
+    return HTTPClient(pool_size=settings['POOL_SIZE'], timeout=settings['TIMEOUT'])
+
+def get_http_client():
+    """Return the process-wide HTTP transport, creating it on first use."""
+    global _http_client
+    if _http_client is None:
+        with _http_client_lock:
+            if _http_client is None:
+                _http_client = create_http_client(CONFIG['HTTP'])
+    return _http_client
+
+class AsyncHTTPClient:
+    def __init__(self, pool_size: int = 100, timeout: float = 30):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._idle: Dict[tuple, List[tuple]] = {}
+        self._slots: Dict[tuple, asyncio.Semaphore] = {}
+        self._ssl_context = ssl.create_default_context()
+
+    async def _exchange(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, method: str,
+                        host: str, path: str, headers: Dict[str, str],
+                        payload: bytes) -> tuple[int, Dict[str, str], bytes, bool]:
+        """Write one HTTP/1.1 request and read the complete response.
+
+        Args:
+            reader (asyncio.StreamReader): The connection's read side.
+            writer (asyncio.StreamWriter): The connection's write side.
+            method (str): The HTTP method.
+            host (str): The value of the Host header.
+            path (str): The request target, including any query string.
+            headers (Dict[str, str]): Request headers.
+            payload (bytes): The encoded request body.
+
+        Returns:
+            tuple[int, Dict[str, str], bytes, bool]: The status code, response
+            headers, response body and whether the connection may be reused.
+        """
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {host}']
+        lines += [f'{k}: {v}' for k, v in headers.items()]
+        lines.append(f'Content-Length: {len(payload)}')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + payload)
+        await writer.drain()
+
+        while True:
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionResetError("Connection closed by server")
+            version, status = status_line.decode('latin-1').split(None, 2)[:2]
+
+            resp_headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                resp_headers[name.strip().lower()] = value.strip()
+            code = int(status)
+            # Interim 1xx responses (100 Continue, 103 Early Hints) precede the final one
+            if not 100 <= code < 200 or code == 101:
+                break
+
+        # After 101 Switching Protocols the connection no longer speaks HTTP/1.1
+        keep_alive = (version == 'HTTP/1.1' and code != 101
+                      and resp_headers.get('connection', '').lower() != 'close')
+        if method == 'HEAD' or code in (101, 204, 304):
+            # These responses never have a body, whatever their headers say
+            body = b''
+        elif 'chunked' in resp_headers.get('transfer-encoding', '').lower():
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0].strip(), 16)
+                if size == 0:
+                    # Skip trailers up to the terminating blank line
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(chunks)
+        elif 'content-length' in resp_headers:
+            body = await reader.readexactly(int(resp_headers['content-length']))
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return code, resp_headers, body, keep_alive
+
+    async def request(self, method: str, url: str, headers: Optional[Dict[str, str]] = None,
+                      body: Optional[str] = None) -> HTTPResponse:
+        """Send an HTTP request over a pooled keep-alive connection.
+
+        This is the asyncio counterpart of `HTTPClient.request`. Connections
+        are opened with asyncio streams and kept per host; a semaphore bounds
+        the number of open connections per host to the pool size. A request
+        that fails on a reused connection is sent once more on a fresh one.
+
+        Args:
+            method (str): The HTTP method, e.g. 'POST'.
+            url (str): The absolute URL to request.
+            headers (Optional[Dict[str, str]]): Request headers.
+            body (Optional[str]): The request body, encoded as UTF-8.
+
+        Returns:
+            HTTPResponse: The status, decoded body and headers of the response.
+
+        Raises:
+            TransportError: If the request could not be completed.
+        """
+        parsed = urlparse(url)
+        scheme = parsed.scheme or 'http'
+        port = parsed.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parsed.hostname, port)
+        path = parsed.path or '/'
+        if parsed.query:
+            path = f'{path}?{parsed.query}'
+        payload = body.encode('utf-8') if body is not None else b''
+
+        if key not in self._slots:
+            self._slots[key] = asyncio.Semaphore(self.pool_size)
+            self._idle[key] = []
+        idle = self._idle[key]
+
+        async with self._slots[key]:
+            for attempt in range(2):
+                reused = bool(idle)
+                try:
+                    if reused:
+                        reader, writer = idle.pop()
+                    else:
+                        reader, writer = await asyncio.wait_for(
+                            asyncio.open_connection(
+                                parsed.hostname, port,
+                                ssl=self._ssl_context if scheme == 'https' else None
+                            ),
+                            self.timeout
+                        )
+                except (OSError, asyncio.TimeoutError) as e:
+                    raise TransportError(f"{method} {url} failed: {str(e) or type(e).__name__}") from e
+
+                try:
+                    status, resp_headers, data, keep_alive = await asyncio.wait_for(
+                        self._exchange(reader, writer, method, parsed.netloc, path, headers or {}, payload),
+                        self.timeout
+                    )
+                except (ConnectionError, asyncio.IncompleteReadError) as e:
+                    writer.close()
+                    if reused and attempt == 0:
+                        continue
+                    raise TransportError(f"{method} {url} failed: {str(e)}") from e
+                except (OSError, ValueError, asyncio.TimeoutError) as e:
+                    writer.close()
+                    raise TransportError(f"{method} {url} failed: {str(e) or type(e).__name__}") from e
+
+                if keep_alive:
+                    idle.append((reader, writer))
+                else:
+                    writer.close()
+                return HTTPResponse(status, data.decode('utf-8', errors='replace'), resp_headers)
+
+    async def close(self) -> None:
+        """Close all idle pooled connections."""
+        for idle in self._idle.values():
+            while idle:
+                idle.pop()[1].close()
+
+class AsyncHTTP2Client:
+    def __init__(self, pool_size: int = 100, timeout: float = 30):
+        import httpx  # optional dependency, only needed for HTTP/2
+        self._client = httpx.AsyncClient(
+            http2=True,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        )
+        self._errors = (httpx.HTTPError,)
+
+    async def request(self, method: str, url: str, headers: Optional[Dict[str, str]] = None,
+                      body: Optional[str] = None) -> HTTPResponse:
+        """Send an HTTP request through the shared async httpx client."""
+        try:
+            resp = await self._client.request(method, url, headers=headers, content=body)
+        except self._errors as e:
+            raise TransportError(f"{method} {url} failed: {str(e)}") from e
+        return HTTPResponse(resp.status_code, resp.text, dict(resp.headers))
+
+    async def close(self) -> None:
+        """Close the underlying httpx client and its connections."""
+        await self._client.aclose()
+
+class AsyncCurlTransport:
+    def __init__(self, timeout: float = 30):
+        self.timeout = timeout
+
+    async def request(self, method: str, url: str, headers: Optional[Dict[str, str]] = None,
+                      body: Optional[str] = None) -> HTTPResponse:
+        """Send an HTTP request by running a `curl` subprocess without blocking the event loop."""
+        process = await asyncio.create_subprocess_exec(
+            *curl_command(method, url, headers, body, self.timeout),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        if process.returncode != 0:
+            error = subprocess.CalledProcessError(process.returncode, 'curl', stderr=stderr)
+            raise TransportError(f"{method} {url} failed: {stderr.decode(errors='replace').strip()}") from error
+        return parse_curl_output(stdout.decode('utf-8', errors='replace'))
+
+    async def close(self) -> None:
+        pass
+
+def create_async_http_client(settings: Dict[str, Any]):
+    """Create an asyncio HTTP transport from the given settings.
+
+    This mirrors `create_http_client` for the async engine. The returned
+    transport must be created and used inside a running event loop.
+
+    Args:
+        settings (Dict[str, Any]): The `CONFIG['HTTP']` settings.
+
+    Returns:
+        The transport object, exposing coroutine `request()` and `close()` methods.
+    """
+    if settings['TRANSPORT'] == 'curl':
+        return AsyncCurlTransport(timeout=settings['TIMEOUT'])
+    if settings.get('HTTP2'):
+        try:
+            return AsyncHTTP2Client(pool_size=settings['POOL_SIZE'], timeout=settings['TIMEOUT'])
+        except ImportError:
+            logging.debug("httpx with HTTP/2 support not installed, using HTTP/1.1 keep-alive pool")
+    return AsyncHTTPClient(pool_size=settings['POOL_SIZE'], timeout=settings['TIMEOUT'])
+
+def jwt_expiry(token: str) -> Optional[float]:
+    """Return the `exp` claim of a JWT as a Unix timestamp, or None if the token has none."""
+    parts = token.split('.')
+    if len(parts) != 3:
+        return None
+    try:
+        claims = json.loads(base64.urlsafe_b64decode(parts[1] + '=' * (-len(parts[1]) % 4)))
+    except ValueError:
+        return None
+    exp = claims.get('exp') if isinstance(claims, dict) else None
+    return float(exp) if isinstance(exp, (int, float)) else None
 
 class TokenManager:
     def __init__(self):
+        settings = CONFIG['TOKEN']
         self.token = None
         self.last_refresh = None
-        self.refresh_interval = 3600  # 1 hour
+        self.expires_at = None
+        self.refresh_at = None
+        self.refresh_interval = settings['REFRESH_INTERVAL']
+        self.refresh_margin = settings['REFRESH_MARGIN']
+        self.background_refresh = settings['BACKGROUND_REFRESH']
+        self.refresh_count = 0
+        self._lock = threading.Lock()
+        self._async_refresh = None
+        self._stop = threading.Event()
+        self._refresher = None
 
     def get_token(self) -> str:
         """Retrieve the authentication token.
 
         This function checks if the current token is valid based on its
-        existence and the time elapsed since the last refresh. If the token is
-        missing or has expired, it calls the `refresh_token` method to obtain a
-        new token. Finally, it returns the current token.
+        existence and its expiry time. If the token is missing or has
+        expired, it calls the `refresh_token` method to obtain a new token.
+        Only one caller logs in; concurrent callers wait for that login and
+        then use its token. Finally, it returns the current token.
+
+        Returns:
+            str: The current authentication token.
+        """
+
+        if self.needs_refresh():
+            self._refresh_once(self.needs_refresh)
+        return self.token
+
+    def needs_refresh(self) -> bool:
+        """Return True if there is no token yet or the current one has expired."""
+        return (not self.token or
+                not self.expires_at or
+                time.time() >= self.expires_at)
+
+    def _refresh_once(self, stale: Callable[[], bool]) -> None:
+        # Callers queue up on the lock; whoever gets it first logs in and the
+        # rest find the token no longer stale.
+        with self._lock:
+            if stale():
+                self.refresh_token()
+
+    async def _refresh_once_async(self, stale: Callable[[], bool]) -> None:
+        # Coroutines share one refresh task, so a burst of them costs a single
+        # worker thread and a single login.
+        if self._async_refresh is None or self._async_refresh.done():
+            self._async_refresh = asyncio.ensure_future(asyncio.to_thread(self._refresh_once, stale))
+        await asyncio.shield(self._async_refresh)
+
+    async def get_token_async(self) -> str:
+        """Retrieve the authentication token from within an event loop.
+
+        This is the asyncio counterpart of `get_token`. The token is returned
+        directly while it is valid; a refresh runs in a worker thread so the
+        event loop is not blocked during the login request.
+
+        Returns:
+            str: The current authentication token.
+        """
+        if self.needs_refresh():
+            await self._refresh_once_async(self.needs_refresh)
+        return self.token
+
+    def force_refresh(self, rejected_token: str) -> str:
+        """Replace a token the server rejected and return the new one.
+
+        Only the first caller reporting a given token logs in again; callers
+        that were rejected with the same token get the replacement.
+
+        Args:
+            rejected_token (str): The token the server answered 401 to.
 
         Returns:
             str: The current authentication token.
         """
+        self._refresh_once(lambda: self.token == rejected_token)
+        return self.token
 
-        if (not self.token or 
-            not self.last_refresh or 
-            time.time() - self.last_refresh > self.refresh_interval):
-            self.refresh_token()
+    async def force_refresh_async(self, rejected_token: str) -> str:
+        """Replace a token the server rejected from within an event loop."""
+        await self._refresh_once_async(lambda: self.token == rejected_token)
         return self.token
 
     def refresh_token(self) -> None:
         """Refresh the authentication token.
 
         This method sends a request to the server to refresh the authentication
-        token. It constructs a curl command with the necessary headers and data,
-        executes it, and updates the instance's token with the new access token
-        received in the response. If the token refresh is successful, it also
-        updates the last refresh time.
+        token. It posts the configured credentials as form data to the login
+        endpoint through the shared HTTP transport and updates the instance's
+        token with the new access token received in the response. If the token
+        refresh is successful, it also updates the last refresh time and the
+        expiry, taken from the JWT `exp` claim when present and otherwise
+        `refresh_interval` seconds from now, and starts the background refresh.
         """
 
         try:
-            command = [
-                'curl', '--location', f'{CONFIG["SERVER_URL"]}/login',
-                '--header', 'Content-Type: application/x-www-form-urlencoded',
-                '--data-urlencode', f'username={CONFIG["AUTH"]["username"]}',
-                '--data-urlencode', f'password={CONFIG["AUTH"]["password"]}'
-            ]
-            
-            result = subprocess.run(command, capture_output=True, text=True, check=True)
-            response = json.loads(result.stdout)
-            self.token = response.get('access_token')
-            self.last_refresh = time.time()
+            response = get_http_client().request(
+                'POST', f'{CONFIG["SERVER_URL"]}/login',
+                headers={'Content-Type': 'application/x-www-form-urlencoded'},
+                body=urlencode({
+                    'username': CONFIG["AUTH"]["username"],
+                    'password': CONFIG["AUTH"]["password"]
+                })
+            )
+            if not response.ok:
+                raise TransportError(f"Login failed with HTTP {response.status}")
+            response_data = json.loads(response.body)
+            token = response_data.get('access_token')
+            now = time.time()
+            expires_at = jwt_expiry(token) if token else None
+            if not expires_at or expires_at <= now:
+                expires_at = now + self.refresh_interval
+            self.expires_at = expires_at
+            self.refresh_at = expires_at - min(self.refresh_margin, (expires_at - now) / 2)
+            self.token = token
+            self.last_refresh = now
+            self.refresh_count += 1
             logging.info("Token refreshed successfully")
         except Exception as e:
             logging.error(f"Error refreshing token: {str(e)}")
             raise
+        if self.background_refresh and self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresh_in_background, name='token-refresh', daemon=True)
+            self._refresher.start()
+
+    def _refresh_in_background(self) -> None:
+        # Log in shortly before the token expires, so workers never wait for a login
+        delay = 0.0
+        while not self._stop.wait(max(delay, 1.0)):
+            delay = self.refresh_at - time.time()
+            if delay > 0:
+                continue
+            try:
+                self._refresh_once(lambda: time.time() >= self.refresh_at)
+            except Exception:
+                delay = 5.0
+
+    def close(self) -> None:
+        """Stop the background refresh."""
+        self._stop.set()
+        if self._refresher:
+            self._refresher.join()
+
+# Upper bounds, in seconds, of the latency histogram buckets (1 ms to roughly 10 minutes)
+LATENCY_BUCKETS = [0.001 * 1.25 ** i for i in range(60)]
+
+class ReportShard:
+    __slots__ = ('counters', 'latency', 'retries')
 
-class Report:
     def __init__(self):
-        self.stats = {
-            "success_count": 0,
-            "error_count": 0,
-            "start_time": datetime.now(),
-            "last_save_time": None,
-            "processed_domains": set(),
-            "failed_domains": set(),
-            "retry_count": {}
-        }
-    
+        self.counters = defaultdict(int)
+        self.latency: Dict[str, List[int]] = {}
+        self.retries = defaultdict(int)
+
+class Report:
+    def __init__(self, track_domains: Optional[bool] = None, max_domains: Optional[int] = None):
+        settings = CONFIG['REPORT']
+        self.start_time = datetime.now()
+        self.track_domains = settings['TRACK_DOMAINS'] if track_domains is None else track_domains
+        self.max_domains = max_domains or settings['MAX_DOMAINS']
+        self.processed_domains = set()
+        self.failed_domains = set()
+        self.pipeline = None  # the StagedPipeline currently feeding this report, for metrics
+        self._started = time.monotonic()
+        self._local = threading.local()
+        self._shards: List[ReportShard] = []
+        self._remote: Dict[str, ReportShard] = {}
+        self._lock = threading.Lock()
+
+    def _shard(self) -> ReportShard:
+        """Return the calling thread's shard, creating it on first use.
+
+        Each thread only ever writes to its own shard, so updates need no
+        lock; shards are merged when the report is read. Coroutines of the
+        async engine all run on the event loop thread and share its shard.
+        """
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = ReportShard()
+            self._local.shard = shard
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
     def update(self, success: bool, domain: Optional[str] = None, retries: int = 0) -> None:
         """Update the statistics based on the success of an operation.
 
-        This method updates the internal statistics of the object, incrementing
-        the success or error counts based on the outcome of an operation. If the
-        operation was successful, it increments the success count and adds the
-        domain to the set of processed domains if provided. If the operation
-        failed, it increments the error count and adds the domain to the set of
-        failed domains if provided. Additionally, if there are retries, it
-        updates the retry count for the specified domain.
+        This method increments the success or error count of the calling
+        thread's shard. If domain tracking is enabled, the domain is added to
+        the set of processed or failed domains as long as that set holds
+        fewer than `max_domains` entries. If there were retries, the retry
+        histogram is updated.
 
         Args:
             success (bool): Indicates whether the operation was successful.
@@ -128,18 +1033,220 @@ class Report:
         Returns:
             None: This method does not return any value.
         """
+        self._shard().counters['success_count' if success else 'error_count'] += 1
+        self.record_retries(retries)
+        if domain and self.track_domains:
+            domains = self.processed_domains if success else self.failed_domains
+            with self._lock:
+                if len(domains) < self.max_domains:
+                    domains.add(domain)
 
-        if success:
-            self.stats["success_count"] += 1
-            if domain:
-                self.stats["processed_domains"].add(domain)
-        else:
-            self.stats["error_count"] += 1
-            if domain:
-                self.stats["failed_domains"].add(domain)
-        
+    def record_retries(self, retries: int) -> None:
+        """Add a request that needed `retries` retries to the retry histogram; zero is not counted."""
         if retries > 0:
-            self.stats["retry_count"][domain] = retries
+            self._shard().retries[retries] += 1
+
+    def record_cache(self, event: str) -> None:
+        """Count a response cache lookup.
+
+        Args:
+            event (str): 'hit' for a fresh entry, 'miss' when the API had to be
+                called, or 'stale' when an expired entry was served because the
+                API failed.
+        """
+        self._shard().counters[f'cache_{event}'] += 1
+
+    def record_incremental(self, event: str) -> None:
+        """Count a domain skipped by the incremental mode.
+
+        Args:
+            event (str): 'fresh' for a domain not fetched because it was
+                fetched within `MAX_AGE`, or 'unchanged' for a record not
+                uploaded because it equals the last uploaded version.
+        """
+        self._shard().counters[f'incremental_{event}'] += 1
+
+    def record_latency(self, stage: str, seconds: float) -> None:
+        """Add a duration to the latency histogram of a pipeline stage.
+
+        Args:
+            stage (str): The stage name, e.g. 'fetch', 'map' or 'upload'.
+            seconds (float): How long the stage took for one item, or one HTTP request for 'fetch' and 'upload'.
+        """
+        histogram = self._shard().latency.get(stage)
+        if histogram is None:
+            histogram = self._shard().latency[stage] = [0] * (len(LATENCY_BUCKETS) + 1)
+        histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self._shard().counters[f'latency_sum_{stage}'] += seconds
+
+    def record_rate_limit_wait(self, seconds: float, bucket: str = 'api') -> None:
+        """Add time spent waiting for the rate limiter of the 'api' or 'server' bucket."""
+        self._shard().counters[f'rate_limit_wait_seconds_{bucket}'] += seconds
+
+    def record_throttled(self, bucket: str) -> None:
+        """Count a 429 response from the service behind the 'api' or 'server' bucket."""
+        self._shard().counters[f'throttled_{bucket}'] += 1
+
+    def record_failure(self, bucket: str, failure: str) -> None:
+        """Count a failed attempt against the 'api' or 'server' bucket by its failure class."""
+        self._shard().counters[f'failure_{bucket}_{failure}'] += 1
+
+    def record_dead_letter(self) -> None:
+        """Count a domain written to the dead-letter file."""
+        self._shard().counters['dead_letters'] += 1
+
+    def export(self) -> Dict[str, Any]:
+        """Return the merged counters and histograms as plain data for `absorb`."""
+        return {
+            'counters': dict(self.counters()),
+            'retries': self.retry_histogram(),
+            'latency': {stage: self.latency_histogram(stage) for stage in self.stages()}
+        }
+
+    def absorb(self, source: str, state: Dict[str, Any]) -> None:
+        """Replace the contribution of another process with its latest exported state.
+
+        The coordinator of a sharded run calls this with each worker's
+        `export()`, so the merged report covers all shards.
+
+        Args:
+            source (str): Identifies the process, e.g. 'shard-0'.
+            state (Dict[str, Any]): The state returned by that process's `export()`.
+        """
+        shard = ReportShard()
+        shard.counters.update(state['counters'])
+        shard.retries.update(state['retries'])
+        shard.latency = {stage: list(histogram) for stage, histogram in state['latency'].items()}
+        with self._lock:
+            previous = self._remote.get(source)
+            if previous is not None:
+                self._shards.remove(previous)
+            self._remote[source] = shard
+            self._shards.append(shard)
+
+    def stages(self) -> List[str]:
+        """Return the names of the stages with recorded latencies."""
+        with self._lock:
+            return sorted({stage for shard in self._shards for stage in list(shard.latency)})
+
+    def counters(self) -> Dict[str, int]:
+        """Return all counters merged across shards."""
+        merged = defaultdict(int)
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for key, value in list(shard.counters.items()):
+                merged[key] += value
+        return merged
+
+    def retry_histogram(self) -> Dict[int, int]:
+        """Return how many operations needed each number of retries."""
+        merged = defaultdict(int)
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for retries, count in list(shard.retries.items()):
+                merged[retries] += count
+        return dict(sorted(merged.items()))
+
+    def latency_histogram(self, stage: str) -> List[int]:
+        """Return the merged latency bucket counts of a stage."""
+        merged = [0] * (len(LATENCY_BUCKETS) + 1)
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for i, count in enumerate(shard.latency.get(stage, ())):
+                merged[i] += count
+        return merged
+
+    def latency_percentiles(self, stage: str) -> Dict[str, float]:
+        """Return the p50, p95 and p99 latency of a stage in seconds.
+
+        Percentiles are estimated from the histogram and reported as the
+        upper bound of the bucket they fall in, which overstates them by at
+        most 25%.
+
+        Args:
+            stage (str): The stage name.
+
+        Returns:
+            Dict[str, float]: The number of samples and the p50, p95 and p99 latency.
+        """
+        histogram = self.latency_histogram(stage)
+        total = sum(histogram)
+        result = {'count': total}
+        for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            value = 0.0
+            if total:
+                target = q * total
+                seen = 0
+                for i, count in enumerate(histogram):
+                    seen += count
+                    if seen >= target:
+                        value = LATENCY_BUCKETS[min(i, len(LATENCY_BUCKETS) - 1)]
+                        break
+            result[name] = round(value, 4)
+        return result
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Return a snapshot of the statistics in the original dictionary layout."""
+        counters = self.counters()
+        return {
+            "success_count": counters['success_count'],
+            "error_count": counters['error_count'],
+            "start_time": self.start_time,
+            "last_save_time": None,
+            "processed_domains": self.processed_domains,
+            "failed_domains": self.failed_domains,
+            "retry_count": self.retry_histogram(),
+            "cache": {
+                "hits": counters['cache_hit'],
+                "misses": counters['cache_miss'],
+                "stale": counters['cache_stale']
+            }
+        }
+
+    def summary(self) -> Dict[str, Any]:
+        """Return throughput, rates, latency percentiles and counters of the run.
+
+        Returns:
+            Dict[str, Any]: A JSON-serialisable summary with requests per
+            second, success and error rates, cache and incremental counters, the retry
+            histogram and p50/p95/p99 latency per pipeline stage.
+        """
+        counters = self.counters()
+        elapsed = time.monotonic() - self._started
+        total = counters['success_count'] + counters['error_count']
+        return {
+            "elapsed_seconds": round(elapsed, 1),
+            "success_count": counters['success_count'],
+            "error_count": counters['error_count'],
+            "requests_per_second": round(total / elapsed, 2) if elapsed > 0 else 0.0,
+            "success_rate": round(counters['success_count'] / total, 4) if total else 0.0,
+            "error_rate": round(counters['error_count'] / total, 4) if total else 0.0,
+            "cache": {
+                "hits": counters['cache_hit'],
+                "misses": counters['cache_miss'],
+                "stale": counters['cache_stale']
+            },
+            "incremental": {
+                "fresh_skipped": counters['incremental_fresh'],
+                "unchanged_skipped": counters['incremental_unchanged']
+            },
+            "rate_limit_wait_seconds": {
+                bucket: round(counters[f'rate_limit_wait_seconds_{bucket}'], 3) for bucket in ('api', 'server')
+            },
+            "throttled": {bucket: counters[f'throttled_{bucket}'] for bucket in ('api', 'server')},
+            "failures": {
+                bucket: {failure: counters[f'failure_{bucket}_{failure}'] for failure in FAILURE_CLASSES
+                         if counters[f'failure_{bucket}_{failure}']}
+                for bucket in ('api', 'server')
+            },
+            "dead_letters": counters['dead_letters'],
+            "retries": {str(k): v for k, v in self.retry_histogram().items()},
+            "latency": {stage: self.latency_percentiles(stage) for stage in self.stages()}
+        }
 
 def clean_domain(url: str) -> tuple[str, str]:
     """Extract and clean domain from a given URL.
@@ -173,345 +1280,3467 @@ def clean_domain(url: str) -> tuple[str, str]:
         logging.error(f"Error cleaning domain {url}: {str(e)}")
         return url, url
 
-@sleep_and_retry
-@limits(calls=1000, period=60)
-@backoff.on_exception(
-    backoff.expo,
-    (subprocess.CalledProcessError, json.JSONDecodeError),
-    max_tries=CONFIG['MAX_RETRIES']
-)
-def call_api(website: str, report: Report) -> Optional[Dict[str, Any]]:
-    """Call an external API with the specified website and report.
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
 
-    This function constructs a command to call an external API using the
-    `curl` command. It prepares the necessary data, executes the command,
-    and processes the response. If the response is valid, it enriches the
-    response data with additional information such as the original URL and
-    clean domain. The function also handles various error scenarios, logging
-    errors and updating the provided report object accordingly.
+    def _positions(self, item: str) -> Iterator[int]:
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
 
-    Args:
-        website (str): The website URL to be processed.
-        report (Report): An object used to log the success or failure of the API call.
+    def add(self, item: str) -> None:
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
 
-    Returns:
-        Optional[Dict[str, Any]]: A dictionary containing the API response data if successful,
-        or None if there was an error.
-    """
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
 
-    try:
-        clean_website, full_url = clean_domain(website)
-        data = {
-            "domain": clean_website,
-            "report_component": "harmonic_funding_and_web_traffic",
-            "user_id": None
-        }
+class DomainDeduplicator:
+    def __init__(self, max_exact: Optional[int] = None, bloom_capacity: Optional[int] = None,
+                 bloom_error_rate: Optional[float] = None, is_done: Optional[Callable[[str], bool]] = None):
+        settings = CONFIG['DEDUP']
+        self.max_exact = max_exact or settings['MAX_EXACT']
+        self.bloom_capacity = bloom_capacity or settings['BLOOM_CAPACITY']
+        self.bloom_error_rate = bloom_error_rate or settings['BLOOM_ERROR_RATE']
+        self.is_done = is_done
+        self.exact = set()
+        self.bloom = None
+        self.unique = 0
+        self.duplicates = 0
+        self.already_done = 0
 
-        command = [
-            'curl', CONFIG['API_URL'],
-            '-X', 'POST',
-            *sum((['-H', f'{k}: {v}'] for k, v in CONFIG['HEADERS'].items()), []),
-            '--data-raw', json.dumps(data)
-        ]
-        
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
-        
-        try:
-            # Log raw response for debugging
-            logging.debug(f"Raw API response for {website}: {result.stdout}")
-            
-            if not result.stdout.strip():
-                logging.error(f"Empty response for {website}")
-                report.update(success=False, domain=clean_website)
-                return None
-            
-            try:
-                response_data = json.loads(result.stdout)
-            except json.JSONDecodeError as e:
-                logging.error(f"Failed to parse JSON for {website}: {str(e)}")
-                report.update(success=False, domain=clean_website)
-                return None
-            
-            # Verify response is a dictionary
-            if not isinstance(response_data, dict):
-                logging.error(f"Invalid response type for {website}: {type(response_data)}")
-                report.update(success=False, domain=clean_website)
-                return None
-            
-            # Add URL information
-            response_data['original_url'] = website
-            response_data['clean_domain'] = clean_website
-            response_data['full_url'] = full_url
-            
-            logging.info(f"Successfully processed {website}")
-            report.update(success=True, domain=clean_website)
-            return response_data
-            
-        except Exception as e:
-            logging.error(f"Error processing response for {website}: {str(e)}")
+    def _switch_to_bloom(self) -> None:
+        logging.info(f"Deduplication set reached {len(self.exact)} domains, switching to Bloom filter")
+        self.bloom = BloomFilter(self.bloom_capacity, self.bloom_error_rate)
+        for domain in self.exact:
+            self.bloom.add(domain)
+        self.exact = None
+
+    def seen(self, domain: str) -> bool:
+        """Record a domain and return True if it was already seen in this run.
+
+        Domains are held in an exact set until `max_exact` is reached, after
+        which they are moved into a Bloom filter. From then on a small,
+        configurable fraction of new domains may be reported as seen, but
+        memory stays bounded.
+
+        Args:
+            domain (str): The clean domain, as returned by `clean_domain`.
+
+        Returns:
+            bool: True if the domain was seen before.
+        """
+        if self.bloom is None:
+            if domain in self.exact:
+                return True
+            self.exact.add(domain)
+            if len(self.exact) >= self.max_exact:
+                self._switch_to_bloom()
+            return False
+        if domain in self.bloom:
+            return True
+        self.bloom.add(domain)
+        return False
+
+    def filter(self, websites: Iterator[str]) -> Iterator[str]:
+        """Yield only websites whose clean domain has not been handled yet.
+
+        Websites are canonicalized with `clean_domain`, so variants such as
+        `www.x.com`, `https://x.com/path` and `X.COM` count as one domain.
+        Domains reported as completed by `is_done` are skipped as well.
+
+        Args:
+            websites (Iterator[str]): An iterator of website URLs, consumed lazily.
+
+        Yields:
+            str: The first website seen for each domain still to be processed.
+        """
+        for website in websites:
+            domain, _ = clean_domain(str(website))
+            if self.seen(domain):
+                self.duplicates += 1
+                continue
+            if self.is_done is not None and self.is_done(domain):
+                self.already_done += 1
+                continue
+            self.unique += 1
+            yield website
+        logging.info(
+            f"Deduplication: {self.unique} domains queued, {self.duplicates} duplicates "
+            f"and {self.already_done} already processed domains skipped"
+        )
+
+class ProgressJournal:
+    CODES = {('fetch', True): 'F', ('fetch', False): 'f', ('upload', True): 'U', ('upload', False): 'u'}
+
+    def __init__(self, path: str, resume: bool = False, fsync_interval: Optional[float] = None):
+        self.path = path
+        self.fsync_interval = fsync_interval or CONFIG['JOURNAL']['FSYNC_INTERVAL']
+        self.completed = array('q')
+        self.failed = set()
+        if resume and os.path.exists(path):
+            self._load()
+        self._file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        self._buffer: List[str] = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically, name='journal-flusher', daemon=True)
+        self._flusher.start()
+
+    def _load(self) -> None:
+        """Read an existing journal to find completed and failed domains.
+
+        A domain is completed once its upload succeeded, or with
+        `--no-upload` once every sink has written its record. Completed domains
+        are kept as a sorted array of 64-bit hashes, so tens of millions of
+        entries take a few hundred MB at most and can be looked up with a
+        binary search. A trailing line without a newline, left by a crash
+        during a write, is ignored.
+        """
+        start = time.time()
+        completed = []
+        failed = set()
+        with open(self.path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if len(line) < 3 or line[-1] != '\n':
+                    continue
+                code, domain = line[0], line[2:-1]
+                if code == 'U':
+                    completed.append(hash(domain))
+                    failed.discard(domain)
+                elif code in 'fu':
+                    failed.add(domain)
+        self.completed = array('q', sorted(set(completed)))
+        self.failed = {domain for domain in failed if not self.is_completed(domain)}
+        logging.info(
+            f"Loaded progress journal {self.path} in {time.time() - start:.2f} seconds: "
+            f"{len(self.completed)} completed and {len(self.failed)} failed domains"
+        )
+
+    def is_completed(self, domain: str) -> bool:
+        """Return True if the journal recorded the domain as uploaded, or as written to the sinks."""
+        h = hash(domain)
+        i = bisect.bisect_left(self.completed, h)
+        return i < len(self.completed) and self.completed[i] == h
+
+    def record(self, domain: str, stage: str, ok: bool) -> None:
+        """Append the outcome of a stage for a domain to the journal.
+
+        Entries are buffered and written with a single fsync every
+        `fsync_interval` seconds, so at most that much progress is lost if
+        the process dies.
+
+        Args:
+            domain (str): The clean domain.
+            stage (str): 'fetch' or 'upload'.
+            ok (bool): Whether the stage succeeded.
+        """
+        line = f"{self.CODES[(stage, ok)]} {domain.replace(chr(10), ' ')}\n"
+        with self._lock:
+            self._buffer.append(line)
+
+    def flush(self) -> None:
+        """Write buffered entries to disk and fsync the journal.
+
+        Only swapping the buffer holds the lock taken by `record`, so
+        workers keep journaling while the fsync runs. The write lock keeps
+        concurrent flushes, and with them the entries, in order.
+        """
+        with self._write_lock:
+            with self._lock:
+                lines, self._buffer = self._buffer, []
+            if lines:
+                self._file.writelines(lines)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def _flush_periodically(self) -> None:
+        while not self._stop.wait(self.fsync_interval):
+            self.flush()
+
+    def close(self) -> None:
+        """Flush outstanding entries and close the journal file."""
+        self._stop.set()
+        self._flusher.join()
+        self.flush()
+        self._file.close()
+
+def merge_journals(paths: List[str], target: str) -> None:
+    """Concatenate progress journals into `target`, replacing it atomically.
+
+    Missing files are skipped, and so is a trailing line without a newline
+    left by a crash, so that it cannot run into the next journal's first line.
+    """
+    tmp_path = f'{target}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as out:
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                out.writelines(line for line in f if line.endswith('\n'))
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_path, target)
+
+class DeadLetterFile:
+    def __init__(self, path: str):
+        self.path = path
+        self.count = 0
+        self._tmp_path = f'{path}.tmp'
+        self._file = open(self._tmp_path, 'w', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def write(self, website: str, domain: str, stage: str, failure: str, error: str) -> None:
+        """Append a domain that failed for good to the file as one JSON line.
+
+        The website comes first, so the file can be read back as NDJSON
+        input without naming a column.
+
+        Args:
+            website (str): The website as read from the input, or the record's domain for uploads.
+            domain (str): The clean domain.
+            stage (str): 'fetch' or 'upload'.
+            failure (str): The failure class of the last attempt.
+            error (str): A short description of the last error.
+        """
+        line = json.dumps({
+            'website': website,
+            'domain': domain,
+            'stage': stage,
+            'failure': failure,
+            'error': error,
+            'time': datetime.now().isoformat(timespec='seconds')
+        })
+        with self._lock:
+            self._file.write(line + '\n')
+            self.count += 1
+
+    def close(self) -> None:
+        """Write the file out and move it to `path`, replacing the previous run's dead letters.
+
+        Entries go to a temporary file until then, so a retry run can read
+        the previous file as its input while it writes its own.
+        """
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+_dead_letters = None
+_dead_letters_lock = threading.Lock()
+
+def get_dead_letters() -> Optional[DeadLetterFile]:
+    """Return the process-wide dead-letter file, or None if `CONFIG['DEAD_LETTER']['PATH']` is unset."""
+    global _dead_letters
+    if not CONFIG['DEAD_LETTER']['PATH']:
+        return None
+    if _dead_letters is None:
+        with _dead_letters_lock:
+            if _dead_letters is None:
+                _dead_letters = DeadLetterFile(CONFIG['DEAD_LETTER']['PATH'])
+    return _dead_letters
+
+def close_dead_letters() -> None:
+    """Close the process-wide dead-letter file if it was opened."""
+    global _dead_letters
+    with _dead_letters_lock:
+        if _dead_letters is not None:
+            _dead_letters.close()
+            logging.info(f"Wrote {_dead_letters.count} failed domains to {_dead_letters.path}")
+            _dead_letters = None
+
+def record_dead_letter(report: Optional[Report], website: str, domain: str, stage: str,
+                       failure: Optional[str], error: str) -> None:
+    """Write a failed domain to the dead-letter file if its failure class is worth a retry run.
+
+    Only classes listed in `CONFIG['DEAD_LETTER']['FAILURE_CLASSES']` are
+    written; by default these are the transient ones, not 4xx responses.
+    """
+    if failure not in CONFIG['DEAD_LETTER']['FAILURE_CLASSES']:
+        return
+    dead_letters = get_dead_letters()
+    if dead_letters is None:
+        return
+    dead_letters.write(website, domain, stage, failure, error)
+    if report:
+        report.record_dead_letter()
+
+class CacheEntry:
+    def __init__(self, body: str, fetched_at: float, negative: bool, fresh: bool):
+        self.body = body
+        self.fetched_at = fetched_at
+        self.negative = negative
+        self.fresh = fresh
+
+class ResponseCache:
+    def __init__(self, path: str, ttl: float, negative_ttl: float, max_entries: int,
+                 serve_stale: bool = True):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.serve_stale = serve_stale
+        self._lock = threading.Lock()
+        self._writes = 0
+        # Shard workers share the file, so wait for their writes instead of failing after sqlite's 5s default
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "domain TEXT PRIMARY KEY, body TEXT NOT NULL, fetched_at REAL NOT NULL, negative INTEGER NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_fetched_at ON responses (fetched_at)")
+
+    def get(self, domain: str) -> Optional[CacheEntry]:
+        """Look up the cached API response for a domain.
+
+        Entries older than their TTL are still returned, marked as not fresh,
+        so that callers can fall back to them when the upstream API fails.
+        Negative entries (empty or invalid responses) use the shorter
+        negative TTL.
+
+        Args:
+            domain (str): The clean domain, as returned by `clean_domain`.
+
+        Returns:
+            Optional[CacheEntry]: The cached entry, or None if the domain is
+            not cached or the cache could not be read.
+        """
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT body, fetched_at, negative FROM responses WHERE domain = ?", (domain,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logging.error(f"Error reading response cache for {domain}: {str(e)}")
+            return None
+        if row is None:
+            return None
+        body, fetched_at, negative = row
+        ttl = self.negative_ttl if negative else self.ttl
+        return CacheEntry(body, fetched_at, bool(negative), time.time() - fetched_at < ttl)
+
+    def put(self, domain: str, body: str, negative: bool = False) -> None:
+        """Store the API response body for a domain, replacing any earlier entry.
+
+        Every 1000 writes the oldest entries beyond `max_entries` are evicted.
+        A failed write is logged and otherwise ignored, so the response it
+        belongs to is still processed.
+
+        Args:
+            domain (str): The clean domain, as returned by `clean_domain`.
+            body (str): The raw response body.
+            negative (bool): True if the response was empty or invalid.
+        """
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses (domain, body, fetched_at, negative) VALUES (?, ?, ?, ?)",
+                    (domain, body, time.time(), int(negative))
+                )
+                self._writes += 1
+                if self._writes % 1000 == 0:
+                    self._evict()
+        except sqlite3.Error as e:
+            logging.error(f"Error writing response cache for {domain}: {str(e)}")
+
+    def _evict(self) -> None:
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM responses WHERE domain IN "
+                "(SELECT domain FROM responses ORDER BY fetched_at LIMIT ?)",
+                (count - self.max_entries,)
+            )
+            logging.info(f"Evicted {count - self.max_entries} entries from response cache")
+
+    def close(self) -> None:
+        """Close the underlying SQLite connection."""
+        with self._lock:
+            self._conn.close()
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """Return the process-wide response cache, or None if caching is disabled."""
+    global _response_cache
+    settings = CONFIG['CACHE']
+    if not settings['ENABLED']:
+        return None
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                _response_cache = ResponseCache(
+                    settings['PATH'], settings['TTL'], settings['NEGATIVE_TTL'],
+                    settings['MAX_ENTRIES'], settings['SERVE_STALE']
+                )
+    return _response_cache
+
+def record_digest(record: Dict[str, Any]) -> str:
+    """Return a hash of a mapped record that changes whenever any of its fields does."""
+    text = json.dumps(record, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+class ImportState:
+    def __init__(self, path: str, max_age: float, flush_interval: Optional[float] = None):
+        self.path = path
+        self.max_age = max_age
+        self.flush_interval = flush_interval or CONFIG['INCREMENTAL']['FLUSH_INTERVAL']
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._pending: List[tuple] = []
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS domains ("
+            "domain TEXT PRIMARY KEY, fetched_at REAL, uploaded_digest TEXT, uploaded_at REAL)"
+        )
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically, name='state-flusher', daemon=True)
+        self._flusher.start()
+
+    def select_due(self, websites: Iterator[str], report: Optional[Report] = None) -> Iterator[str]:
+        """Yield the websites whose domain is due for a fetch, oldest first.
+
+        A domain's fetch time is only stored once its record reached the
+        server or was found unchanged, so domains whose fetch or upload
+        failed stay due. Domains without a stored time are yielded as they
+        are read. Domains last fetched more than `max_age` seconds ago are
+        set aside in a temporary table and yielded once the input is
+        exhausted, in order of their last fetch, so memory stays bounded
+        however many there are. Domains fetched more recently are skipped
+        and counted in the report.
+
+        Args:
+            websites (Iterator[str]): An iterator of website URLs, consumed lazily.
+            report (Optional[Report]): The report counting skipped domains.
+
+        Yields:
+            str: The websites to fetch.
+        """
+        cutoff = time.time() - self.max_age
+        # A connection of its own, as this generator runs in the pipeline's reader thread
+        conn = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+        new = stale = fresh = 0
+        try:
+            conn.execute("CREATE TEMP TABLE due (website TEXT NOT NULL, fetched_at REAL NOT NULL)")
+            batch = []
+            for website in websites:
+                row = conn.execute(
+                    "SELECT fetched_at FROM domains WHERE domain = ?", (clean_domain(str(website))[0],)
+                ).fetchone()
+                if row is None or row[0] is None:
+                    new += 1
+                    yield website
+                elif row[0] < cutoff:
+                    stale += 1
+                    batch.append((str(website), row[0]))
+                    if len(batch) >= 10000:
+                        conn.executemany("INSERT INTO due VALUES (?, ?)", batch)
+                        batch = []
+                else:
+                    fresh += 1
+                    if report:
+                        report.record_incremental('fresh')
+            conn.executemany("INSERT INTO due VALUES (?, ?)", batch)
+            logging.info(f"Incremental: {new} new and {stale} stale domains queued, {fresh} fresh domains skipped")
+            for (website,) in conn.execute("SELECT website FROM due ORDER BY fetched_at"):
+                yield website
+        finally:
+            conn.close()
+
+    def record_fetch(self, domain: str) -> None:
+        """Store the current time as the last fetch of a domain that needs no upload."""
+        with self._lock:
+            self._pending.append((domain, time.time(), None, None))
+
+    def record_upload(self, record: Dict[str, Any], fetched: bool = True) -> None:
+        """Store the hash of a record the server accepted as the last uploaded version of its domain.
+
+        Args:
+            record (Dict[str, Any]): The accepted record.
+            fetched (bool): Whether the record was just fetched, so the
+                current time also becomes the domain's last fetch; False
+                for records replayed from a sink.
+        """
+        now = time.time()
+        entry = (record.get('domain'), now if fetched else None, record_digest(record), now)
+        with self._lock:
+            self._pending.append(entry)
+
+    def is_unchanged(self, record: Dict[str, Any]) -> bool:
+        """Return True if a mapped record equals the version last uploaded for its domain."""
+        with self._write_lock:
+            row = self._conn.execute(
+                "SELECT uploaded_digest FROM domains WHERE domain = ?", (record.get('domain'),)
+            ).fetchone()
+        return row is not None and row[0] == record_digest(record)
+
+    def flush(self) -> None:
+        """Write the buffered fetch and upload entries in one transaction.
+
+        Callers only append to a buffer, so neither upload workers nor the
+        event loop wait for SQLite. A column left as None keeps its stored
+        value.
+        """
+        with self._write_lock:
+            with self._lock:
+                entries, self._pending = self._pending, []
+            if not entries:
+                return
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.executemany(
+                    "INSERT INTO domains (domain, fetched_at, uploaded_digest, uploaded_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (domain) DO UPDATE SET "
+                    "fetched_at = coalesce(excluded.fetched_at, fetched_at), "
+                    "uploaded_digest = coalesce(excluded.uploaded_digest, uploaded_digest), "
+                    "uploaded_at = coalesce(excluded.uploaded_at, uploaded_at)",
+                    entries
+                )
+
+    def _flush_periodically(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logging.error(f"Error writing incremental state: {str(e)}")
+
+    def close(self) -> None:
+        """Write outstanding entries and close the underlying SQLite connection."""
+        self._stop.set()
+        self._flusher.join()
+        self.flush()
+        with self._write_lock:
+            self._conn.close()
+
+_import_state = None
+_import_state_lock = threading.Lock()
+
+def get_import_state() -> Optional[ImportState]:
+    """Return the process-wide incremental state, or None if the incremental mode is off."""
+    global _import_state
+    settings = CONFIG['INCREMENTAL']
+    if not settings['ENABLED']:
+        return None
+    if _import_state is None:
+        with _import_state_lock:
+            if _import_state is None:
+                _import_state = ImportState(settings['PATH'], settings['MAX_AGE'], settings['FLUSH_INTERVAL'])
+    return _import_state
+
+def close_import_state() -> None:
+    """Close the process-wide incremental state if it was opened."""
+    global _import_state
+    with _import_state_lock:
+        if _import_state is not None:
+            _import_state.close()
+            _import_state = None
+
+class TokenBucket:
+    STATE = struct.Struct('<ddddd')  # tokens, updated, rate, blocked_until, last_decrease
+
+    def __init__(self, name: str, rate: float, burst: float, min_rate: Optional[float] = None,
+                 max_rate: Optional[float] = None, state_path: Optional[str] = None):
+        self.name = name
+        self.burst = burst
+        self.max_rate = max_rate or rate
+        self.min_rate = min(min_rate or self.max_rate / 10, self.max_rate)
+        self.state_path = state_path
+        self._state = (float(burst), time.time(), float(rate), 0.0, 0.0)
+        self._lock = threading.Lock()
+        self._fd = None
+        self._flock = None
+        if state_path:
+            try:
+                import fcntl
+            except ImportError:
+                logging.warning(f"File locking is not available, rate limiter '{name}' is not shared between processes")
+            else:
+                self._flock = fcntl
+                self._fd = os.open(state_path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def _update(self, func: Callable[[float, List[float]], Any]) -> Any:
+        """Apply `func` to the bucket state while holding the thread and file locks.
+
+        `func` receives the current time and the state as a mutable list and
+        returns the result of the update. With a state file the state is
+        read from and written back to the file, so every process using the
+        same file draws from the same bucket.
+        """
+        with self._lock:
+            if self._fd is not None:
+                self._flock.flock(self._fd, self._flock.LOCK_EX)
+            try:
+                state = list(self._state)
+                if self._fd is not None:
+                    data = os.pread(self._fd, self.STATE.size, 0)
+                    if len(data) == self.STATE.size:
+                        state = list(self.STATE.unpack(data))
+                now = time.time()
+                state[2] = min(max(state[2], self.min_rate), self.max_rate)
+                # Refill for the time since the last update, but not while blocked by a Retry-After
+                elapsed = now - max(state[1], state[3])
+                if elapsed > 0:
+                    state[0] = min(self.burst, state[0] + elapsed * state[2])
+                state[1] = now
+                result = func(now, state)
+                self._state = tuple(state)
+                if self._fd is not None:
+                    os.pwrite(self._fd, self.STATE.pack(*state), 0)
+                return result
+            finally:
+                if self._fd is not None:
+                    self._flock.flock(self._fd, self._flock.LOCK_UN)
+
+    @property
+    def rate(self) -> float:
+        """Return the current rate of the bucket in calls per second."""
+        return self._update(lambda now, state: state[2])
+
+    def _reserve(self, now: float, state: List[float]) -> float:
+        # Take a token even if the bucket is empty; the caller waits until it
+        # has been refilled, so concurrent callers are spread out at the rate.
+        state[0] -= 1
+        return max(state[3] - now, 0) + max(-state[0], 0) / state[2]
+
+    def _blocked_for(self, now: float, state: List[float]) -> float:
+        return max(state[3] - now, 0)
+
+    def acquire(self) -> float:
+        """Block until a call is allowed and return the seconds waited."""
+        waited = 0.0
+        wait = self._update(self._reserve)
+        while wait > 0:
+            time.sleep(wait)
+            waited += wait
+            # A Retry-After received while waiting pushes the call back further
+            wait = self._update(self._blocked_for)
+        return waited
+
+    async def acquire_async(self) -> float:
+        """Wait on the event loop until a call is allowed and return the seconds waited."""
+        waited = 0.0
+        wait = self._update(self._reserve)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            waited += wait
+            wait = self._update(self._blocked_for)
+        return waited
+
+    def on_response(self, status: Optional[int], latency: float, retry_after: Optional[float] = None) -> None:
+        """Adapt the rate to the outcome of a call.
+
+        The rate is adjusted additively-increase/multiplicatively-decrease:
+        429 and 5xx responses and transport errors (`status` None) multiply
+        it by `DECREASE`, at most once per `DECREASE_INTERVAL`, and responses
+        slower than `LATENCY_TARGET` reduce it by a tenth. Every other
+        response adds `INCREASE / rate`, so the rate grows by about
+        `INCREASE` per second of successful traffic, up to `max_rate`. A
+        Retry-After stops the bucket from handing out tokens until it has
+        passed.
+
+        Args:
+            status (Optional[int]): The HTTP status, or None if the request failed.
+            latency (float): How long the request took in seconds.
+            retry_after (Optional[float]): Seconds the server asked us to wait.
+        """
+        settings = CONFIG['RATE_LIMIT']
+
+        def adapt(now: float, state: List[float]) -> None:
+            if retry_after:
+                state[3] = max(state[3], now + min(retry_after, settings['MAX_RETRY_AFTER']))
+                state[0] = min(state[0], 0)
+            if status is None or status == 429 or status >= 500:
+                if now - state[4] >= settings['DECREASE_INTERVAL']:
+                    state[2] = max(self.min_rate, state[2] * settings['DECREASE'])
+                    state[4] = now
+            elif latency > settings['LATENCY_TARGET']:
+                state[2] = max(self.min_rate, state[2] * 0.9)
+            else:
+                state[2] = min(self.max_rate, state[2] + settings['INCREASE'] / state[2])
+
+        self._update(adapt)
+
+    def close(self) -> None:
+        """Close the state file."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+_rate_limiters: Dict[str, TokenBucket] = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(name: str) -> TokenBucket:
+    """Return the process-wide token bucket for 'api' or 'server', creating it on first use.
+
+    When `CONFIG['RATE_LIMIT']['STATE_DIR']` is set the bucket keeps its
+    state in `<STATE_DIR>/<name>.bucket`, which importer processes on the
+    same host share, so together they stay within the configured rate.
+    """
+    with _rate_limiters_lock:
+        bucket = _rate_limiters.get(name)
+        if bucket is None:
+            settings = CONFIG['RATE_LIMIT']
+            limits = settings[name.upper()]
+            state_path = None
+            if settings['STATE_DIR']:
+                os.makedirs(settings['STATE_DIR'], exist_ok=True)
+                state_path = os.path.join(settings['STATE_DIR'], f'{name}.bucket')
+            bucket = _rate_limiters[name] = TokenBucket(
+                name, limits['RATE'], limits['BURST'], limits['MIN_RATE'], limits['MAX_RATE'], state_path
+            )
+        return bucket
+
+def parse_retry_after(headers: Dict[str, str]) -> Optional[float]:
+    """Return the delay requested by a Retry-After header in seconds, or None.
+
+    The header may hold a number of seconds or an HTTP date.
+    """
+    value = next((v for k, v in headers.items() if k.lower() == 'retry-after'), None)
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+FAILURE_CLASSES = ('timeout', 'connection', 'throttled', 'server_error', 'client_error', 'payload', 'circuit_open')
+
+def is_timeout(error: BaseException) -> bool:
+    """Return True if a transport error was caused by a timeout."""
+    cause = error.__cause__
+    if isinstance(cause, (TimeoutError, asyncio.TimeoutError)):
+        return True
+    if isinstance(cause, subprocess.CalledProcessError):
+        return cause.returncode == 28  # curl: operation timed out
+    return 'Timeout' in type(cause).__name__  # httpx.TimeoutException and its subclasses
+
+def classify_failure(response: Optional[HTTPResponse] = None, error: Optional[BaseException] = None,
+                     validate: Optional[Callable[[HTTPResponse], bool]] = None) -> Optional[str]:
+    """Return the failure class of a request's outcome, or None if it succeeded.
+
+    Args:
+        response (Optional[HTTPResponse]): The response, if one was received.
+        error (Optional[BaseException]): The transport error, if the request failed.
+        validate (Optional[Callable[[HTTPResponse], bool]]): Checks the body of a
+            2xx/3xx response; a body it rejects is a 'payload' failure.
+
+    Returns:
+        Optional[str]: One of `FAILURE_CLASSES`, or None.
+    """
+    if error is not None:
+        if isinstance(error, CircuitOpenError):
+            return 'circuit_open'
+        return 'timeout' if is_timeout(error) else 'connection'
+    status = response.status
+    if status == 0:
+        return 'connection'  # curl received no status line
+    if status == 408:
+        return 'timeout'
+    if status == 429:
+        return 'throttled'
+    if status >= 500:
+        return 'server_error'
+    if status >= 400:
+        return 'client_error'
+    if validate is not None and not validate(response):
+        return 'payload'
+    return None
+
+def retry_delay(failure: str, attempt: int) -> Optional[float]:
+    """Return the seconds to wait before retrying after the `attempt`-th failure of a class.
+
+    Each failure class has its own budget of `TRIES` attempts in
+    `CONFIG['RETRY']`. The delay bound doubles from `BASE_DELAY` with every
+    attempt up to `MAX_DELAY`, and the delay is drawn uniformly below it
+    (full jitter), so workers that failed together do not retry together.
+
+    Returns:
+        Optional[float]: The delay, or None once the budget is spent or the
+        class is not retried at all.
+    """
+    policy = CONFIG['RETRY'].get(failure.upper())
+    if policy is None or attempt >= (policy['TRIES'] or CONFIG['MAX_RETRIES']):
+        return None
+    return random.uniform(0, min(policy['MAX_DELAY'], policy['BASE_DELAY'] * 2 ** (attempt - 1)))
+
+class CircuitBreaker:
+    TRIP_FAILURES = frozenset(('timeout', 'connection', 'server_error'))
+    STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float, max_reset_timeout: float,
+                 half_open_requests: int = 1, max_open_time: Optional[float] = None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max(max_reset_timeout, reset_timeout)
+        self.half_open_requests = half_open_requests
+        self.max_open_time = max_open_time
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.retry_at = 0.0
+        self.probes = 0
+        self._pause = reset_timeout
+        self._lock = threading.Lock()
+
+    def _admit(self) -> tuple[float, bool]:
+        """Return how long the caller must wait and whether it may send a probe request.
+
+        Raises:
+            CircuitOpenError: If the circuit has been open for longer than
+            `max_open_time` and no probe slot is free.
+        """
+        with self._lock:
+            if self.state == 'closed':
+                return 0.0, False
+            now = time.monotonic()
+            if self.state == 'open' and now >= self.retry_at:
+                self.state = 'half_open'
+                logging.info(f"Circuit for {self.name} is half-open, letting a probe request through")
+            if self.state == 'half_open' and self.probes < self.half_open_requests:
+                self.probes += 1
+                return 0.0, True
+            if self.max_open_time is not None and now - self.opened_at >= self.max_open_time:
+                raise CircuitOpenError(f"Circuit for {self.name} has been open for {now - self.opened_at:.0f} seconds")
+            if self.state == 'open':
+                return self.retry_at - now, False
+            # Half-open with all probe slots taken: check back shortly for the probe's outcome
+            return min(self.reset_timeout, 1.0), False
+
+    def acquire(self) -> bool:
+        """Block while the circuit is open and return whether the call is a probe.
+
+        The result must be passed to `on_result`, or to `release` if the
+        call ends without an outcome.
+
+        Raises:
+            CircuitOpenError: If the circuit stays open for longer than `max_open_time`.
+        """
+        while True:
+            wait, probe = self._admit()
+            if wait <= 0:
+                return probe
+            time.sleep(wait)
+
+    async def acquire_async(self) -> bool:
+        """Wait on the event loop while the circuit is open and return whether the call is a probe."""
+        while True:
+            wait, probe = self._admit()
+            if wait <= 0:
+                return probe
+            await asyncio.sleep(wait)
+
+    def on_result(self, failure: Optional[str], probe: bool = False) -> None:
+        """Record the outcome of a call admitted by `acquire`.
+
+        Timeouts, connection errors and 5xx responses count against the
+        host; any other outcome, a 4xx included, shows that it is up.
+        `failure_threshold` consecutive failures open the circuit and pause
+        all callers for `reset_timeout` seconds. After the pause a probe
+        request is let through: if it succeeds the circuit closes, if it
+        fails the pause doubles, up to `max_reset_timeout`.
+
+        Args:
+            failure (Optional[str]): The failure class of the call, or None if it succeeded.
+            probe (bool): The value returned by `acquire` for the call.
+        """
+        failed = failure in self.TRIP_FAILURES
+        with self._lock:
+            now = time.monotonic()
+            if probe:
+                self.probes -= 1
+            if self.state == 'closed':
+                self.failures = self.failures + 1 if failed else 0
+                if self.failures >= self.failure_threshold:
+                    self.state = 'open'
+                    self.opened_at = now
+                    self._pause = self.reset_timeout
+                    self.retry_at = now + self._pause
+                    logging.warning(
+                        f"Circuit for {self.name} opened after {self.failures} consecutive failures, "
+                        f"pausing requests for {self._pause:g} seconds"
+                    )
+            elif probe and self.state == 'half_open':
+                if failed:
+                    self.state = 'open'
+                    self._pause = min(self._pause * 2, self.max_reset_timeout)
+                    self.retry_at = now + self._pause
+                    logging.warning(f"Probe request to {self.name} failed, pausing requests for {self._pause:g} seconds")
+                else:
+                    self.state = 'closed'
+                    self.failures = 0
+                    logging.warning(f"Circuit for {self.name} closed after {now - self.opened_at:.0f} seconds")
+
+    def release(self, probe: bool) -> None:
+        """Free the probe slot of a call that ended without an outcome, e.g. because it was cancelled."""
+        if probe:
+            with self._lock:
+                self.probes -= 1
+
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+_circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(url: str) -> CircuitBreaker:
+    """Return the process-wide circuit breaker for the host of a URL, creating it on first use."""
+    host = urlparse(url).netloc
+    with _circuit_breakers_lock:
+        breaker = _circuit_breakers.get(host)
+        if breaker is None:
+            settings = CONFIG['CIRCUIT_BREAKER']
+            breaker = _circuit_breakers[host] = CircuitBreaker(
+                host, settings['FAILURE_THRESHOLD'], settings['RESET_TIMEOUT'], settings['MAX_RESET_TIMEOUT'],
+                settings['HALF_OPEN_REQUESTS'], settings['MAX_OPEN_TIME']
+            )
+        return breaker
+
+# Pipeline stage whose latency histogram receives the requests made within each rate limiter
+REQUEST_STAGES = {'api': 'fetch', 'server': 'upload'}
+
+def record_attempt(bucket: TokenBucket, breaker: CircuitBreaker, probe: bool, response: Optional[HTTPResponse],
+                   error: Optional[TransportError], latency: float,
+                   validate: Optional[Callable[[HTTPResponse], bool]] = None,
+                   report: Optional[Report] = None) -> Optional[str]:
+    """Feed the outcome of one attempt to the rate limiter, circuit breaker and report.
+
+    The attempt's duration, without rate limiter and circuit breaker waits
+    or retry delays, is recorded as the latency of the stage the bucket
+    serves (see `REQUEST_STAGES`).
+
+    Returns:
+        Optional[str]: The failure class of the attempt, or None if it succeeded.
+    """
+    if report:
+        report.record_latency(REQUEST_STAGES.get(bucket.name, bucket.name), latency)
+    if error is not None:
+        bucket.on_response(None, latency)
+    else:
+        bucket.on_response(response.status, latency, parse_retry_after(response.headers))
+    failure = classify_failure(response, error, validate)
+    breaker.on_result(failure, probe)
+    if failure and report:
+        report.record_failure(bucket.name, failure)
+        if failure == 'throttled':
+            report.record_throttled(bucket.name)
+    return failure
+
+def limited_request(bucket: TokenBucket, method: str, url: str, headers: Optional[Dict[str, str]] = None,
+                    body: Optional[str] = None, report: Optional[Report] = None,
+                    validate: Optional[Callable[[HTTPResponse], bool]] = None) -> HTTPResponse:
+    """Send a request through the shared HTTP transport within a rate limit and circuit breaker.
+
+    Every attempt first waits while the circuit breaker of the target host
+    is open, then takes a token from `bucket`. Its outcome adapts the
+    bucket's rate and is recorded by the circuit breaker. Failed attempts
+    are classified by `classify_failure` and retried after `retry_delay`
+    until the budget of their class is spent; then the last response is
+    returned, or the last transport error raised. The number of retries
+    goes to the report's retry histogram.
+
+    Args:
+        bucket (TokenBucket): The rate limiter of the target service.
+        method (str): The HTTP method.
+        url (str): The request URL.
+        headers (Optional[Dict[str, str]]): Request headers.
+        body (Optional[str]): The request body.
+        report (Optional[Report]): Receives rate limiter waits, failed attempts and retries.
+        validate (Optional[Callable[[HTTPResponse], bool]]): Checks the body of a
+            successful response; rejected bodies are retried as 'payload' failures.
+
+    Returns:
+        HTTPResponse: The response of the last attempt.
+
+    Raises:
+        TransportError: If the last attempt failed in the transport.
+        CircuitOpenError: If the host's circuit stayed open for longer than `MAX_OPEN_TIME`.
+    """
+    breaker = get_circuit_breaker(url)
+    attempts = defaultdict(int)
+    while True:
+        probe = breaker.acquire()
+        try:
+            waited = bucket.acquire()
+            if report:
+                report.record_rate_limit_wait(waited, bucket.name)
+            started = time.perf_counter()
+            try:
+                response, error = get_http_client().request(method, url, headers=headers, body=body), None
+            except TransportError as e:
+                response, error = None, e
+        except BaseException:
+            breaker.release(probe)
+            raise
+        failure = record_attempt(bucket, breaker, probe, response, error, time.perf_counter() - started,
+                                 validate, report)
+        if failure is None:
+            if report:
+                report.record_retries(sum(attempts.values()))
+            return response
+        attempts[failure] += 1
+        delay = retry_delay(failure, attempts[failure])
+        if delay is None:
+            if report:
+                report.record_retries(sum(attempts.values()) - 1)
+            if error is not None:
+                raise error
+            return response
+        logging.debug("Retrying %s %s in %.2f seconds after %s (attempt %d)", method, url, delay, failure, attempts[failure])
+        time.sleep(delay)
+
+async def limited_request_async(bucket: TokenBucket, client, method: str, url: str,
+                                headers: Optional[Dict[str, str]] = None, body: Optional[str] = None,
+                                report: Optional[Report] = None,
+                                validate: Optional[Callable[[HTTPResponse], bool]] = None) -> HTTPResponse:
+    """Send a request through an async transport within a rate limit and circuit breaker.
+
+    This is the asyncio counterpart of `limited_request`.
+    """
+    breaker = get_circuit_breaker(url)
+    attempts = defaultdict(int)
+    while True:
+        probe = await breaker.acquire_async()
+        try:
+            waited = await bucket.acquire_async()
+            if report:
+                report.record_rate_limit_wait(waited, bucket.name)
+            started = time.perf_counter()
+            try:
+                response, error = await client.request(method, url, headers=headers, body=body), None
+            except TransportError as e:
+                response, error = None, e
+        except BaseException:
+            breaker.release(probe)
+            raise
+        failure = record_attempt(bucket, breaker, probe, response, error, time.perf_counter() - started,
+                                 validate, report)
+        if failure is None:
+            if report:
+                report.record_retries(sum(attempts.values()))
+            return response
+        attempts[failure] += 1
+        delay = retry_delay(failure, attempts[failure])
+        if delay is None:
+            if report:
+                report.record_retries(sum(attempts.values()) - 1)
+            if error is not None:
+                raise error
+            return response
+        logging.debug("Retrying %s %s in %.2f seconds after %s (attempt %d)", method, url, delay, failure, attempts[failure])
+        await asyncio.sleep(delay)
+
+def build_api_payload(clean_website: str) -> str:
+    """Return the JSON request body asking agent.ai for a company report."""
+    return json.dumps({
+        "domain": clean_website,
+        "report_component": "harmonic_funding_and_web_traffic",
+        "user_id": None
+    })
+
+def handle_api_response(website: str, clean_website: str, full_url: str,
+                        response: HTTPResponse, report: Report) -> Optional[Dict[str, Any]]:
+    """Validate an agent.ai API response and enrich it with URL information.
+
+    This function checks the HTTP status and body of the response, parses the
+    JSON payload and verifies that it is a dictionary. Valid responses are
+    enriched with the original URL, the clean domain and the full URL. The
+    outcome is recorded in the provided report in every case.
+
+    Args:
+        website (str): The website URL as it was read from the input.
+        clean_website (str): The cleaned domain of the website.
+        full_url (str): The website URL including its scheme.
+        response (HTTPResponse): The response returned by the transport.
+        report (Report): An object used to log the success or failure of the API call.
+
+    Returns:
+        Optional[Dict[str, Any]]: The enriched response data if it is valid,
+        or None otherwise.
+    """
+    try:
+        # Log raw response for debugging; the body is only formatted if DEBUG is enabled
+        logging.debug("Raw API response for %s: %s", website, response.body)
+        
+        if not response.ok:
+            logging.error("HTTP %s from API for %s", response.status, website,
+                          extra={'domain': clean_website, 'stage': 'fetch', 'status': response.status})
+            report.update(success=False, domain=clean_website)
+            return None
+        
+        if not response.body.strip():
+            logging.error("Empty response for %s", website, extra={'domain': clean_website, 'stage': 'fetch'})
+            report.update(success=False, domain=clean_website)
+            return None
+        
+        try:
+            response_data = loads_json(response.body)
+        except json.JSONDecodeError as e:
+            logging.error("Failed to parse JSON for %s: %s", website, e, extra={'domain': clean_website, 'stage': 'fetch'})
+            report.update(success=False, domain=clean_website)
+            return None
+        
+        # Verify response is a dictionary
+        if not isinstance(response_data, dict):
+            logging.error("Invalid response type for %s: %s", website, type(response_data),
+                          extra={'domain': clean_website, 'stage': 'fetch'})
             report.update(success=False, domain=clean_website)
             return None
+        
+        # Add URL information
+        response_data['original_url'] = website
+        response_data['clean_domain'] = clean_website
+        response_data['full_url'] = full_url
+        
+        log_success("Successfully processed %s", website, domain=clean_website, stage='fetch')
+        report.update(success=True, domain=clean_website)
+        return response_data
+        
+    except Exception as e:
+        logging.error("Error processing response for %s: %s", website, e, extra={'domain': clean_website, 'stage': 'fetch'})
+        report.update(success=False, domain=clean_website)
+        return None
+
+def handle_cached_response(website: str, clean_website: str, full_url: str,
+                           entry: CacheEntry, report: Report) -> Optional[Dict[str, Any]]:
+    """Process a cached API response as if it had just been fetched.
+
+    Args:
+        website (str): The website URL as it was read from the input.
+        clean_website (str): The cleaned domain of the website.
+        full_url (str): The website URL including its scheme.
+        entry (CacheEntry): The cached response.
+        report (Report): An object used to log the success or failure of the API call.
+
+    Returns:
+        Optional[Dict[str, Any]]: The enriched response data, or None for a
+        negative entry.
+    """
+    if entry.negative:
+        logging.info("Cached empty or invalid response for %s", website, extra={'domain': clean_website, 'stage': 'fetch'})
+        report.update(success=False, domain=clean_website)
+        return None
+    return handle_api_response(website, clean_website, full_url, HTTPResponse(200, entry.body), report)
+
+def store_api_response(cache: ResponseCache, clean_website: str, response: HTTPResponse,
+                       result: Optional[Dict[str, Any]]) -> None:
+    """Cache a fetched response, or a negative entry if it was empty or invalid."""
+    if result is not None:
+        cache.put(clean_website, response.body)
+    elif response.ok:
+        cache.put(clean_website, response.body, negative=True)
+
+def api_payload_ok(response: HTTPResponse) -> bool:
+    """Return False for a response body that is evidently not a complete JSON object.
+
+    This cheap check catches truncated bodies and HTML error pages served
+    with a 2xx status, which are worth fetching again. Empty bodies pass;
+    they are negative-cached like other invalid answers. The body is parsed
+    by `handle_api_response`.
+    """
+    body = response.body.strip()
+    return not body or (body[0] == '{' and body[-1] == '}')
+
+def request_api(clean_website: str, report: Report) -> HTTPResponse:
+    """Request the company report for a domain from agent.ai within the API rate limit."""
+    return limited_request(
+        get_rate_limiter('api'), 'POST', CONFIG['API_URL'], headers=CONFIG['HEADERS'],
+        body=build_api_payload(clean_website), report=report, validate=api_payload_ok
+    )
+
+def handle_fetch_error(website: str, clean_website: str, full_url: str, error: TransportError,
+                       cache: Optional[ResponseCache], entry: Optional[CacheEntry],
+                       report: Report) -> Optional[Dict[str, Any]]:
+    """Serve a stale cache entry for a fetch that failed in the transport, or dead-letter the domain.
+
+    Returns:
+        Optional[Dict[str, Any]]: The enriched cached data, or None if
+        there was no entry to serve.
+    """
+    if entry is not None and cache.serve_stale:
+        report.record_cache('stale')
+        return handle_cached_response(website, clean_website, full_url, entry, report)
+    logging.error("Error calling API for %s: %s", website, error, extra={'domain': clean_website, 'stage': 'fetch'})
+    report.update(success=False, domain=clean_website)
+    record_dead_letter(report, website, clean_website, 'fetch', classify_failure(error=error), str(error))
+    return None
+
+def handle_fetched_response(website: str, clean_website: str, full_url: str, response: HTTPResponse,
+                            cache: Optional[ResponseCache], entry: Optional[CacheEntry],
+                            report: Report) -> Optional[Dict[str, Any]]:
+    """Process the final response of a fetch, falling back to the cache when it failed.
+
+    A failed response is replaced by a stale cache entry if there is one
+    and `SERVE_STALE` is enabled; otherwise the domain is dead-lettered.
+    Valid responses, and answers that are complete but empty or invalid,
+    are stored in the cache.
+
+    Returns:
+        Optional[Dict[str, Any]]: The enriched response data if it is valid,
+        or None otherwise.
+    """
+    failure = classify_failure(response, validate=api_payload_ok)
+    if failure and entry is not None and cache.serve_stale:
+        report.record_cache('stale')
+        return handle_cached_response(website, clean_website, full_url, entry, report)
+    result = handle_api_response(website, clean_website, full_url, response, report)
+    if failure:
+        record_dead_letter(report, website, clean_website, 'fetch', failure, f'HTTP {response.status}')
+    elif cache:
+        store_api_response(cache, clean_website, response, result)
+    return result
+
+def call_api(website: str, report: Report) -> Optional[Dict[str, Any]]:
+    """Call an external API with the specified website and report.
+
+    This function posts a request for the given website to the external API
+    through the shared HTTP transport and processes the response. If the
+    response is valid, it enriches the response data with additional
+    information such as the original URL and clean domain. Fresh entries
+    in the response cache are used instead of calling the API, and stale
+    entries are served when the API fails and `SERVE_STALE` is enabled.
+    Failed attempts are retried by `limited_request` according to their
+    failure class, and a domain that still fails is written to the
+    dead-letter file. The function also handles various error scenarios,
+    logging errors and updating the provided report object accordingly.
+
+    Args:
+        website (str): The website URL to be processed.
+        report (Report): An object used to log the success or failure of the API call.
+
+    Returns:
+        Optional[Dict[str, Any]]: A dictionary containing the API response data if successful,
+        or None if there was an error.
+    """
+
+    try:
+        clean_website, full_url = clean_domain(website)
+        cache = get_response_cache()
+        entry = cache.get(clean_website) if cache else None
+        if entry is not None and entry.fresh:
+            report.record_cache('hit')
+            return handle_cached_response(website, clean_website, full_url, entry, report)
+        if cache:
+            report.record_cache('miss')
+
+        try:
+            response = request_api(clean_website, report)
+        except TransportError as e:
+            return handle_fetch_error(website, clean_website, full_url, e, cache, entry, report)
+        return handle_fetched_response(website, clean_website, full_url, response, cache, entry, report)
 
     except Exception as e:
-        logging.error(f"Error calling API for {website}: {str(e)}")
+        logging.error("Error calling API for %s: %s", website, e, extra={'domain': clean_website, 'stage': 'fetch'})
         report.update(success=False, domain=clean_website)
         return None
 
+# Field mapping from an agent.ai response to a server record. Each field is
+# produced by one rule, in this order:
+#   const     the fixed 'value'
+#   str       str() of the value at 'path', or of 'default' if the key is missing
+#   first     str() of the first item of the list at 'path', or 'default'
+#   join      the items of the list at 'path' joined with 'separator', or 'default'
+#   json      the object at 'path' serialised with json.dumps ('{}' if it is not an object)
+#   truncate  str() of the value at 'path' cut to 'length' characters, or 'default' if it is falsy
+# Paths are dotted keys below the enriched response. Objects along a path
+# that are missing or not objects count as empty; for the objects listed in
+# 'validate' a wrong type is logged.
+COMPANY_MAPPING = {
+    'validate': ['company_data', 'company_data.company'],
+    'fields': [
+        {'name': 'company_name', 'rule': 'str', 'path': 'company_data.company.name'},
+        {'name': 'firstCompanyName', 'rule': 'const', 'value': ''},
+        {'name': 'street_NO', 'rule': 'str', 'path': 'company_data.company.location.street'},
+        {'name': 'domain', 'rule': 'str', 'path': 'clean_domain'},
+        {'name': 'city', 'rule': 'str', 'path': 'company_data.company.location.city'},
+        {'name': 'email', 'rule': 'first', 'path': 'company_data.company.site.emailAddresses'},
+        {'name': 'linkedin', 'rule': 'str', 'path': 'company_data.company.linkedin.handle'},
+        {'name': 'logo', 'rule': 'str', 'path': 'company_data.company.logo'},
+        {'name': 'founded_on', 'rule': 'str', 'path': 'company_data.company.foundedYear'},
+        {'name': 'sourcefound', 'rule': 'const', 'value': 'agent.ai'},
+        {'name': 'zip', 'rule': 'str', 'path': 'company_data.company.location.postalCode'},
+        {'name': 'category', 'rule': 'str', 'path': 'company_data.company.category.industry'},
+        {'name': 'slogan', 'rule': 'str', 'path': 'company_data.company.description'},
+        {'name': 'pressphoto', 'rule': 'const', 'value': ''},
+        {'name': 'tags', 'rule': 'join', 'path': 'company_data.company.tags', 'separator': ','},
+        {'name': 'ceo', 'rule': 'const', 'value': ''},
+        {'name': 'ceoid', 'rule': 'const', 'value': ''},
+        {'name': 'news', 'rule': 'const', 'value': ''},
+        {'name': 'awards', 'rule': 'const', 'value': ''},
+        {'name': 'futurepredictions', 'rule': 'const', 'value': ''},
+        {'name': 'financials', 'rule': 'json', 'path': 'company_data.company.metrics'},
+        {'name': 'Company_Short', 'rule': 'truncate', 'path': 'company_data.company.name', 'length': 50},
+        {'name': 'phone', 'rule': 'first', 'path': 'company_data.company.site.phoneNumbers'},
+        {'name': 'Rechtsform', 'rule': 'str', 'path': 'company_data.company.type'},
+        {'name': 'cat-tag-1-trustedshops', 'rule': 'const', 'value': ''},
+        {'name': 'cat-tag-2-trustedshops', 'rule': 'const', 'value': ''},
+        {'name': 'private-gov', 'rule': 'const', 'value': ''},
+        {'name': 'Description', 'rule': 'str', 'path': 'company_data.company.description'},
+        {'name': 'link_agb', 'rule': 'const', 'value': ''},
+        {'name': 'link_daten', 'rule': 'const', 'value': ''},
+        {'name': 'tag_cat_linkedin', 'rule': 'str', 'path': 'company_data.company.linkedin.industry'},
+        {'name': 'linkedinurl', 'rule': 'str', 'path': 'company_data.company.linkedin.handle'},
+        {'name': 'facebookurl', 'rule': 'str', 'path': 'company_data.company.facebook.handle'},
+        {'name': 'instagramurl', 'rule': 'const', 'value': ''},
+        {'name': 'Twitter', 'rule': 'str', 'path': 'company_data.company.twitter.handle'},
+        {'name': 'TAX-ID', 'rule': 'str', 'path': 'company_data.company.identifiers.usEIN'},
+        {'name': 'country', 'rule': 'str', 'path': 'company_data.company.location.country'}
+    ]
+}
+
+def compile_mapping(spec: Dict[str, Any]) -> Callable[[Dict[str, Any]], Dict[str, Any]]:
+    """Compile a field mapping spec into a function that maps one response.
+
+    The spec is turned into the source of a single function that resolves
+    every object on the field paths once and builds the record in one dict
+    display, so mapping a response costs no more than hand-written code.
+    See `COMPANY_MAPPING` for the rules.
+
+    Args:
+        spec (Dict[str, Any]): The mapping spec, with 'fields' and optionally 'validate'.
+
+    Returns:
+        Callable[[Dict[str, Any]], Dict[str, Any]]: The mapper. It raises
+        TypeError if the response is not a dict.
+
+    Raises:
+        ValueError: If a field has an unknown rule or is missing a path.
+    """
+    validate = set(spec.get('validate', ()))
+    objects = {(): 'data'}
+    lines = [
+        'def mapper(data):',
+        '    if not isinstance(data, dict):',
+        '        _log(f"Invalid data type in map_company_data: {type(data)}")',
+        '        raise TypeError(f"Expected dict, got {type(data)}")'
+    ]
+
+    def resolve(parts: tuple) -> str:
+        # Emit the lookup of the object at `parts` once and return its variable name
+        if parts not in objects:
+            parent = resolve(parts[:-1])
+            name = objects[parts] = f'o{len(objects)}'
+            lines.append(f'    {name} = {parent}.get({parts[-1]!r}, _EMPTY)')
+            lines.append(f'    if not isinstance({name}, dict):')
+            if '.'.join(parts) in validate:
+                # The key comes from a user-editable spec, so it goes into the source only as a literal
+                lines.append(f'        _log("Invalid %s type: %s", {parts[-1]!r}, type({name}))')
+            lines.append(f'        {name} = _EMPTY')
+        return objects[parts]
+
+    values = []
+    for field in spec['fields']:
+        rule = field['rule']
+        if rule == 'const':
+            values.append(repr(field['value']))
+            continue
+        if not field.get('path'):
+            raise ValueError(f"Field {field['name']!r} needs a path")
+        *parents, key = field['path'].split('.')
+        source = f'{resolve(tuple(parents))}.get({key!r}'
+        default = repr(field.get('default', ''))
+        if rule == 'str':
+            values.append(f'_str({source}, {default}))')
+        elif rule == 'first':
+            values.append(f'_first({source}), {default})')
+        elif rule == 'join':
+            values.append(f'_join({source}), {field.get("separator", ",")!r}, {default})')
+        elif rule == 'json':
+            values.append(f'_json({source}))')
+        elif rule == 'truncate':
+            values.append(f'_truncate({source}), {int(field["length"])}, {default})')
+        else:
+            raise ValueError(f"Unknown rule {rule!r} for field {field['name']!r}")
+    lines.append('    return {')
+    lines.append(',\n'.join(f'        {field["name"]!r}: {value}' for field, value in zip(spec['fields'], values)))
+    lines.append('    }')
+
+    namespace = {
+        '_EMPTY': {}, '_str': str, '_log': logging.error,
+        '_first': lambda items, default: str(items[0]) if isinstance(items, list) and items else default,
+        '_join': lambda items, separator, default: (
+            separator.join([str(item) for item in items]) if isinstance(items, list) else default
+        ),
+        '_json': lambda value: json.dumps(value) if isinstance(value, dict) and value else '{}',
+        '_truncate': lambda value, length, default: str(value)[:length] if value else default
+    }
+    exec(compile('\n'.join(lines), '<company mapping>', 'exec'), namespace)
+    return namespace['mapper']
+
+def load_mapping(path: Optional[str] = None) -> Dict[str, Any]:
+    """Return the mapping spec from a JSON file, or `COMPANY_MAPPING` if no path is given."""
+    if not path:
+        return COMPANY_MAPPING
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+_company_mapper = None
+_company_mapper_lock = threading.Lock()
+
+def get_company_mapper() -> Callable[[Dict[str, Any]], Dict[str, Any]]:
+    """Return the compiled mapper for `CONFIG['MAPPING']['PATH']`, compiling it on first use."""
+    global _company_mapper
+    if _company_mapper is None:
+        with _company_mapper_lock:
+            if _company_mapper is None:
+                _company_mapper = compile_mapping(load_mapping(CONFIG['MAPPING']['PATH']))
+    return _company_mapper
+
 def map_company_data(data: Dict[str, Any]) -> Dict[str, Any]:
     """Map agent.ai data to server format.
 
-    This function takes a dictionary containing company data from agent.ai
-    and maps it to a specific server format. It validates the input data,
-    ensuring that the necessary fields are present and of the correct type.
-    The function extracts relevant information such as company name,
-    location, contact details, and social media links, returning a new
-    dictionary with the mapped data. If any errors occur during processing,
-    the function logs the error and returns a default dictionary with empty
-    fields.
+    This function takes a dictionary containing company data from agent.ai
+    and maps it to a specific server format with the compiled field mapping
+    (`COMPANY_MAPPING`, or the JSON file in `CONFIG['MAPPING']['PATH']`).
+    Nested objects and lists of the wrong type are treated as empty. If any
+    errors occur during processing, the function logs the error and returns
+    a record with empty fields, keeping the constants and the fields taken
+    directly from the top level of the data, such as the domain.
+
+    Args:
+        data (Dict[str, Any]): A dictionary containing company data from agent.ai.
+
+    Returns:
+        Dict[str, Any]: A dictionary containing the mapped company data in the
+        specified server format.
+    """
+    mapper = get_company_mapper()
+    try:
+        return mapper(data)
+    except Exception as e:
+        logging.error("Error mapping company data: %s", e, extra={'stage': 'map'})
+        # Return empty data with required fields
+        if not isinstance(data, dict):
+            return mapper({})
+        return mapper({key: value for key, value in data.items() if not isinstance(value, (dict, list))})
+
+def map_many(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Map a batch of agent.ai responses to server records.
+
+    Equivalent to calling `map_company_data` for every item, but looks up
+    the compiled mapper once for the whole batch.
+    """
+    mapper = get_company_mapper()
+    records = []
+    for data in items:
+        try:
+            records.append(mapper(data))
+        except Exception:
+            records.append(map_company_data(data))
+    return records
+
+def loads_json(text: str) -> Any:
+    """Parse a JSON document, with orjson when it is installed and enabled.
+
+    `CONFIG['MAPPING']['JSON_BACKEND']` selects 'orjson', 'json' or 'auto'
+    (orjson if importable). Documents orjson rejects but the standard
+    library accepts, such as NaN literals or very large integers, are
+    parsed with `json.loads`, so the result never depends on the backend.
+
+    Raises:
+        json.JSONDecodeError: If the document is invalid.
+    """
+    global _orjson
+    if _orjson is _UNSET:
+        _orjson = _load_orjson(CONFIG['MAPPING']['JSON_BACKEND'])
+    if _orjson is not None:
+        try:
+            return _orjson.loads(text)
+        except _orjson.JSONDecodeError:
+            pass
+    return json.loads(text)
+
+_UNSET = object()
+_orjson = _UNSET
+
+def _load_orjson(backend: str):
+    if backend == 'json':
+        return None
+    try:
+        import orjson  # optional dependency, only a faster parser
+        return orjson
+    except ImportError:
+        if backend == 'orjson':
+            raise
+        return None
+
+def build_upload_request(data: Dict[str, Any], token: str) -> tuple[str, Dict[str, str], str]:
+    """Return the URL, headers and form-encoded body for uploading a record."""
+    return (
+        f'{CONFIG["SERVER_URL"]}/crawler/institution',
+        {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Authorization': token
+        },
+        urlencode(data)
+    )
+
+def authorized_request(token_manager: TokenManager, build_request: Callable[[str], tuple[str, Dict[str, str], str]],
+                       report: Optional[Report] = None) -> HTTPResponse:
+    """POST an authenticated request to the server, replaying it once after a 401.
+
+    If the server rejects the token, the token manager logs in again (only
+    once for all requests rejected with the same token) and the request is
+    rebuilt with the new token and sent again.
+
+    Args:
+        token_manager (TokenManager): Provides the authentication token.
+        build_request (Callable[[str], tuple[str, Dict[str, str], str]]): Returns the URL,
+            headers and body of the request for a token.
+        report (Optional[Report]): Receives the time spent waiting for the server rate limiter.
+
+    Returns:
+        HTTPResponse: The response to the last attempt.
+    """
+    token = token_manager.get_token()
+    url, headers, body = build_request(token)
+    response = limited_request(get_rate_limiter('server'), 'POST', url, headers=headers, body=body, report=report)
+    if response.status == 401:
+        logging.warning("Server rejected the authentication token, logging in again")
+        url, headers, body = build_request(token_manager.force_refresh(token))
+        response = limited_request(get_rate_limiter('server'), 'POST', url, headers=headers, body=body, report=report)
+    return response
+
+async def authorized_request_async(token_manager: TokenManager, client,
+                                   build_request: Callable[[str], tuple[str, Dict[str, str], str]],
+                                   report: Optional[Report] = None) -> HTTPResponse:
+    """POST an authenticated request through an async transport, replaying it once after a 401.
+
+    This is the asyncio counterpart of `authorized_request`.
+    """
+    token = await token_manager.get_token_async()
+    url, headers, body = build_request(token)
+    response = await limited_request_async(
+        get_rate_limiter('server'), client, 'POST', url, headers=headers, body=body, report=report
+    )
+    if response.status == 401:
+        logging.warning("Server rejected the authentication token, logging in again")
+        url, headers, body = build_request(await token_manager.force_refresh_async(token))
+        response = await limited_request_async(
+            get_rate_limiter('server'), client, 'POST', url, headers=headers, body=body, report=report
+        )
+    return response
+
+def handle_upload_response(data: Dict[str, Any], response: HTTPResponse, report: Optional[Report] = None) -> bool:
+    """Log the outcome of an upload, dead-letter a failed record and return whether it succeeded."""
+    if not response.ok:
+        logging.error("Server returned HTTP %s for company: %s", response.status, data.get('company_name'),
+                      extra={'domain': data.get('domain'), 'stage': 'upload', 'status': response.status})
+        record_dead_letter(report, data.get('domain'), data.get('domain'), 'upload',
+                           classify_failure(response), f'HTTP {response.status}')
+        return False
+    log_success("Successfully sent data to server for company: %s", data.get('company_name'),
+                domain=data.get('domain'), stage='upload')
+    return True
+
+def handle_upload_error(data: Dict[str, Any], error: Exception, report: Optional[Report] = None) -> bool:
+    """Log an upload that raised, dead-letter the record if the transport failed, and return False."""
+    logging.error("Error sending data to server: %s", error, extra={'domain': data.get('domain'), 'stage': 'upload'})
+    if isinstance(error, TransportError):
+        record_dead_letter(report, data.get('domain'), data.get('domain'), 'upload',
+                           classify_failure(error=error), str(error))
+    return False
+
+def send_to_server(data: Dict[str, Any], token_manager: TokenManager, report: Optional[Report] = None) -> bool:
+    """Send data to the server with authentication.
+
+    This function posts data to the institution endpoint of the server
+    through the shared HTTP transport, within the server rate limit. It retrieves an authentication token
+    from the provided TokenManager and includes it in the request headers;
+    if the server rejects the token, it logs in again and resends once.
+    The data is sent as URL-encoded form data. Failed attempts are retried
+    by `limited_request` according to their failure class. If the request
+    is successful, it logs a success message; otherwise, it logs an error
+    message and writes the record's domain to the dead-letter file.
+
+    Args:
+        data (Dict[str, Any]): A dictionary containing the data to be sent to the server.
+        token_manager (TokenManager): An instance of TokenManager used to retrieve the authentication token.
+        report (Optional[Report]): Receives rate limiter waits, failed attempts and dead letters.
+
+    Returns:
+        bool: True if the data was successfully sent to the server, False otherwise.
+    """
+    try:
+        response = authorized_request(token_manager, lambda token: build_upload_request(data, token), report)
+        return handle_upload_response(data, response, report)
+
+    except Exception as e:
+        return handle_upload_error(data, e, report)
+
+def build_batch_upload_request(records: List[Dict[str, Any]], token: str) -> tuple[str, Dict[str, str], str]:
+    """Return the URL, headers and body for uploading several records at once.
+
+    Records are encoded as a single JSON array, or as one JSON document per
+    line when `CONFIG['BATCH_UPLOAD']['FORMAT']` is 'ndjson'.
+
+    Args:
+        records (List[Dict[str, Any]]): The mapped records to upload.
+        token (str): The authentication token.
+
+    Returns:
+        tuple[str, Dict[str, str], str]: The bulk endpoint URL, the request
+        headers and the encoded body.
+    """
+    settings = CONFIG['BATCH_UPLOAD']
+    if settings['FORMAT'] == 'ndjson':
+        content_type = 'application/x-ndjson'
+        body = '\n'.join(json.dumps(record) for record in records) + '\n'
+    else:
+        content_type = 'application/json'
+        body = json.dumps(records)
+    return (
+        f'{CONFIG["SERVER_URL"]}{settings["ENDPOINT"]}',
+        {'Content-Type': content_type, 'Authorization': token},
+        body
+    )
+
+def handle_batch_upload_response(records: List[Dict[str, Any]], response: HTTPResponse) -> List[bool]:
+    """Return the per-record outcome of a bulk upload.
+
+    The bulk endpoint answers with `{"results": [{"ok": bool, "error": str}, ...]}`
+    (or the bare list), one entry per record in request order. If the request
+    itself failed or the results cannot be matched to the records, every
+    record of the batch is considered failed.
+
+    Args:
+        records (List[Dict[str, Any]]): The records that were sent.
+        response (HTTPResponse): The response returned by the transport.
+
+    Returns:
+        List[bool]: Whether each record was accepted, in request order.
+    """
+    if not response.ok:
+        logging.error(f"Server returned HTTP {response.status} for batch of {len(records)} records")
+        return [False] * len(records)
+    try:
+        payload = json.loads(response.body)
+    except json.JSONDecodeError as e:
+        logging.error(f"Failed to parse batch upload response: {str(e)}")
+        return [False] * len(records)
+
+    results = payload.get('results') if isinstance(payload, dict) else payload
+    if not isinstance(results, list) or len(results) != len(records):
+        logging.error(f"Batch upload response does not match the {len(records)} records sent")
+        return [False] * len(records)
+
+    outcomes = []
+    for record, result in zip(records, results):
+        ok = bool(result.get('ok')) if isinstance(result, dict) else bool(result)
+        if not ok:
+            error = result.get('error') if isinstance(result, dict) else result
+            logging.error("Server rejected company %s (%s): %s", record.get('company_name'), record.get('domain'), error,
+                          extra={'domain': record.get('domain'), 'stage': 'upload'})
+        outcomes.append(ok)
+    return outcomes
+
+def batch_upload_failed(batch: List[Dict[str, Any]], error: Exception) -> tuple[Optional[str], str]:
+    """Log a bulk upload that raised and return its failure class and error message."""
+    logging.error(f"Error sending batch of {len(batch)} records to server: {str(error)}")
+    return classify_failure(error=error) if isinstance(error, TransportError) else None, str(error)
+
+def apply_batch_upload_response(records: List[Dict[str, Any]], pending: List[int], outcomes: List[bool],
+                                response: HTTPResponse) -> tuple[List[int], Optional[str], str]:
+    """Record the outcome of a bulk upload of the `pending` records.
+
+    Args:
+        records (List[Dict[str, Any]]): All records of the batch.
+        pending (List[int]): Indexes of the records that were sent.
+        outcomes (List[bool]): Per-record outcomes, updated in place.
+        response (HTTPResponse): The response returned by the transport.
+
+    Returns:
+        tuple[List[int], Optional[str], str]: The indexes still not accepted,
+        and the failure class and error message that apply to them.
+    """
+    results = handle_batch_upload_response([records[i] for i in pending], response)
+    for i, ok in zip(pending, results):
+        outcomes[i] = ok
+    pending = [i for i, ok in zip(pending, results) if not ok]
+    if not response.ok:
+        return pending, classify_failure(response), f'HTTP {response.status}'
+    return pending, 'client_error', 'rejected by the server'
+
+def send_batch_to_server(records: List[Dict[str, Any]], token_manager: TokenManager,
+                         report: Optional[Report] = None) -> List[bool]:
+    """Send several records to the bulk endpoint of the server.
+
+    This function uploads the records in one request. A failed request is
+    retried by `limited_request` according to its failure class. Records
+    the server rejected individually count as client errors and are only
+    resent as far as `CONFIG['RETRY']['CLIENT_ERROR']` allows; accepted
+    records are never resent. Records that were not accepted in the end
+    are written to the dead-letter file.
+
+    Args:
+        records (List[Dict[str, Any]]): The mapped records to upload.
+        token_manager (TokenManager): An instance of TokenManager used to retrieve the authentication token.
+        report (Optional[Report]): Receives rate limiter waits, failed attempts and dead letters.
+
+    Returns:
+        List[bool]: Whether each record was accepted, in the order given.
+    """
+    outcomes = [False] * len(records)
+    pending = list(range(len(records)))
+    for attempt in itertools.count(1):
+        batch = [records[i] for i in pending]
+        try:
+            response = authorized_request(
+                token_manager, lambda token: build_batch_upload_request(batch, token), report
+            )
+        except Exception as e:
+            failure, error = batch_upload_failed(batch, e)
+            break
+        pending, failure, error = apply_batch_upload_response(records, pending, outcomes, response)
+        delay = retry_delay(failure, attempt) if pending and failure == 'client_error' else None
+        if delay is None:
+            break
+        time.sleep(delay)
+    for i in pending:
+        record_dead_letter(report, records[i].get('domain'), records[i].get('domain'), 'upload', failure, error)
+    logging.info(f"Batch upload: {len(records) - len(pending)} of {len(records)} records accepted")
+    return outcomes
+
+class BatchUploader:
+    def __init__(self, send_batch: Callable[[List[Dict[str, Any]]], List[bool]],
+                 batch_size: Optional[int] = None, max_wait: Optional[float] = None,
+                 on_result: Optional[Callable[[Dict[str, Any], bool], None]] = None):
+        self.send_batch = send_batch
+        self.on_result = on_result
+        self.batch_size = batch_size or CONFIG['BATCH_UPLOAD']['SIZE']
+        self.max_wait = max_wait or CONFIG['BATCH_UPLOAD']['MAX_WAIT_MS'] / 1000
+        self.sent = 0
+        self.failed = 0
+        self._buffer: List[Dict[str, Any]] = []
+        self._oldest = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically, name='batch-flusher', daemon=True)
+        self._flusher.start()
+
+    def _take(self) -> List[Dict[str, Any]]:
+        batch, self._buffer = self._buffer, []
+        return batch
+
+    def _send(self, batch: List[Dict[str, Any]]) -> None:
+        """Send a batch and record its outcomes; an error fails the batch instead of the caller."""
+        try:
+            results = self.send_batch(batch)
+        except Exception as e:
+            logging.error(f"Error sending batch of {len(batch)} records to server: {str(e)}")
+            results = [False] * len(batch)
+        if self.on_result:
+            for record, ok in zip(batch, results):
+                self.on_result(record, ok)
+        accepted = sum(results)
+        with self._lock:
+            self.sent += accepted
+            self.failed += len(batch) - accepted
+
+    def submit(self, record: Dict[str, Any]) -> bool:
+        """Add a record to the current batch.
+
+        When the batch reaches `batch_size` records it is sent from the
+        calling thread, so upload workers block while their batch is in
+        flight and backpressure reaches the earlier pipeline stages.
+
+        Args:
+            record (Dict[str, Any]): A mapped record to upload.
+
+        Returns:
+            bool: Always True; per-record outcomes are counted in `sent` and `failed`.
+        """
+        batch = None
+        with self._lock:
+            if not self._buffer:
+                self._oldest = time.monotonic()
+            self._buffer.append(record)
+            if len(self._buffer) >= self.batch_size:
+                batch = self._take()
+        if batch:
+            self._send(batch)
+        return True
+
+    def _flush_periodically(self) -> None:
+        while not self._stop.wait(self.max_wait / 2):
+            batch = None
+            with self._lock:
+                if self._buffer and time.monotonic() - self._oldest >= self.max_wait:
+                    batch = self._take()
+            if batch:
+                self._send(batch)
+
+    def close(self) -> None:
+        """Stop the periodic flush and send any records still buffered."""
+        self._stop.set()
+        self._flusher.join()
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._send(batch)
+
+class AsyncBatchUploader:
+    def __init__(self, send_batch: Callable[[List[Dict[str, Any]]], Any],
+                 batch_size: Optional[int] = None, max_wait: Optional[float] = None,
+                 on_result: Optional[Callable[[Dict[str, Any], bool], None]] = None):
+        self.send_batch = send_batch
+        self.on_result = on_result
+        self.batch_size = batch_size or CONFIG['BATCH_UPLOAD']['SIZE']
+        self.max_wait = max_wait or CONFIG['BATCH_UPLOAD']['MAX_WAIT_MS'] / 1000
+        self.sent = 0
+        self.failed = 0
+        self._buffer: List[Dict[str, Any]] = []
+        self._oldest = 0.0
+        self._stop = asyncio.Event()
+        self._flusher = asyncio.create_task(self._flush_periodically())
+
+    def _take(self) -> List[Dict[str, Any]]:
+        batch, self._buffer = self._buffer, []
+        return batch
+
+    async def _send(self, batch: List[Dict[str, Any]]) -> None:
+        """Send a batch and record its outcomes, like `BatchUploader._send`."""
+        try:
+            results = await self.send_batch(batch)
+        except Exception as e:
+            logging.error(f"Error sending batch of {len(batch)} records to server: {str(e)}")
+            results = [False] * len(batch)
+        if self.on_result:
+            for record, ok in zip(batch, results):
+                self.on_result(record, ok)
+        self.sent += sum(results)
+        self.failed += len(batch) - sum(results)
+
+    async def submit(self, record: Dict[str, Any]) -> bool:
+        """Add a record to the current batch, sending it once it is full.
+
+        This is the asyncio counterpart of `BatchUploader.submit`.
+
+        Args:
+            record (Dict[str, Any]): A mapped record to upload.
+
+        Returns:
+            bool: Always True; per-record outcomes are counted in `sent` and `failed`.
+        """
+        if not self._buffer:
+            self._oldest = time.monotonic()
+        self._buffer.append(record)
+        if len(self._buffer) >= self.batch_size:
+            await self._send(self._take())
+        return True
+
+    async def _flush_periodically(self) -> None:
+        while not self._stop.is_set():
+            try:
+                await asyncio.wait_for(self._stop.wait(), self.max_wait / 2)
+            except asyncio.TimeoutError:
+                pass
+            if self._buffer and time.monotonic() - self._oldest >= self.max_wait:
+                await self._send(self._take())
+
+    async def close(self) -> None:
+        """Stop the periodic flush and send any records still buffered.
+
+        The flusher is stopped rather than cancelled, so a batch it is
+        sending completes and has its outcomes recorded.
+        """
+        self._stop.set()
+        await self._flusher
+        if self._buffer:
+            await self._send(self._take())
+
+class RecordSink(abc.ABC):
+    def __init__(self, batch_size: Optional[int] = None):
+        self.batch_size = batch_size or CONFIG['SINKS']['BATCH_SIZE']
+        self.written = 0
+        # Called with every batch once it is written, e.g. to journal its domains
+        self.on_written: Optional[Callable[[List[Dict[str, Any]]], None]] = None
+        self._buffer: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def write(self, record: Dict[str, Any]) -> None:
+        """Buffer a mapped record and write the buffer once it holds `batch_size` records.
+
+        The batch is written by the calling thread while the sink is locked,
+        so at most one batch per sink is held in memory and a slow sink
+        slows the mapping stage down instead of buffering without bound.
+        """
+        with self._lock:
+            self._buffer.append(record)
+            if len(self._buffer) >= self.batch_size:
+                self._flush_locked()
+
+    def _flush_locked(self) -> None:
+        batch, self._buffer = self._buffer, []
+        if batch:
+            self._write_batch(batch)
+            self.written += len(batch)
+            if self.on_written:
+                self.on_written(batch)
+
+    def flush(self) -> None:
+        """Write any buffered records."""
+        with self._lock:
+            self._flush_locked()
+
+    def close(self) -> None:
+        """Write any buffered records and release the sink's files."""
+        with self._lock:
+            self._flush_locked()
+            self._close()
+
+    @abc.abstractmethod
+    def _write_batch(self, batch: List[Dict[str, Any]]) -> None:
+        """Write a batch of records to the sink's storage."""
+
+    def _close(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    def read(self) -> Iterator[Dict[str, Any]]:
+        """Yield the records previously written to the sink's location."""
+
+class RotatingFileSink(RecordSink):
+    suffix = ''
+
+    def __init__(self, directory: str, rotate_records: Optional[int] = None, batch_size: Optional[int] = None):
+        super().__init__(batch_size)
+        self.directory = directory
+        self.rotate_records = rotate_records or CONFIG['SINKS']['ROTATE_RECORDS']
+        self._file = None
+        self._file_records = 0
+        self._sequence = 0
+
+    def _next_path(self) -> str:
+        # The process id keeps the files of concurrent shard processes apart
+        self._sequence += 1
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        return os.path.join(self.directory, f'records_{stamp}_{os.getpid()}_{self._sequence:05d}{self.suffix}')
+
+    def _write_batch(self, batch: List[Dict[str, Any]]) -> None:
+        if self._file is None or self._file_records >= self.rotate_records:
+            self._close()
+            os.makedirs(self.directory, exist_ok=True)
+            self._file = self._open(self._next_path(), batch)
+            self._file_records = 0
+        self._append(batch)
+        self._file_records += len(batch)
+
+    @abc.abstractmethod
+    def _open(self, path: str, batch: List[Dict[str, Any]]):
+        """Create a new file at `path` for records shaped like `batch` and return it."""
+
+    @abc.abstractmethod
+    def _append(self, batch: List[Dict[str, Any]]) -> None:
+        """Append a batch of records to the current file."""
+
+    def _close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _paths(self) -> List[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            os.path.join(self.directory, name) for name in os.listdir(self.directory)
+            if name.startswith('records_') and name.endswith(self.suffix)
+        )
+
+class NDJSONSink(RotatingFileSink):
+    suffix = '.ndjson.gz'
+
+    def _open(self, path: str, batch: List[Dict[str, Any]]):
+        import gzip
+        return gzip.open(path, 'wt', encoding='utf-8', compresslevel=6)
+
+    def _append(self, batch: List[Dict[str, Any]]) -> None:
+        self._file.write(''.join(json.dumps(record) + '\n' for record in batch))
+
+    def read(self) -> Iterator[Dict[str, Any]]:
+        """Yield the records of every NDJSON file in the directory, oldest first.
+
+        A file cut short by a crash is read up to the damage.
+        """
+        for path in self._paths():
+            try:
+                for line in iter_lines(path, 'gzip'):
+                    if line.endswith('\n'):
+                        yield json.loads(line)
+            except (EOFError, OSError, json.JSONDecodeError) as e:
+                logging.warning(f"Stopped reading truncated sink file {path}: {str(e)}")
+
+class ParquetSink(RotatingFileSink):
+    suffix = '.parquet'
+
+    def _open(self, path: str, batch: List[Dict[str, Any]]):
+        import pyarrow as pa  # optional dependency, only needed for Parquet sinks
+        import pyarrow.parquet as pq
+        # map_company_data only produces strings, so every column is a string column
+        self._schema = pa.schema([(key, pa.string()) for key in batch[0]])
+        return pq.ParquetWriter(path, self._schema, compression='zstd')
+
+    def _append(self, batch: List[Dict[str, Any]]) -> None:
+        import pyarrow as pa
+        rows = [{key: None if value is None else str(value) for key, value in record.items()} for record in batch]
+        self._file.write_table(pa.Table.from_pylist(rows, schema=self._schema))
+
+    def read(self) -> Iterator[Dict[str, Any]]:
+        """Yield the records of every Parquet file in the directory, oldest first.
+
+        A file left without a footer by a crash is skipped.
+        """
+        import pyarrow.parquet as pq  # optional dependency, only needed for Parquet sinks
+        for path in self._paths():
+            try:
+                parquet_file = pq.ParquetFile(path)
+            except Exception as e:
+                logging.warning(f"Skipping unreadable sink file {path}: {str(e)}")
+                continue
+            for batch in parquet_file.iter_batches():
+                for row in batch.to_pylist():
+                    yield {key: value for key, value in row.items() if value is not None}
+
+class SQLiteSink(RecordSink):
+    def __init__(self, path: str, batch_size: Optional[int] = None):
+        super().__init__(batch_size)
+        self.path = path
+        # Shard processes may share the database, so wait for each other's write locks
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "domain TEXT PRIMARY KEY, record TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def _write_batch(self, batch: List[Dict[str, Any]]) -> None:
+        now = time.time()
+        self._conn.execute("BEGIN")
+        try:
+            self._conn.executemany(
+                "INSERT INTO records (domain, record, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(domain) DO UPDATE SET record = excluded.record, updated_at = excluded.updated_at",
+                [(record.get('domain', ''), json.dumps(record), now) for record in batch]
+            )
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def _close(self) -> None:
+        self._conn.close()
+
+    def read(self) -> Iterator[Dict[str, Any]]:
+        """Yield the latest record of every domain in the table."""
+        for (record,) in self._conn.execute("SELECT record FROM records ORDER BY rowid"):
+            yield json.loads(record)
+
+SINK_TYPES: Dict[str, Callable[[str], RecordSink]] = {
+    'ndjson': NDJSONSink,
+    'parquet': ParquetSink,
+    'sqlite': SQLiteSink
+}
+
+def create_sink(spec: str) -> RecordSink:
+    """Create an output sink from a 'kind:path' specification.
+
+    'ndjson:DIR' writes rotating gzip-compressed NDJSON files into DIR,
+    'parquet:DIR' rotating Parquet files (requires pyarrow) and
+    'sqlite:FILE' a table with one row per domain, upserted on `domain`.
+
+    Args:
+        spec (str): The sink specification.
+
+    Returns:
+        RecordSink: The sink.
+
+    Raises:
+        ValueError: If the kind is unknown.
+    """
+    kind, _, path = spec.partition(':')
+    if kind not in SINK_TYPES or not path:
+        raise ValueError(f"Invalid sink {spec!r}, expected one of {', '.join(f'{k}:PATH' for k in SINK_TYPES)}")
+    return SINK_TYPES[kind](path)
+
+def record_fetch_outcome(website: str, result: Optional[Dict[str, Any]],
+                         journal: Optional[ProgressJournal] = None) -> None:
+    """Journal the outcome of a fetch and, when nothing is uploaded, store its time in the incremental state.
+
+    With uploads, the time is stored once the record is accepted or found
+    unchanged, so a domain whose upload fails is fetched again next run.
+    """
+    domain = result['clean_domain'] if result else clean_domain(website)[0]
+    if journal:
+        journal.record(domain, 'fetch', result is not None)
+    state = get_import_state()
+    if state and result is not None and not CONFIG['SINKS']['UPLOAD']:
+        state.record_fetch(domain)
+
+def skip_unchanged(record: Dict[str, Any], report: Report, journal: Optional[ProgressJournal] = None,
+                   fetched: bool = True) -> bool:
+    """Return True if the incremental mode leaves out the upload of a record equal to the last uploaded one.
+
+    A skipped domain is journaled as uploaded, so a resumed run skips it
+    too, and if the record was just fetched (not replayed from a sink) the
+    current time is stored as its last fetch.
+    """
+    state = get_import_state()
+    if state is None or not state.is_unchanged(record):
+        return False
+    report.record_incremental('unchanged')
+    if journal:
+        journal.record(record['domain'], 'upload', True)
+    if fetched:
+        state.record_fetch(record['domain'])
+    return True
+
+def upload_recorder(journal: Optional[ProgressJournal] = None,
+                    fetched: bool = True) -> Optional[Callable[[Dict[str, Any], bool], None]]:
+    """Return the callback recording upload outcomes in the journal and the incremental state.
 
     Args:
-        data (Dict[str, Any]): A dictionary containing company data from agent.ai.
+        journal (Optional[ProgressJournal]): Journal receiving every upload outcome.
+        fetched (bool): Whether the records were just fetched; see `ImportState.record_upload`.
 
     Returns:
-        Dict[str, Any]: A dictionary containing the mapped company data in the
-        specified server format.
+        Optional[Callable[[Dict[str, Any], bool], None]]: Called with each
+        record and whether the server accepted it, or None if neither the
+        journal nor the incremental mode is in use.
+    """
+    state = get_import_state()
+    if journal is None and state is None:
+        return None
 
-    Raises:
-        TypeError: If the input data is not of type dict.
+    def record(data: Dict[str, Any], ok: bool) -> None:
+        if journal:
+            journal.record(data['domain'], 'upload', ok)
+        if state and ok:
+            state.record_upload(data, fetched)
+    return record
+
+def sink_recorder(journal: Optional[ProgressJournal],
+                  sinks: List[RecordSink]) -> Optional[Callable[[List[Dict[str, Any]]], None]]:
+    """Return the callback journaling domains as completed once every sink has written their record.
+
+    Runs with `--no-upload` have no upload to journal, so without this a
+    resumed run would fetch every domain again. A record only counts once
+    its sink batch is written, not when it is buffered.
+
+    Returns:
+        Optional[Callable[[List[Dict[str, Any]]], None]]: The `on_written`
+        callback for the sinks, or None without a journal or sinks.
     """
-    try:
-        # Validate input
-        if not isinstance(data, dict):
-            logging.error(f"Invalid data type in map_company_data: {type(data)}")
-            raise TypeError(f"Expected dict, got {type(data)}")
-        
-        company_data = data.get('company_data', {})
-        if not isinstance(company_data, dict):
-            logging.error(f"Invalid company_data type: {type(company_data)}")
-            company_data = {}
-            
-        company = company_data.get('company', {})
-        if not isinstance(company, dict):
-            logging.error(f"Invalid company type: {type(company)}")
-            company = {}
-        
-        # Get domain information with validation
-        clean_domain = str(data.get('clean_domain', ''))
-        full_url = str(data.get('full_url', ''))
-        
-        # Safely get nested values
-        location = company.get('location', {}) if isinstance(company.get('location'), dict) else {}
-        site = company.get('site', {}) if isinstance(company.get('site'), dict) else {}
-        linkedin = company.get('linkedin', {}) if isinstance(company.get('linkedin'), dict) else {}
-        facebook = company.get('facebook', {}) if isinstance(company.get('facebook'), dict) else {}
-        twitter = company.get('twitter', {}) if isinstance(company.get('twitter'), dict) else {}
-        metrics = company.get('metrics', {}) if isinstance(company.get('metrics'), dict) else {}
-        category = company.get('category', {}) if isinstance(company.get('category'), dict) else {}
-        identifiers = company.get('identifiers', {}) if isinstance(company.get('identifiers'), dict) else {}
-        
-        # Safely get arrays
-        email_addresses = site.get('emailAddresses', []) if isinstance(site.get('emailAddresses'), list) else []
-        phone_numbers = site.get('phoneNumbers', []) if isinstance(site.get('phoneNumbers'), list) else []
-        tags = company.get('tags', []) if isinstance(company.get('tags'), list) else []
-        
-        return {
-            'company_name': str(company.get('name', '')),
-            'firstCompanyName': '',
-            'street_NO': str(location.get('street', '')),
-            'domain': clean_domain,
-            'city': str(location.get('city', '')),
-            'email': str(email_addresses[0]) if email_addresses else '',
-            'linkedin': str(linkedin.get('handle', '')),
-            'logo': str(company.get('logo', '')),
-            'founded_on': str(company.get('foundedYear', '')),
-            'sourcefound': 'agent.ai',
-            'zip': str(location.get('postalCode', '')),
-            'category': str(category.get('industry', '')),
-            'slogan': str(company.get('description', '')),
-            'pressphoto': '',
-            'tags': ','.join(str(tag) for tag in tags),
-            'ceo': '',
-            'ceoid': '',
-            'news': '',
-            'awards': '',
-            'futurepredictions': '',
-            'financials': json.dumps(metrics),
-            'Company_Short': str(company.get('name', ''))[:50] if company.get('name') else '',
-            'phone': str(phone_numbers[0]) if phone_numbers else '',
-            'Rechtsform': str(company.get('type', '')),
-            'cat-tag-1-trustedshops': '',
-            'cat-tag-2-trustedshops': '',
-            'private-gov': '',
-            'Description': str(company.get('description', '')),
-            'link_agb': '',
-            'link_daten': '',
-            'tag_cat_linkedin': str(linkedin.get('industry', '')),
-            'linkedinurl': str(linkedin.get('handle', '')),
-            'facebookurl': str(facebook.get('handle', '')),
-            'instagramurl': '',
-            'Twitter': str(twitter.get('handle', '')),
-            'TAX-ID': str(identifiers.get('usEIN', '')),
-            'country': str(location.get('country', ''))
-        }
-    except Exception as e:
-        logging.error(f"Error mapping company data: {str(e)}")
-        # Return empty data with required fields
+    if journal is None or not sinks:
+        return None
+    pending = defaultdict(int)
+    lock = threading.Lock()
+
+    def written(batch: List[Dict[str, Any]]) -> None:
+        completed = []
+        with lock:
+            for record in batch:
+                domain = record.get('domain')
+                pending[domain] += 1
+                if pending[domain] == len(sinks):
+                    del pending[domain]
+                    completed.append(domain)
+        for domain in completed:
+            journal.record(domain, 'upload', True)
+    return written
+
+_STOP = object()
+
+class PipelineStage:
+    def __init__(self, name: str, func: Callable[[Any], Any], workers: int, timed: bool = True):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        # False when the stage's work is timed elsewhere, as fetches and uploads are per request by limited_request
+        self.timed = timed
+        self.queue = None
+        self.in_flight = 0
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def started(self) -> None:
+        with self._lock:
+            self.in_flight += 1
+
+    def finished(self, result: Any = None, error: bool = False) -> None:
+        """Record the outcome of one item handled by the stage."""
+        with self._lock:
+            self.in_flight -= 1
+            if error:
+                self.errors += 1
+            elif result is None or result is False:
+                self.dropped += 1
+            else:
+                self.processed += 1
+
+class StagedPipeline:
+    def __init__(self, stages: List[PipelineStage], queue_size: Optional[int] = None,
+                 stats_interval: Optional[float] = None, report: Optional[Report] = None):
+        self.stages = stages
+        self.report = report
+        self.queue_size = queue_size or CONFIG['PIPELINE']['QUEUE_SIZE']
+        self.stats_interval = stats_interval or CONFIG['PIPELINE']['STATS_INTERVAL']
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Return queue depth and item counters for every stage.
+
+        Returns:
+            Dict[str, Dict[str, int]]: Per stage name, the number of items
+            waiting in its input queue, items being handled, items passed on,
+            items dropped (the stage returned None or False) and errors.
+        """
         return {
-            'company_name': '',
-            'firstCompanyName': '',
-            'street_NO': '',
-            'domain': str(data.get('clean_domain', '')) if isinstance(data, dict) else '',
-            'city': '',
-            'email': '',
-            'linkedin': '',
-            'logo': '',
-            'founded_on': '',
-            'sourcefound': 'agent.ai',
-            'zip': '',
-            'category': '',
-            'slogan': '',
-            'pressphoto': '',
-            'tags': '',
-            'ceo': '',
-            'ceoid': '',
-            'news': '',
-            'awards': '',
-            'futurepredictions': '',
-            'financials': '{}',
-            'Company_Short': '',
-            'phone': '',
-            'Rechtsform': '',
-            'cat-tag-1-trustedshops': '',
-            'cat-tag-2-trustedshops': '',
-            'private-gov': '',
-            'Description': '',
-            'link_agb': '',
-            'link_daten': '',
-            'tag_cat_linkedin': '',
-            'linkedinurl': '',
-            'facebookurl': '',
-            'instagramurl': '',
-            'Twitter': '',
-            'TAX-ID': '',
-            'country': ''
+            stage.name: {
+                'workers': stage.workers,
+                'queued': stage.queue.qsize() if stage.queue is not None else 0,
+                'in_flight': stage.in_flight,
+                'processed': stage.processed,
+                'dropped': stage.dropped,
+                'errors': stage.errors
+            }
+            for stage in self.stages
         }
 
-@backoff.on_exception(
-    backoff.expo,
-    Exception,
-    max_tries=CONFIG['MAX_RETRIES']
-)
-def send_to_server(data: Dict[str, Any], token_manager: TokenManager) -> bool:
-    """Send data to the server with authentication.
+    def log_stats(self) -> None:
+        """Log the stage statistics and, if the pipeline has a report, the run summary."""
+        logging.info(f"Pipeline stats: {json.dumps(self.stats())}")
+        if self.report:
+            logging.info(f"Run report: {json.dumps(self.report.summary())}")
+
+    def _work(self, index: int) -> None:
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            item = stage.queue.get()
+            if item is _STOP:
+                return
+            stage.started()
+            started = time.perf_counter()
+            try:
+                result = stage.func(item)
+            except Exception as e:
+                logging.error(f"Error in {stage.name} stage: {str(e)}")
+                stage.finished(error=True)
+                continue
+            finally:
+                if self.report and stage.timed:
+                    self.report.record_latency(stage.name, time.perf_counter() - started)
+            stage.finished(result)
+            if next_stage is not None and result is not None:
+                # Blocks while the next stage is saturated, which slows this stage down in turn
+                next_stage.queue.put(result)
+
+    def run(self, items: Iterator[Any]) -> None:
+        """Feed items through all stages using worker threads.
+
+        Each stage gets its own bounded input queue and its own number of
+        worker threads. A worker hands its result to the next stage's queue
+        and blocks while that queue is full, so a slow downstream stage
+        propagates backpressure all the way to the input iterator instead of
+        letting intermediate results pile up in memory. A stage function
+        returning None drops the item. The time each stage takes per item is
+        recorded in the report, if one is given. Queue depths and the run
+        summary are logged every `stats_interval` seconds.
+
+        Args:
+            items (Iterator[Any]): The input of the first stage, consumed lazily.
+        """
+        for stage in self.stages:
+            stage.queue = queue.Queue(maxsize=self.queue_size)
+        if self.report:
+            self.report.pipeline = self
+        threads = [
+            [threading.Thread(target=self._work, args=(index,), name=f'{stage.name}-{i}', daemon=True)
+             for i in range(stage.workers)]
+            for index, stage in enumerate(self.stages)
+        ]
+        for thread in (t for stage_threads in threads for t in stage_threads):
+            thread.start()
+
+        done = threading.Event()
+
+        def monitor() -> None:
+            while not done.wait(self.stats_interval):
+                self.log_stats()
+
+        threading.Thread(target=monitor, name='pipeline-monitor', daemon=True).start()
+        try:
+            for item in items:
+                self.stages[0].queue.put(item)
+        finally:
+            # Stop stages in order so each one drains into the next before it is stopped
+            for stage, stage_threads in zip(self.stages, threads):
+                for _ in stage_threads:
+                    stage.queue.put(_STOP)
+                for thread in stage_threads:
+                    thread.join()
+            done.set()
+            logging.info(f"Pipeline finished: {json.dumps(self.stats())}")
+
+    async def _work_async(self, index: int) -> None:
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            item = await stage.queue.get()
+            if item is _STOP:
+                return
+            stage.started()
+            started = time.perf_counter()
+            try:
+                result = await stage.func(item)
+            except Exception as e:
+                logging.error(f"Error in {stage.name} stage: {str(e)}")
+                stage.finished(error=True)
+                continue
+            finally:
+                if self.report and stage.timed:
+                    self.report.record_latency(stage.name, time.perf_counter() - started)
+            stage.finished(result)
+            if next_stage is not None and result is not None:
+                await next_stage.queue.put(result)
+
+    async def run_async(self, items: Iterator[Any]) -> None:
+        """Feed items through all stages using asyncio worker tasks.
+
+        This is the asyncio counterpart of `run`: stage functions must be
+        coroutine functions, queues are `asyncio.Queue` objects and each
+        stage runs its number of worker tasks on the current event loop.
+
+        Args:
+            items (Iterator[Any]): The input of the first stage, consumed lazily.
+        """
+        for stage in self.stages:
+            stage.queue = asyncio.Queue(maxsize=self.queue_size)
+        if self.report:
+            self.report.pipeline = self
+        tasks = [
+            [asyncio.create_task(self._work_async(index)) for _ in range(stage.workers)]
+            for index, stage in enumerate(self.stages)
+        ]
+
+        async def monitor() -> None:
+            while True:
+                await asyncio.sleep(self.stats_interval)
+                self.log_stats()
 
-    This function constructs a curl command to send data to a specified
-    server endpoint. It retrieves an authentication token from the provided
-    TokenManager and includes it in the request headers. The data is sent as
-    URL-encoded form data. If the request is successful, it logs a success
-    message; otherwise, it logs an error message.
+        monitor_task = asyncio.create_task(monitor())
+        try:
+            for item in items:
+                await self.stages[0].queue.put(item)
+        finally:
+            for stage, stage_tasks in zip(self.stages, tasks):
+                for _ in stage_tasks:
+                    await stage.queue.put(_STOP)
+                await asyncio.gather(*stage_tasks)
+            monitor_task.cancel()
+            logging.info(f"Pipeline finished: {json.dumps(self.stats())}")
+
+def process_websites(websites: List[str], token_manager: TokenManager, report: Optional[Report] = None) -> None:
+    """Process websites with concurrent execution.
+
+    This function takes a list of website URLs and processes each website
+    concurrently with `process_stream`. It utilizes a `TokenManager` to
+    manage tokens during the processing of each website. The given report,
+    or a new one, tracks the status and results of each website processed.
 
     Args:
-        data (Dict[str, Any]): A dictionary containing the data to be sent to the server.
-        token_manager (TokenManager): An instance of TokenManager used to retrieve the authentication token.
+        websites (List[str]): A list of website URLs to be processed.
+        token_manager (TokenManager): An instance of TokenManager to manage tokens
+            during the website processing.
+        report (Optional[Report]): The run-level report to update.
 
     Returns:
-        bool: True if the data was successfully sent to the server, False otherwise.
+        None: This function does not return any value.
+    """
+    process_stream(iter(websites), token_manager, report or Report(), fetch_workers=min(CONFIG['MAX_WORKERS'], len(websites) or 1))
+
+def process_stream(websites: Iterator[str], token_manager: TokenManager, report: Report,
+                   fetch_workers: Optional[int] = None, journal: Optional[ProgressJournal] = None,
+                   sinks: Optional[List[RecordSink]] = None) -> None:
+    """Process a stream of websites through the staged thread pipeline.
+
+    Websites are pulled lazily from the iterator and pass through three
+    stages connected by bounded queues: fetching from agent.ai with
+    `call_api`, mapping with `map_company_data` and uploading with
+    `send_to_server`. Each stage has its own worker threads, so the API and
+    the server no longer throttle each other, and a slow upload stage slows
+    the fetchers down through backpressure instead of buffering records.
+    With `CONFIG['BATCH_UPLOAD']['ENABLED']` the upload stage collects
+    records into batches for the bulk endpoint. Mapped records are also
+    written to every sink, and the upload stage is left out when
+    `CONFIG['SINKS']['UPLOAD']` is off. In the incremental mode, records
+    equal to the last uploaded version of their domain are not uploaded.
+
+    Args:
+        websites (Iterator[str]): An iterator of website URLs, consumed lazily.
+        token_manager (TokenManager): An instance of TokenManager to manage tokens
+            during the website processing.
+        report (Report): The report shared by all workers of the run.
+        fetch_workers (Optional[int]): Number of fetch threads, defaults to `CONFIG['MAX_WORKERS']`.
+        journal (Optional[ProgressJournal]): Journal receiving the fetch and upload outcome of every domain.
+        sinks (Optional[List[RecordSink]]): Sinks receiving a copy of every mapped record.
     """
+    settings = CONFIG['PIPELINE']
+
+    def fetch(website: str) -> Optional[Dict[str, Any]]:
+        result = call_api(website, report)
+        record_fetch_outcome(website, result, journal)
+        return result
+
+    def map_record(data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        record = map_company_data(data)
+        for sink in sinks or ():
+            sink.write(record)
+        if CONFIG['SINKS']['UPLOAD'] and skip_unchanged(record, report, journal):
+            return None
+        return record
+
+    stages = [
+        PipelineStage('fetch', fetch, fetch_workers or CONFIG['MAX_WORKERS'], timed=False),
+        PipelineStage('map', map_record, settings['MAP_WORKERS'])
+    ]
+    uploader = None
+    if CONFIG['SINKS']['UPLOAD']:
+        upload, uploader = upload_stage(token_manager, report, journal)
+        stages.append(PipelineStage('upload', upload, settings['UPLOAD_WORKERS'], timed=False))
+    pipeline = StagedPipeline(stages, report=report)
     try:
-        token = token_manager.get_token()
-        
-        command = [
-            'curl', '--location', f'{CONFIG["SERVER_URL"]}/crawler/institution',
-            '--header', 'Content-Type: application/x-www-form-urlencoded',
-            '--header', f'Authorization: {token}',
-            *sum((['--data-urlencode', f'{k}={v}'] for k, v in data.items()), [])
-        ]
-        
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
-        logging.info(f"Successfully sent data to server for company: {data.get('company_name')}")
-        return True
+        pipeline.run(websites)
+    finally:
+        if uploader:
+            uploader.close()
+            logging.info(f"Batch uploads finished: {uploader.sent} records accepted, {uploader.failed} failed")
+        logging.info(f"Run report: {json.dumps(report.summary())}")
 
-    except Exception as e:
-        logging.error(f"Error sending data to server: {str(e)}")
-        return False
+def upload_stage(token_manager: TokenManager, report: Report, journal: Optional[ProgressJournal] = None,
+                 fetched: bool = True) -> tuple[Callable, Optional[BatchUploader]]:
+    """Return the upload function of the thread pipeline and its batch uploader, if batching is enabled.
+
+    Every upload outcome is recorded in the journal and, in the incremental
+    mode, every accepted record in the incremental state. The batch
+    uploader must be closed once the pipeline has finished. `fetched` is
+    False for records replayed from a sink.
+    """
+    on_result = upload_recorder(journal, fetched)
 
-def process_website(website: str, report: Report, token_manager: TokenManager) -> None:
-    """Process a single website and send data to server.
+    def send(data: Dict[str, Any]) -> bool:
+        ok = send_to_server(data, token_manager, report)
+        if on_result:
+            on_result(data, ok)
+        return ok
 
-    This function takes a website URL and a report object, calls an API to
-    retrieve data related to the website, maps the retrieved data to a
-    specific format, and sends the mapped data to a server using the
-    provided token manager. If any error occurs during this process, it logs
-    an error message indicating the failure.
+    if not CONFIG['BATCH_UPLOAD']['ENABLED']:
+        return send, None
+    uploader = BatchUploader(
+        lambda records: send_batch_to_server(records, token_manager, report), on_result=on_result
+    )
+    return uploader.submit, uploader
+
+def replay_records(records: Iterator[Dict[str, Any]], token_manager: TokenManager, report: Report,
+                   journal: Optional[ProgressJournal] = None) -> None:
+    """Upload already mapped records to the server without calling agent.ai.
+
+    The records, typically read back from a sink, go through a pipeline
+    with only the upload stage, so rate limiting, batching, journaling and
+    metrics work as in a normal run.
 
     Args:
-        website (str): The URL of the website to process.
-        report (Report): The report object containing relevant information.
-        token_manager (TokenManager): The token manager used for authentication.
+        records (Iterator[Dict[str, Any]]): Mapped records, consumed lazily.
+        token_manager (TokenManager): An instance of TokenManager to manage tokens.
+        report (Report): The report shared by all workers of the run.
+        journal (Optional[ProgressJournal]): Journal receiving the upload outcome of every domain.
     """
+    upload, uploader = upload_stage(token_manager, report, journal, fetched=False)
+    pipeline = StagedPipeline(
+        [PipelineStage('upload', upload, CONFIG['PIPELINE']['UPLOAD_WORKERS'], timed=False)], report=report
+    )
     try:
-        result = call_api(website, report)
-        if result:
-            mapped_data = map_company_data(result)
-            send_to_server(mapped_data, token_manager)
-    except Exception as e:
-        logging.error(f"Error in process_website for {website}: {str(e)}")
+        pipeline.run(records)
+    finally:
+        if uploader:
+            uploader.close()
+            logging.info(f"Batch uploads finished: {uploader.sent} records accepted, {uploader.failed} failed")
+        logging.info(f"Run report: {json.dumps(report.summary())}")
 
-def process_websites(websites: List[str], token_manager: TokenManager) -> None:
-    """Process websites with concurrent execution.
+class AsyncEngine:
+    def __init__(self, token_manager: TokenManager, max_fetches: Optional[int] = None,
+                 max_uploads: Optional[int] = None, journal: Optional[ProgressJournal] = None,
+                 report: Optional[Report] = None, sinks: Optional[List[RecordSink]] = None):
+        self.token_manager = token_manager
+        self.journal = journal
+        self.report = report or Report()
+        self.sinks = sinks or []
+        self.max_fetches = max_fetches or CONFIG['ASYNC']['MAX_INFLIGHT_FETCHES']
+        self.max_uploads = max_uploads or CONFIG['ASYNC']['MAX_INFLIGHT_UPLOADS']
+        # Each service has its own host, so every in-flight request of a stage can hold a connection
+        pool_size = max(CONFIG['HTTP']['POOL_SIZE'], self.max_fetches, self.max_uploads)
+        self.client = create_async_http_client(dict(CONFIG['HTTP'], POOL_SIZE=pool_size))
+        self.record_upload = upload_recorder(journal)
 
-    This function takes a list of website URLs and processes each website
-    concurrently using a thread pool. It utilizes a `TokenManager` to manage
-    tokens during the processing of each website. A report is generated
-    during the processing, which can be used to track the status and results
-    of each website processed.
+    async def call_api(self, website: str) -> Optional[Dict[str, Any]]:
+        """Call the agent.ai API for a website without blocking the event loop.
+
+        This is the asyncio counterpart of the module-level `call_api`. It
+        uses the response cache in the same way, waits for the API rate limiter,
+        posts the request through the engine's async transport and validates
+        the response with `handle_api_response`. Cache lookups, and handling
+        the response with its cache and dead-letter writes, run in the default
+        executor so they do not block the event loop.
+
+        Args:
+            website (str): The website URL to be processed.
+
+        Returns:
+            Optional[Dict[str, Any]]: A dictionary containing the API response data if successful,
+            or None if there was an error.
+        """
+        try:
+            clean_website, full_url = clean_domain(website)
+            cache = get_response_cache()
+            # Cache lookups and writes are blocking SQLite calls, so they run in the default executor
+            entry = await asyncio.to_thread(cache.get, clean_website) if cache else None
+            if entry is not None and entry.fresh:
+                self.report.record_cache('hit')
+                return handle_cached_response(website, clean_website, full_url, entry, self.report)
+            if cache:
+                self.report.record_cache('miss')
+
+            try:
+                response = await limited_request_async(
+                    get_rate_limiter('api'), self.client, 'POST', CONFIG['API_URL'],
+                    headers=CONFIG['HEADERS'], body=build_api_payload(clean_website), report=self.report,
+                    validate=api_payload_ok
+                )
+            except TransportError as e:
+                return await asyncio.to_thread(
+                    handle_fetch_error, website, clean_website, full_url, e, cache, entry, self.report
+                )
+            return await asyncio.to_thread(
+                handle_fetched_response, website, clean_website, full_url, response, cache, entry, self.report
+            )
+
+        except Exception as e:
+            logging.error("Error calling API for %s: %s", website, e, extra={'domain': clean_website, 'stage': 'fetch'})
+            self.report.update(success=False, domain=clean_website)
+            return None
+
+    async def send_to_server(self, data: Dict[str, Any]) -> bool:
+        """Upload a mapped record to the server without blocking the event loop.
+
+        Args:
+            data (Dict[str, Any]): A dictionary containing the data to be sent to the server.
+
+        Returns:
+            bool: True if the data was successfully sent to the server, False otherwise.
+        """
+        try:
+            response = await authorized_request_async(
+                self.token_manager, self.client, lambda token: build_upload_request(data, token), self.report
+            )
+            return handle_upload_response(data, response, self.report)
+
+        except Exception as e:
+            return handle_upload_error(data, e, self.report)
+
+    async def send_batch_to_server(self, records: List[Dict[str, Any]]) -> List[bool]:
+        """Send several records to the bulk endpoint without blocking the event loop.
+
+        This is the asyncio counterpart of the module-level
+        `send_batch_to_server`; only failed records are resent.
+
+        Args:
+            records (List[Dict[str, Any]]): The mapped records to upload.
+
+        Returns:
+            List[bool]: Whether each record was accepted, in the order given.
+        """
+        outcomes = [False] * len(records)
+        pending = list(range(len(records)))
+        for attempt in itertools.count(1):
+            batch = [records[i] for i in pending]
+            try:
+                response = await authorized_request_async(
+                    self.token_manager, self.client, lambda token: build_batch_upload_request(batch, token),
+                    self.report
+                )
+            except Exception as e:
+                failure, error = batch_upload_failed(batch, e)
+                break
+            pending, failure, error = apply_batch_upload_response(records, pending, outcomes, response)
+            delay = retry_delay(failure, attempt) if pending and failure == 'client_error' else None
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+        for i in pending:
+            record_dead_letter(
+                self.report, records[i].get('domain'), records[i].get('domain'), 'upload', failure, error
+            )
+        logging.info(f"Batch upload: {len(records) - len(pending)} of {len(records)} records accepted")
+        return outcomes
+
+    async def fetch(self, website: str) -> Optional[Dict[str, Any]]:
+        """Run the fetch stage for a website and journal its outcome."""
+        result = await self.call_api(website)
+        record_fetch_outcome(website, result, self.journal)
+        return result
+
+    async def map_company_data(self, data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Map an API response on the event loop for the mapping stage and write it to the sinks.
+
+        The sinks are written from a worker thread, since every
+        `BATCH_SIZE` records one of them compresses or commits a whole
+        batch. In the incremental mode, a record equal to the last uploaded
+        version of its domain is dropped instead of being uploaded.
+        """
+        record = map_company_data(data)
+        if self.sinks:
+            await asyncio.to_thread(self._write_sinks, record)
+        # The lookup of the last uploaded version is a blocking SQLite query
+        if (CONFIG['SINKS']['UPLOAD'] and get_import_state()
+                and await asyncio.to_thread(skip_unchanged, record, self.report, self.journal)):
+            return None
+        return record
+
+    def _write_sinks(self, record: Dict[str, Any]) -> None:
+        for sink in self.sinks:
+            sink.write(record)
+
+    async def upload(self, data: Dict[str, Any]) -> bool:
+        """Run the upload stage for a record and record its outcome."""
+        ok = await self.send_to_server(data)
+        if self.record_upload:
+            self.record_upload(data, ok)
+        return ok
+
+    async def process_websites(self, websites: List[str]) -> None:
+        """Process a list of websites concurrently on the event loop.
+
+        Args:
+            websites (List[str]): A list of website URLs to be processed.
+        """
+        await self.process_stream(iter(websites))
+
+    async def process_stream(self, websites: Iterator[str]) -> None:
+        """Process a stream of websites through the staged asyncio pipeline.
+
+        This is the asyncio counterpart of `process_stream`. The fetch and
+        upload stages run `max_fetches` and `max_uploads` worker tasks, so
+        in-flight API requests and in-flight uploads are capped separately,
+        and the bounded queues between the stages provide backpressure.
+
+        Args:
+            websites (Iterator[str]): An iterator of website URLs, consumed lazily.
+        """
+        uploader = None
+        upload = self.upload
+        if CONFIG['BATCH_UPLOAD']['ENABLED']:
+            uploader = AsyncBatchUploader(self.send_batch_to_server, on_result=self.record_upload)
+            upload = uploader.submit
+        stages = [
+            PipelineStage('fetch', self.fetch, self.max_fetches, timed=False),
+            PipelineStage('map', self.map_company_data, CONFIG['PIPELINE']['MAP_WORKERS'])
+        ]
+        if CONFIG['SINKS']['UPLOAD']:
+            stages.append(PipelineStage('upload', upload, self.max_uploads, timed=False))
+        pipeline = StagedPipeline(stages, report=self.report)
+        try:
+            await pipeline.run_async(websites)
+        finally:
+            if uploader:
+                await uploader.close()
+                logging.info(f"Batch uploads finished: {uploader.sent} records accepted, {uploader.failed} failed")
+            logging.info(f"Run report: {json.dumps(self.report.summary())}")
+
+    async def close(self) -> None:
+        """Release the engine's pooled connections."""
+        await self.client.close()
+
+async def process_stream_async(websites: Iterator[str], token_manager: TokenManager,
+                               journal: Optional[ProgressJournal] = None, report: Optional[Report] = None,
+                               sinks: Optional[List[RecordSink]] = None) -> None:
+    """Process a stream of websites with the asyncio engine.
+
+    A single `AsyncEngine`, and with it a single connection pool, is used for the
+    whole run; the rate limiters are shared with the rest of the process.
 
     Args:
-        websites (List[str]): A list of website URLs to be processed.
+        websites (Iterator[str]): An iterator of website URLs, consumed lazily.
         token_manager (TokenManager): An instance of TokenManager to manage tokens
             during the website processing.
+        journal (Optional[ProgressJournal]): Journal receiving the fetch and upload outcome of every domain.
+        report (Optional[Report]): The run-level report to update.
+        sinks (Optional[List[RecordSink]]): Sinks receiving a copy of every mapped record.
+    """
+    engine = AsyncEngine(token_manager, journal=journal, report=report, sinks=sinks)
+    try:
+        await engine.process_stream(websites)
+    finally:
+        await engine.close()
+
+COMPRESSION_SUFFIXES = {'.gz': 'gzip', '.zst': 'zstd', '.zstd': 'zstd'}
+FORMAT_SUFFIXES = {
+    '.csv': 'csv', '.tsv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson',
+    '.parquet': 'parquet', '.txt': 'text'
+}
+
+def detect_input_format(path: str) -> tuple[str, Optional[str]]:
+    """Return the format and compression of an input file from its name.
+
+    For example `urls.ndjson.zst` is ('ndjson', 'zstd') and `urls.csv` is
+    ('csv', None). Unknown extensions are read as plain text, one URL per line.
+    """
+    root, ext = os.path.splitext(path.lower())
+    compression = COMPRESSION_SUFFIXES.get(ext)
+    if compression:
+        root, ext = os.path.splitext(root)
+    return FORMAT_SUFFIXES.get(ext, 'text'), compression
+
+def iter_lines(path: str, compression: Optional[str] = None, encoding: str = 'utf-8') -> Iterator[str]:
+    """Yield the decoded lines of a file, newline included.
+
+    Uncompressed files are memory-mapped and read sequentially, so large
+    inputs are paged in by the OS without copying them through a read
+    buffer. gzip files use the standard library; zstd files need the
+    optional `zstandard` package, which is only imported for them. A
+    leading byte order mark is dropped.
+
+    Args:
+        path (str): Path to the file.
+        compression (Optional[str]): None, 'gzip' or 'zstd'.
+        encoding (str): Text encoding of the file.
+
+    Yields:
+        str: One line of the file.
+    """
+    with open(path, 'rb') as raw:
+        if compression == 'gzip':
+            import gzip
+            lines = gzip.GzipFile(fileobj=raw)
+        elif compression == 'zstd':
+            import io
+            import zstandard  # optional dependency, only needed for .zst inputs
+            lines = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw))
+        elif os.fstat(raw.fileno()).st_size == 0:
+            return
+        else:
+            import mmap
+            lines = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(lines, 'madvise'):
+                lines.madvise(mmap.MADV_SEQUENTIAL)
+        with lines:
+            # Decode in large blocks and split them, which is much cheaper per
+            # row than reading and decoding one line at a time
+            decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+            pending = ''
+            first = True
+            while True:
+                block = lines.read(1 << 20)
+                text = pending + decoder.decode(block, final=not block)
+                if first and text:
+                    text = text.lstrip('\ufeff')
+                    first = False
+                rows = text.split('\n')
+                pending = rows.pop()
+                for row in rows:
+                    yield row + '\n'
+                if not block:
+                    break
+            if pending:
+                yield pending
+
+def read_csv_column(path: str, column: Any = 0, compression: Optional[str] = None,
+                    encoding: str = 'utf-8') -> Iterator[str]:
+    """Yield one column of a CSV or TSV file with a header row.
+
+    Args:
+        path (str): Path to the file.
+        column (Any): Column name, or zero-based column index.
+        compression (Optional[str]): None, 'gzip' or 'zstd'.
+        encoding (str): Text encoding of the file.
+
+    Yields:
+        str: The value of the column in each row.
+    """
+    delimiter = '\t' if '.tsv' in path.lower() else ','
+    lines = iter_lines(path, compression, encoding)
+
+    def rows() -> Iterator[List[str]]:
+        for line in lines:
+            if '"' in line:
+                # Quoted fields, possibly spanning lines, go through the csv module
+                yield next(csv.reader(itertools.chain((line,), lines), delimiter=delimiter))
+            else:
+                yield line.rstrip('\r\n').split(delimiter)
+
+    reader = rows()
+    header = next(reader, None)
+    if header is None:
+        return
+    if isinstance(column, str):
+        if column not in header:
+            raise ValueError(f"Column {column!r} not found in {path}, columns are {header}")
+        index = header.index(column)
+    else:
+        index = column
+    for row in reader:
+        if len(row) > index:
+            yield row[index]
+
+def read_ndjson_field(path: str, column: Any = 0, compression: Optional[str] = None,
+                      encoding: str = 'utf-8') -> Iterator[str]:
+    """Yield one field of every object in an NDJSON file.
+
+    Lines holding a JSON string are yielded as is. For objects, `column`
+    names the field, or gives its position when it is an index. Lines that
+    are not valid JSON are logged and skipped.
+    """
+    for number, line in enumerate(iter_lines(path, compression, encoding), 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            logging.error(f"Skipping invalid JSON on line {number} of {path}: {str(e)}")
+            continue
+        if isinstance(record, dict):
+            if isinstance(column, str):
+                record = record.get(column)
+            else:
+                record = next(itertools.islice(record.values(), column, None), None)
+        if isinstance(record, str):
+            yield record
+
+def read_text_lines(path: str, column: Any = 0, compression: Optional[str] = None,
+                    encoding: str = 'utf-8') -> Iterator[str]:
+    """Yield every line of a plain text file, one URL per line."""
+    yield from iter_lines(path, compression, encoding)
+
+def read_parquet_column(path: str, column: Any = 0, compression: Optional[str] = None,
+                        encoding: str = 'utf-8', batch_size: int = 5000) -> Iterator[str]:
+    """Yield one column of a Parquet file, reading it one row batch at a time.
+
+    Requires the optional `pyarrow` package, which is only imported here.
+    """
+    import pyarrow.parquet as pq  # optional dependency, only needed for Parquet inputs
+    parquet_file = pq.ParquetFile(path)
+    name = column if isinstance(column, str) else parquet_file.schema_arrow.names[column]
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=[name]):
+        yield from (value for value in batch.column(0).to_pylist() if value is not None)
+
+INPUT_READERS: Dict[str, Callable[..., Iterator[str]]] = {
+    'csv': read_csv_column,
+    'ndjson': read_ndjson_field,
+    'text': read_text_lines,
+    'parquet': read_parquet_column
+}
+
+def iter_websites(path: str, chunk_size: int = 5000, input_format: Optional[str] = None,
+                  column: Any = None) -> Iterator[str]:
+    """Read website URLs lazily from an input file.
+
+    The reader is chosen from `INPUT_READERS` by `input_format`, defaulting
+    to `CONFIG['INPUT']['FORMAT']` or, if that is unset, the file extension
+    (see `detect_input_format`). Rows are streamed one at a time, so memory
+    use does not depend on the file size. Blank values are skipped and
+    surrounding whitespace is removed.
+
+    Args:
+        path (str): Path to the input file.
+        chunk_size (int): Number of rows between progress log lines.
+        input_format (Optional[str]): 'csv', 'ndjson', 'text' or 'parquet'.
+        column (Any): Column name or index, defaults to `CONFIG['INPUT']['COLUMN']`.
+
+    Yields:
+        str: A website URL.
+    """
+    settings = CONFIG['INPUT']
+    detected_format, compression = detect_input_format(path)
+    input_format = input_format or settings['FORMAT'] or detected_format
+    column = settings['COLUMN'] if column is None else column
+    reader = INPUT_READERS[input_format](path, column, compression, settings['ENCODING'])
+    count = 0
+    for value in reader:
+        website = value.strip()
+        if not website:
+            continue
+        count += 1
+        if count % chunk_size == 0:
+            logging.info(f"Read {count} websites from {path}")
+        yield website
+    logging.info(f"Finished reading {count} websites from {path}")
+
+def render_metrics(report: Report, token_manager: Optional[TokenManager] = None) -> str:
+    """Render the run's metrics in the Prometheus text exposition format.
+
+    Args:
+        report (Report): The run-level report.
+        token_manager (Optional[TokenManager]): The token manager, for the refresh count.
 
     Returns:
-        None: This function does not return any value.
+        str: The metrics, one sample per line.
+    """
+    counters = report.counters()
+    summary = report.summary()
+    lines = []
+
+    def metric(name: str, kind: str, help_text: str, samples: List[tuple]) -> None:
+        lines.append(f'# HELP importer_{name} {help_text}')
+        lines.append(f'# TYPE importer_{name} {kind}')
+        for labels, value in samples:
+            label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f'importer_{name}{{{label_text}}} {value}' if label_text else f'importer_{name} {value}')
+
+    metric('requests_total', 'counter', 'agent.ai lookups by outcome.', [
+        ({'outcome': 'success'}, counters['success_count']),
+        ({'outcome': 'error'}, counters['error_count'])
+    ])
+    metric('requests_per_second', 'gauge', 'Average lookups per second since the run started.',
+           [({}, summary['requests_per_second'])])
+    metric('cache_lookups_total', 'counter', 'Response cache lookups by result.', [
+        ({'result': 'hit'}, counters['cache_hit']),
+        ({'result': 'miss'}, counters['cache_miss']),
+        ({'result': 'stale'}, counters['cache_stale'])
+    ])
+    lookups = counters['cache_hit'] + counters['cache_miss']
+    metric('cache_hit_ratio', 'gauge', 'Fraction of cache lookups served from a fresh entry.',
+           [({}, round(counters['cache_hit'] / lookups, 4) if lookups else 0)])
+    metric('incremental_skipped_total', 'counter', 'Fetches and uploads skipped by the incremental mode.', [
+        ({'reason': 'fresh'}, counters['incremental_fresh']),
+        ({'reason': 'unchanged'}, counters['incremental_unchanged'])
+    ])
+    metric('rate_limit_wait_seconds_total', 'counter', 'Time spent waiting for each rate limiter.',
+           [({'bucket': bucket}, round(counters[f'rate_limit_wait_seconds_{bucket}'], 3))
+            for bucket in ('api', 'server')])
+    metric('throttled_responses_total', 'counter', 'HTTP 429 responses by rate limiter.',
+           [({'bucket': bucket}, counters[f'throttled_{bucket}']) for bucket in ('api', 'server')])
+    metric('rate_limit_rate', 'gauge', 'Current adaptive rate of each rate limiter in calls per second.',
+           [({'bucket': name}, round(bucket.rate, 3)) for name, bucket in sorted(_rate_limiters.items())])
+    metric('failed_attempts_total', 'counter', 'Failed request attempts by rate limiter and failure class.',
+           [({'bucket': bucket, 'class': failure}, counters[f'failure_{bucket}_{failure}'])
+            for bucket in ('api', 'server') for failure in FAILURE_CLASSES if failure != 'circuit_open'])
+    metric('circuit_state', 'gauge', 'Circuit breaker state per host: 0 closed, 1 half-open, 2 open.',
+           [({'host': name}, CircuitBreaker.STATES[breaker.state]) for name, breaker in sorted(_circuit_breakers.items())])
+    metric('dead_letters_total', 'counter', 'Domains written to the dead-letter file.',
+           [({}, counters['dead_letters'])])
+    metric('retries_total', 'counter', 'Operations by number of retries needed.',
+           [({'retries': retries}, count) for retries, count in report.retry_histogram().items()])
+    if token_manager is not None:
+        metric('token_refreshes_total', 'counter', 'Authentication token refreshes.',
+               [({}, token_manager.refresh_count)])
+
+    if report.pipeline is not None:
+        stats = report.pipeline.stats()
+        metric('stage_queue_depth', 'gauge', 'Items waiting in the input queue of each stage.',
+               [({'stage': name}, stage['queued']) for name, stage in stats.items()])
+        metric('stage_in_flight', 'gauge', 'Items currently being handled by each stage.',
+               [({'stage': name}, stage['in_flight']) for name, stage in stats.items()])
+        metric('stage_workers', 'gauge', 'Workers of each stage.',
+               [({'stage': name}, stage['workers']) for name, stage in stats.items()])
+        metric('stage_items_total', 'counter', 'Items handled by each stage by outcome.',
+               [({'stage': name, 'outcome': outcome}, stage[outcome])
+                for name, stage in stats.items() for outcome in ('processed', 'dropped', 'errors')])
+
+    lines.append('# HELP importer_stage_latency_seconds Time of each map call and of each fetch and upload HTTP request.')
+    lines.append('# TYPE importer_stage_latency_seconds histogram')
+    for stage in report.stages():
+        histogram = report.latency_histogram(stage)
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, histogram):
+            cumulative += count
+            lines.append(f'importer_stage_latency_seconds_bucket{{stage="{stage}",le="{bound:.6g}"}} {cumulative}')
+        cumulative += histogram[-1]
+        lines.append(f'importer_stage_latency_seconds_bucket{{stage="{stage}",le="+Inf"}} {cumulative}')
+        lines.append(f'importer_stage_latency_seconds_sum{{stage="{stage}"}} {counters[f"latency_sum_{stage}"]:.6f}')
+        lines.append(f'importer_stage_latency_seconds_count{{stage="{stage}"}} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+def progress_snapshot(report: Report, token_manager: Optional[TokenManager] = None) -> Dict[str, Any]:
+    """Return the run summary, stage statistics and token refreshes as one dictionary."""
+    snapshot = {'timestamp': datetime.now().isoformat(timespec='seconds'), 'report': report.summary()}
+    if report.pipeline is not None:
+        snapshot['pipeline'] = report.pipeline.stats()
+    if token_manager is not None:
+        snapshot['token_refreshes'] = token_manager.refresh_count
+    return snapshot
+
+class MetricsExporter:
+    def __init__(self, report: Report, token_manager: Optional[TokenManager] = None,
+                 port: Optional[int] = None, snapshot_path: Optional[str] = None,
+                 snapshot_interval: Optional[float] = None):
+        settings = CONFIG['METRICS']
+        self.report = report
+        self.token_manager = token_manager
+        self.port = port if port is not None else settings['PORT']
+        self.snapshot_path = snapshot_path if snapshot_path is not None else settings['SNAPSHOT_PATH']
+        self.snapshot_interval = snapshot_interval or settings['SNAPSHOT_INTERVAL']
+        self._server = None
+        self._stop = threading.Event()
+        self._snapshot_thread = None
+
+    def start(self) -> 'MetricsExporter':
+        """Start the metrics endpoint and the snapshot writer, as configured.
+
+        The HTTP endpoint serves the Prometheus metrics at `/metrics` and the
+        JSON snapshot at `/snapshot` on localhost. It only runs if a port is
+        configured. Snapshots are written to disk only if a snapshot path is
+        configured.
+
+        Returns:
+            MetricsExporter: The exporter itself.
+        """
+        if self.port:
+            exporter = self
+
+            class MetricsHandler(BaseHTTPRequestHandler):
+                def do_GET(self) -> None:
+                    path = self.path.split('?', 1)[0]
+                    if path == '/metrics':
+                        body = render_metrics(exporter.report, exporter.token_manager).encode('utf-8')
+                        content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                    elif path == '/snapshot':
+                        body = json.dumps(progress_snapshot(exporter.report, exporter.token_manager)).encode('utf-8')
+                        content_type = 'application/json'
+                    else:
+                        self.send_error(404)
+                        return
+                    self.send_response(200)
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format: str, *args: Any) -> None:
+                    pass
+
+            self._server = ThreadingHTTPServer(('127.0.0.1', self.port), MetricsHandler)
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever, name='metrics-server', daemon=True).start()
+            logging.info(f"Serving metrics on http://127.0.0.1:{self._server.server_address[1]}/metrics")
+        if self.snapshot_path:
+            self._snapshot_thread = threading.Thread(
+                target=self._write_snapshots, name='metrics-snapshot', daemon=True
+            )
+            self._snapshot_thread.start()
+        return self
+
+    def write_snapshot(self) -> None:
+        """Write the current progress snapshot to `snapshot_path` atomically."""
+        tmp_path = f'{self.snapshot_path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(progress_snapshot(self.report, self.token_manager), f, indent=2)
+        os.replace(tmp_path, self.snapshot_path)
+
+    def _write_snapshots(self) -> None:
+        while not self._stop.wait(self.snapshot_interval):
+            try:
+                self.write_snapshot()
+            except OSError as e:
+                logging.error(f"Error writing progress snapshot: {str(e)}")
+
+    def stop(self) -> None:
+        """Write a final snapshot and shut the endpoint down."""
+        self._stop.set()
+        if self._snapshot_thread:
+            self._snapshot_thread.join()
+            self.write_snapshot()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+def build_input(path: str, journal: ProgressJournal, resume: bool = False,
+                shard: int = 0, shards: int = 1, report: Optional[Report] = None) -> Iterator[str]:
+    """Return the websites still to be processed, read lazily from the input file.
+
+    When resuming, domains that failed last time are requeued ahead of the
+    input file and completed domains are skipped. Duplicate domains are
+    dropped if `CONFIG['DEDUP']['ENABLED']` is set. With several shards only
+    the websites whose domain belongs to `shard` are returned. In the
+    incremental mode only domains due for a fetch are returned, oldest first.
+
+    Args:
+        path (str): Path to the input file containing the URLs.
+        journal (ProgressJournal): The journal of this run (or shard).
+        resume (bool): Whether a previous run is being continued.
+        shard (int): The shard to select.
+        shards (int): The total number of shards.
+        report (Optional[Report]): The report counting domains skipped by the incremental mode.
+
+    Returns:
+        Iterator[str]: An iterator of website URLs.
+    """
+    websites = iter_websites(path)
+    if shards > 1:
+        websites = select_shard(websites, shard, shards)
+    if resume:
+        # Requeue domains that failed last time ahead of the input file
+        websites = itertools.chain(sorted(journal.failed), websites)
+    if CONFIG['DEDUP']['ENABLED']:
+        websites = DomainDeduplicator(is_done=journal.is_completed if resume else None).filter(websites)
+    elif resume:
+        websites = (website for website in websites if not journal.is_completed(clean_domain(str(website))[0]))
+    state = get_import_state()
+    if state:
+        websites = state.select_due(websites, report)
+    return websites
+
+def run_engine(engine: str, websites: Iterator[str], token_manager: TokenManager,
+               journal: ProgressJournal, report: Report) -> None:
+    """Process websites with the 'thread' or 'async' engine, writing to the sinks in `CONFIG['SINKS']`."""
+    sinks = [create_sink(spec) for spec in CONFIG['SINKS']['OUTPUTS']]
+    if not CONFIG['SINKS']['UPLOAD']:
+        on_written = sink_recorder(journal, sinks)
+        for sink in sinks:
+            sink.on_written = on_written
+    try:
+        if engine == 'async':
+            asyncio.run(process_stream_async(websites, token_manager, journal, report, sinks))
+        else:
+            process_stream(websites, token_manager, report, journal=journal, sinks=sinks)
+    finally:
+        for sink in sinks:
+            sink.close()
+            logging.info(f"Wrote {sink.written} records to {type(sink).__name__}")
+
+def replay(spec: str, token_manager: TokenManager, journal: ProgressJournal, report: Report,
+           resume: bool = False) -> None:
+    """Upload the records stored in a sink to the server.
+
+    When resuming, records whose domain the journal lists as uploaded are
+    skipped, and in the incremental mode records equal to the last
+    uploaded version of their domain.
+
+    Args:
+        spec (str): The 'kind:path' specification of the sink to read.
+        token_manager (TokenManager): An instance of TokenManager to manage tokens.
+        journal (ProgressJournal): Journal receiving the upload outcome of every domain.
+        report (Report): The run-level report to update.
+        resume (bool): Whether a previous replay is being continued.
+    """
+    sink = create_sink(spec)
+    try:
+        records = sink.read()
+        if resume:
+            records = (record for record in records if not journal.is_completed(record.get('domain', '')))
+        if get_import_state():
+            records = (record for record in records if not skip_unchanged(record, report, journal, fetched=False))
+        replay_records(records, token_manager, report, journal)
+    finally:
+        sink.close()
+
+def shard_of(domain: str, shards: int) -> int:
+    """Return the shard a clean domain belongs to.
+
+    The shard is derived from a BLAKE2 hash of the domain rather than
+    `hash()`, which is salted per process, so a domain maps to the same
+    shard in every process and every run with the same number of shards.
+    """
+    return int.from_bytes(hashlib.blake2b(domain.encode('utf-8'), digest_size=8).digest(), 'big') % shards
+
+def select_shard(websites: Iterator[str], shard: int, shards: int) -> Iterator[str]:
+    """Yield the websites whose clean domain belongs to `shard`."""
+    for website in websites:
+        if shard_of(clean_domain(str(website))[0], shards) == shard:
+            yield website
+
+def shard_path(path: str, shard: int, shards: int) -> str:
+    """Return the per-shard variant of a file path, such as the progress journal."""
+    return f'{path}.shard-{shard}-of-{shards}'
+
+def split_budget(shards: int) -> None:
+    """Scale the rate limits and concurrency in `CONFIG` down to one shard's share.
+
+    Rate limits are only divided when the buckets are not shared through
+    `RATE_LIMIT['STATE_DIR']`; shared buckets already hold the combined
+    budget of all processes.
+    """
+    if not CONFIG['RATE_LIMIT']['STATE_DIR']:
+        for name in ('API', 'SERVER'):
+            limits = CONFIG['RATE_LIMIT'][name]
+            limits['MAX_RATE'] = (limits['MAX_RATE'] or limits['RATE']) / shards
+            limits['RATE'] /= shards
+            limits['MIN_RATE'] /= shards
+            limits['BURST'] = max(1, limits['BURST'] / shards)
+    CONFIG['MAX_WORKERS'] = max(1, CONFIG['MAX_WORKERS'] // shards)
+    CONFIG['PIPELINE']['UPLOAD_WORKERS'] = max(1, CONFIG['PIPELINE']['UPLOAD_WORKERS'] // shards)
+    for key in ('MAX_INFLIGHT_FETCHES', 'MAX_INFLIGHT_UPLOADS'):
+        CONFIG['ASYNC'][key] = max(1, CONFIG['ASYNC'][key] // shards)
+
+def run_shard(shard: int, shards: int, config: Dict[str, Any], args: argparse.Namespace, updates) -> None:
+    """Process one shard of the input in a worker process started by `run_sharded`.
+
+    The worker runs its own engine, token manager, progress journal,
+    dead-letter file and log file (`shard_path` of their paths) with its
+    share of the rate budget.
+    It sends its exported report to the coordinator every
+    `SHARDS['REPORT_INTERVAL']` seconds and once more when it finishes.
+
+    Args:
+        shard (int): The shard to process.
+        shards (int): The total number of shards.
+        config (Dict[str, Any]): The coordinator's `CONFIG`, including command line overrides.
+        args (argparse.Namespace): The parsed command line options.
+        updates: A multiprocessing queue receiving `(shard, report state, finished)` tuples.
     """
+    CONFIG.update(config)
+    CONFIG['LOGGING']['PATH'] = shard_path(CONFIG['LOGGING']['PATH'] or LOG_PATH, shard, shards)
+    configure_logging()
+    split_budget(shards)
     report = Report()
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=CONFIG['MAX_WORKERS']) as executor:
-        futures = [
-            executor.submit(process_website, website, report, token_manager)
-            for website in websites
-        ]
-        concurrent.futures.wait(futures)
+    stop = threading.Event()
+
+    def publish() -> None:
+        while not stop.wait(CONFIG['SHARDS']['REPORT_INTERVAL']):
+            updates.put((shard, report.export(), False))
+
+    publisher = threading.Thread(target=publish, name='shard-report', daemon=True)
+    publisher.start()
+    token_manager = TokenManager()
+    journal = None
+    if CONFIG['DEAD_LETTER']['PATH']:
+        CONFIG['DEAD_LETTER']['PATH'] = shard_path(CONFIG['DEAD_LETTER']['PATH'], shard, shards)
+    try:
+        token_manager.get_token()
+        journal = ProgressJournal(shard_path(CONFIG['JOURNAL']['PATH'], shard, shards), resume=args.resume)
+        get_dead_letters()
+        run_engine(args.engine, build_input(args.input, journal, args.resume, shard, shards, report),
+                   token_manager, journal, report)
+    except Exception as e:
+        logging.error(f"Shard {shard} of {shards} failed: {str(e)}")
+        raise
+    finally:
+        stop.set()
+        publisher.join()
+        if journal:
+            journal.close()
+        close_dead_letters()
+        close_import_state()
+        token_manager.close()
+        updates.put((shard, report.export(), True))
+        shutdown_logging()
 
-def main() -> None:
+def run_sharded(args: argparse.Namespace, shards: int, report: Report) -> None:
+    """Split the input between `shards` worker processes and wait for them.
+
+    Websites are assigned to workers by `shard_of` their clean domain, so a
+    resumed run with the same number of processes sends every domain back
+    to the shard whose journal knows it. The workers' report updates are
+    merged into `report` as they arrive. Once all workers have exited,
+    their journals are merged into the journal path and their dead-letter
+    files into the dead-letter path.
+
+    Args:
+        args (argparse.Namespace): The parsed command line options.
+        shards (int): The number of worker processes.
+        report (Report): The run-level report receiving the merged metrics.
+
+    Raises:
+        RuntimeError: If a worker process failed.
+    """
+    # Spawn rather than fork: the coordinator already runs threads (metrics, token refresh)
+    context = multiprocessing.get_context('spawn')
+    updates = context.Queue()
+    processes = [
+        context.Process(target=run_shard, args=(shard, shards, CONFIG, args, updates), name=f'shard-{shard}')
+        for shard in range(shards)
+    ]
+    for process in processes:
+        process.start()
+    logging.info(f"Started {shards} shard processes")
+
+    finished = set()
+    while len(finished) < shards:
+        try:
+            shard, state, done = updates.get(timeout=1)
+        except queue.Empty:
+            if not any(process.is_alive() for process in processes):
+                break
+            continue
+        report.absorb(f'shard-{shard}', state)
+        if done:
+            finished.add(shard)
+    for process in processes:
+        process.join()
+
+    journal_path = CONFIG['JOURNAL']['PATH']
+    merge_journals([shard_path(journal_path, shard, shards) for shard in range(shards)], journal_path)
+    dead_letter_path = CONFIG['DEAD_LETTER']['PATH']
+    if dead_letter_path:
+        shard_paths = [shard_path(dead_letter_path, shard, shards) for shard in range(shards)]
+        merge_journals(shard_paths, dead_letter_path)
+        for path in shard_paths:
+            if os.path.exists(path):
+                os.remove(path)
+    logging.info(f"Run report: {json.dumps(report.summary())}")
+    failed = [process.name for process in processes if process.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Shard processes failed: {', '.join(failed)}")
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse the command line options of the importer."""
+    parser = argparse.ArgumentParser(description="Import company data from agent.ai into the crawler server.")
+    parser.add_argument('--input', default='urls.csv',
+                        help="Input file: CSV/TSV, NDJSON, plain text or Parquet, optionally .gz or .zst compressed")
+    parser.add_argument('--input-format', choices=sorted(INPUT_READERS), default=CONFIG['INPUT']['FORMAT'],
+                        help="Input format, detected from the file name by default")
+    parser.add_argument('--column', default=CONFIG['INPUT']['COLUMN'],
+                        help="Column name or zero-based index holding the URLs")
+    parser.add_argument('--engine', choices=['thread', 'async'], default='thread',
+                        help="Concurrency engine: thread pool or asyncio event loop")
+    parser.add_argument('--transport', choices=['native', 'curl'], default=CONFIG['HTTP']['TRANSPORT'],
+                        help="HTTP transport: pooled in-process client or curl subprocesses")
+    parser.add_argument('--no-cache', dest='cache', action='store_false', default=CONFIG['CACHE']['ENABLED'],
+                        help="Always call the API instead of using the response cache")
+    parser.add_argument('--cache-path', default=CONFIG['CACHE']['PATH'], help="SQLite file of the response cache")
+    parser.add_argument('--no-dedup', dest='dedup', action='store_false', default=CONFIG['DEDUP']['ENABLED'],
+                        help="Process every input row even if its domain was already seen")
+    parser.add_argument('--journal', default=CONFIG['JOURNAL']['PATH'], help="Progress journal file")
+    parser.add_argument('--incremental', action='store_true', default=CONFIG['INCREMENTAL']['ENABLED'],
+                        help="Fetch only domains not fetched within --max-age, oldest first, "
+                             "and upload only records that changed since their last upload")
+    parser.add_argument('--max-age', type=float, default=CONFIG['INCREMENTAL']['MAX_AGE'],
+                        help="Seconds after which the incremental mode fetches a domain again")
+    parser.add_argument('--state-path', default=CONFIG['INCREMENTAL']['PATH'],
+                        help="SQLite file with the last fetch time and uploaded record hash per domain")
+    start = parser.add_mutually_exclusive_group()
+    start.add_argument('--resume', action='store_true',
+                       help="Continue a previous run: skip domains the journal lists as completed "
+                            "and requeue the ones that failed")
+    start.add_argument('--fresh', action='store_true',
+                       help="Start over, discarding an existing progress journal")
+    parser.add_argument('--metrics-port', type=int, default=CONFIG['METRICS']['PORT'],
+                        help="Serve Prometheus metrics on this localhost port")
+    parser.add_argument('--snapshot', default=CONFIG['METRICS']['SNAPSHOT_PATH'],
+                        help="Write a periodic JSON progress snapshot to this file")
+    parser.add_argument('--batch-upload', action='store_true', default=CONFIG['BATCH_UPLOAD']['ENABLED'],
+                        help="Upload records in batches through the bulk endpoint")
+    parser.add_argument('--batch-size', type=int, default=CONFIG['BATCH_UPLOAD']['SIZE'],
+                        help="Records per bulk upload")
+    parser.add_argument('--mapping', default=CONFIG['MAPPING']['PATH'],
+                        help="JSON file with the field mapping from agent.ai responses to server records")
+    parser.add_argument('--sink', action='append', default=list(CONFIG['SINKS']['OUTPUTS']),
+                        help="Also write mapped records to a sink: ndjson:DIR, parquet:DIR or sqlite:FILE "
+                             "(may be repeated)")
+    parser.add_argument('--no-upload', dest='upload', action='store_false', default=CONFIG['SINKS']['UPLOAD'],
+                        help="Only write mapped records to the sinks, do not upload them")
+    parser.add_argument('--replay', metavar='SINK',
+                        help="Upload the records stored in a sink instead of fetching from agent.ai")
+    parser.add_argument('--processes', type=int, default=CONFIG['SHARDS']['PROCESSES'],
+                        help="Worker processes; the input is sharded between them by domain")
+    parser.add_argument('--dead-letters', default=CONFIG['DEAD_LETTER']['PATH'],
+                        help="NDJSON file listing the domains that failed, usable as --input of a retry run")
+    parser.add_argument('--rate-state-dir', default=CONFIG['RATE_LIMIT']['STATE_DIR'],
+                        help="Share the rate limiters with other importer processes through files in this directory")
+    parser.add_argument('--log-file', default=CONFIG['LOGGING']['PATH'],
+                        help="Log file, api_calls_<start time>.log by default")
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default=CONFIG['LOGGING']['LEVEL'])
+    parser.add_argument('--log-format', choices=['text', 'json'], default=CONFIG['LOGGING']['FORMAT'],
+                        help="Log lines as text or as JSON objects with structured fields")
+    parser.add_argument('--sync-logging', dest='log_async', action='store_false', default=CONFIG['LOGGING']['ASYNC'],
+                        help="Write log records in the calling thread instead of a background writer")
+    parser.add_argument('--log-max-bytes', type=int, default=CONFIG['LOGGING']['MAX_BYTES'],
+                        help="Rotate the log file once it reaches this size")
+    parser.add_argument('--log-sample-rate', type=float, default=CONFIG['LOGGING']['SUCCESS_SAMPLE_RATE'],
+                        help="Fraction of per-request success lines to log, e.g. 0.01")
+    args = parser.parse_args(argv)
+    if not (args.resume or args.fresh):
+        # Opening the journal for a new run truncates it, so a checkpoint is never discarded implicitly
+        paths = [args.journal] + [shard_path(args.journal, shard, args.processes) for shard in range(args.processes)
+                                  if args.processes > 1]
+        existing = [path for path in paths if os.path.exists(path) and os.path.getsize(path) > 0]
+        if existing:
+            parser.error(f"progress journal {existing[0]} exists, "
+                         f"pass --resume to continue that run or --fresh to discard it")
+    return args
+
+def main(argv: Optional[List[str]] = None) -> None:
     """Run the main processing workflow for website data.
 
     This function orchestrates the main logic of the application, which
-    includes fetching an authentication token, reading website URLs from a
-    CSV file in chunks, and processing these URLs in batches. It logs the
-    progress and execution time of the entire operation. The function
-    handles any exceptions that may occur during the process and logs an
-    error message before re-raising the exception.
+    includes fetching an authentication token, streaming website URLs from
+    the input file, and processing them continuously with either the thread
+    engine or the asyncio engine. With `--processes N` the input is sharded
+    between N worker processes by `run_sharded`, and with `--replay` records
+    stored in a sink are uploaded instead. Every domain's outcome is written to the
+    progress journal, which `--resume` uses to continue an interrupted run, and
+    domains that failed for good are listed in the dead-letter file. It logs the progress and execution
+    time of the entire operation. The function handles any exceptions that
+    may occur during the process and logs an error message before re-raising
+    the exception.
+
+    Args:
+        argv (Optional[List[str]]): Command line arguments, defaults to `sys.argv`.
     """
+    args = parse_args(argv)
+    CONFIG['HTTP']['TRANSPORT'] = args.transport
+    CONFIG['INPUT']['FORMAT'] = args.input_format
+    CONFIG['INPUT']['COLUMN'] = int(args.column) if str(args.column).isdigit() else args.column
+    CONFIG['CACHE']['ENABLED'] = args.cache
+    CONFIG['CACHE']['PATH'] = args.cache_path
+    CONFIG['DEDUP']['ENABLED'] = args.dedup
+    CONFIG['INCREMENTAL'].update(ENABLED=args.incremental, PATH=args.state_path, MAX_AGE=args.max_age)
+    if args.incremental:
+        # A domain due for a refresh must not be answered from a cached response of the same age
+        CONFIG['CACHE']['TTL'] = min(CONFIG['CACHE']['TTL'], args.max_age)
+    CONFIG['JOURNAL']['PATH'] = args.journal
+    CONFIG['METRICS']['PORT'] = args.metrics_port
+    CONFIG['METRICS']['SNAPSHOT_PATH'] = args.snapshot
+    CONFIG['BATCH_UPLOAD']['ENABLED'] = args.batch_upload
+    CONFIG['BATCH_UPLOAD']['SIZE'] = args.batch_size
+    CONFIG['RATE_LIMIT']['STATE_DIR'] = args.rate_state_dir
+    CONFIG['DEAD_LETTER']['PATH'] = args.dead_letters
+    CONFIG['MAPPING']['PATH'] = args.mapping
+    CONFIG['SINKS']['OUTPUTS'] = args.sink
+    CONFIG['SINKS']['UPLOAD'] = args.upload
+    CONFIG['LOGGING'].update(
+        PATH=args.log_file or LOG_PATH, LEVEL=args.log_level, FORMAT=args.log_format, ASYNC=args.log_async,
+        MAX_BYTES=args.log_max_bytes, SUCCESS_SAMPLE_RATE=args.log_sample_rate
+    )
+    configure_logging()
 
+    token_manager = None
+    journal = None
+    exporter = None
     try:
         token_manager = TokenManager()
         # Initial token fetch to ensure we can connect to the server
         token_manager.get_token()
         
         start_time = time.time()
-        chunk_size = 5000
-        
-        for chunk_index, chunk in enumerate(pd.read_csv('urls.csv', chunksize=chunk_size, encoding='utf-8')):
-            logging.info(f"Processing chunk {chunk_index + 1}")
-            websites = chunk.iloc[:, 0].tolist()
-            
-            # Process websites in larger batches
-            batch_size = 500
-            for i in range(0, len(websites), batch_size):
-                batch = websites[i:i + batch_size]
-                logging.info(f"Processing batch {i//batch_size + 1} of chunk {chunk_index + 1}")
-                process_websites(batch, token_manager)
+        report = Report()
+        exporter = MetricsExporter(report, token_manager).start()
+        if args.replay or args.processes <= 1:
+            # Open the dead-letter file up front, so the last run's is replaced even if nothing fails
+            get_dead_letters()
+        if args.replay:
+            journal = ProgressJournal(CONFIG['JOURNAL']['PATH'], resume=args.resume)
+            replay(args.replay, token_manager, journal, report, resume=args.resume)
+        elif args.processes > 1:
+            run_sharded(args, args.processes, report)
+        else:
+            journal = ProgressJournal(CONFIG['JOURNAL']['PATH'], resume=args.resume)
+            websites = build_input(args.input, journal, args.resume, report=report)
+            run_engine(args.engine, websites, token_manager, journal, report)
         
         execution_time = time.time() - start_time
         logging.info(f"Processing completed in {execution_time:.2f} seconds")
@@ -519,6 +4748,16 @@ def main() -> None:
     except Exception as e:
         logging.error(f"Main process error: {str(e)}")
         raise
+    finally:
+        if exporter:
+            exporter.stop()
+        if journal:
+            journal.close()
+        close_dead_letters()
+        close_import_state()
+        if token_manager:
+            token_manager.close()
+        shutdown_logging()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
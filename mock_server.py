@@ -0,0 +1,296 @@
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import parse_qsl
+
+def latency_sampler(spec: Optional[str], rng: Optional[random.Random] = None) -> Callable[[], float]:
+    """Return a function drawing response delays in seconds from a latency spec.
+
+    Specs are in milliseconds: 'const:20', 'uniform:10:50' (minimum and
+    maximum), 'exp:20' (mean) or 'lognormal:20:0.5' (median and sigma, for
+    a long tail). An empty spec means no delay.
+
+    Args:
+        spec (Optional[str]): The latency spec.
+        rng (Optional[random.Random]): The random generator to draw from.
+
+    Returns:
+        Callable[[], float]: Returns one delay in seconds per call.
+
+    Raises:
+        ValueError: If the spec is not understood.
+    """
+    if not spec:
+        return lambda: 0.0
+    rng = rng or random.Random()
+    kind, _, params = spec.partition(':')
+    try:
+        values = [float(value) for value in params.split(':')] if params else []
+        if kind == 'const' and len(values) == 1:
+            return lambda: values[0] / 1000
+        if kind == 'uniform' and len(values) == 2:
+            return lambda: rng.uniform(values[0], values[1]) / 1000
+        if kind == 'exp' and len(values) == 1 and values[0] > 0:
+            return lambda: rng.expovariate(1 / values[0]) / 1000
+        if kind == 'lognormal' and len(values) == 2 and values[0] > 0:
+            mu = math.log(values[0])
+            return lambda: rng.lognormvariate(mu, values[1]) / 1000
+    except ValueError:
+        pass
+    raise ValueError(f"Invalid latency spec {spec!r}, expected const:MS, uniform:MIN:MAX, exp:MEAN or lognormal:MEDIAN:SIGMA")
+
+def company_report(domain: str) -> Dict[str, Any]:
+    """Return a synthetic agent.ai company report for a domain.
+
+    The report fills every field read by the importer's default mapping,
+    with values derived from the domain so that records differ.
+    """
+    name = domain.split('.')[0].replace('-', ' ').title()
+    return {
+        'company_data': {
+            'company': {
+                'name': name,
+                'description': f'{name} builds software for companies of every size.',
+                'foundedYear': 1990 + len(domain) % 30,
+                'logo': f'https://logo.example/{domain}.png',
+                'type': 'private',
+                'tags': ['software', 'b2b', name.lower()],
+                'location': {
+                    'street': f'{len(domain)} Main Street',
+                    'city': 'Berlin',
+                    'postalCode': f'{10000 + len(domain) * 37:05d}',
+                    'country': 'Germany'
+                },
+                'site': {'emailAddresses': [f'info@{domain}'], 'phoneNumbers': ['+49 30 1234567']},
+                'category': {'industry': 'Software'},
+                'linkedin': {'handle': f'company/{name.lower()}', 'industry': 'Computer Software'},
+                'facebook': {'handle': name.lower()},
+                'twitter': {'handle': name.lower()},
+                'identifiers': {'usEIN': None},
+                'metrics': {'employees': len(domain) * 10, 'raised': len(domain) * 100000}
+            }
+        }
+    }
+
+class MockServerState:
+    def __init__(self, token: str = 'mock-token', reject_domains: Optional[List[str]] = None,
+                 latency: Optional[str] = None, error_rate: float = 0.0, throttle_rate: float = 0.0,
+                 retry_after: float = 1, keep_records: bool = True, seed: Optional[int] = None):
+        self.token = token
+        self.reject_domains = set(reject_domains or [])
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.keep_records = keep_records
+        self.records: List[Dict[str, Any]] = []
+        self.accepted = 0
+        self.requests = {'login': 0, 'company': 0, 'institution': 0, 'bulk': 0, 'throttled': 0, 'errors': 0}
+        self.lock = threading.Lock()
+        self._random = random.Random(seed)
+        self.delay = latency_sampler(latency, self._random)
+
+    def fault(self) -> Optional[int]:
+        """Draw an injected fault for a request: 429, 503 or None.
+
+        Returns:
+            Optional[int]: The status to answer with instead of handling the
+            request, or None to handle it normally.
+        """
+        draw = self._random.random()
+        if draw < self.throttle_rate:
+            status, counter = 429, 'throttled'
+        elif draw < self.throttle_rate + self.error_rate:
+            status, counter = 503, 'errors'
+        else:
+            return None
+        with self.lock:
+            self.requests[counter] += 1
+        return status
+
+    def accept(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        """Store a record unless its domain is missing or configured to be rejected.
+
+        Args:
+            record (Dict[str, Any]): A record in the format produced by `map_company_data`.
+
+        Returns:
+            Dict[str, Any]: The per-record result returned by the bulk endpoint.
+        """
+        domain = record.get('domain') if isinstance(record, dict) else None
+        if not domain:
+            return {'ok': False, 'error': 'missing domain'}
+        if domain in self.reject_domains:
+            return {'ok': False, 'error': 'rejected'}
+        with self.lock:
+            self.accepted += 1
+            if self.keep_records:
+                self.records.append(record)
+        return {'ok': True}
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state: MockServerState = None
+
+    def _send_json(self, status: int, payload: Any, headers: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _begin(self, endpoint: str, faults: bool = True) -> bool:
+        """Count a request, wait for the configured latency and inject a fault.
+
+        Returns:
+            bool: False if a 429 or 503 was sent instead of handling the request.
+        """
+        with self.state.lock:
+            self.state.requests[endpoint] += 1
+        delay = self.state.delay()
+        if delay > 0:
+            time.sleep(delay)
+        status = self.state.fault() if faults else None
+        if status == 429:
+            self._send_json(429, {'detail': 'Too many requests'}, {'Retry-After': f'{self.state.retry_after:g}'})
+            return False
+        if status is not None:
+            self._send_json(status, {'detail': 'Injected server error'})
+            return False
+        return True
+
+    def _authorized(self) -> bool:
+        if self.headers.get('Authorization') == self.state.token:
+            return True
+        self._send_json(401, {'detail': 'Not authenticated'})
+        return False
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        path = self.path.split('?', 1)[0]
+
+        if path == '/login':
+            self._begin('login', faults=False)
+            self._send_json(200, {'access_token': self.state.token, 'token_type': 'bearer'})
+
+        elif path == '/api/company/lite':
+            if not self._begin('company'):
+                return
+            try:
+                domain = json.loads(body).get('domain')
+            except (json.JSONDecodeError, AttributeError):
+                domain = None
+            if not domain:
+                self._send_json(400, {'detail': 'missing domain'})
+                return
+            self._send_json(200, company_report(domain))
+
+        elif path == '/crawler/institution':
+            if not self._begin('institution'):
+                return
+            if not self._authorized():
+                return
+            result = self.state.accept(dict(parse_qsl(body, keep_blank_values=True)))
+            self._send_json(200 if result['ok'] else 422, result)
+
+        elif path == '/crawler/institution/bulk':
+            if not self._begin('bulk'):
+                return
+            if not self._authorized():
+                return
+            try:
+                if 'ndjson' in self.headers.get('Content-Type', ''):
+                    records = [json.loads(line) for line in body.splitlines() if line.strip()]
+                else:
+                    records = json.loads(body)
+            except json.JSONDecodeError as e:
+                self._send_json(400, {'detail': str(e)})
+                return
+            if not isinstance(records, list):
+                self._send_json(400, {'detail': 'expected a list of records'})
+                return
+            self._send_json(200, {'results': [self.state.accept(record) for record in records]})
+
+        else:
+            self._send_json(404, {'detail': 'Not found'})
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+class MockHTTPServer(ThreadingHTTPServer):
+    request_queue_size = 1024
+    daemon_threads = True
+
+class MockServer:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, state: Optional[MockServerState] = None):
+        self.state = state or MockServerState()
+        handler = type('BoundMockRequestHandler', (MockRequestHandler,), {'state': self.state})
+        self.httpd = MockHTTPServer((host, port), handler)
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """Return the base URL of the server, suitable for `CONFIG['SERVER_URL']`."""
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'MockServer':
+        """Serve requests from a background thread and return the server."""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='mock-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop serving and close the listening socket."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> 'MockServer':
+        return self.start()
+
+    def __exit__(self, *exc: Any) -> None:
+        self.stop()
+
+def main() -> None:
+    """Run a local stand-in for the institution server and agent.ai until interrupted.
+
+    The server implements `/login`, `/crawler/institution` and
+    `/crawler/institution/bulk` closely enough to run the importer against
+    it with `CONFIG['SERVER_URL']` pointing at the printed URL, and
+    `/api/company/lite` for `CONFIG['API_URL']`. Latency, 5xx errors and
+    429 responses can be injected to test the importer under load.
+    """
+    parser = argparse.ArgumentParser(description="Local stand-in for the institution server and agent.ai.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--reject', action='append', default=[], help="Domain the server should reject")
+    parser.add_argument('--latency', help="Response latency: const:MS, uniform:MIN:MAX, exp:MEAN or lognormal:MEDIAN:SIGMA")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of requests answered with 503")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument('--retry-after', type=float, default=1, help="Retry-After seconds sent with a 429")
+    parser.add_argument('--seed', type=int, help="Seed for latency and fault injection")
+    args = parser.parse_args()
+
+    state = MockServerState(
+        reject_domains=args.reject, latency=args.latency, error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate, retry_after=args.retry_after, seed=args.seed
+    )
+    server = MockServer(args.host, args.port, state)
+    print(f"Serving on {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+if __name__ == '__main__':
+    main()
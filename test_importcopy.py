@@ -0,0 +1,1056 @@
+import asyncio
+import copy
+import email.utils
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+
+import pytest
+
+import importcopy
+from benchmark import write_urls
+from mock_server import MockServer, MockServerState, company_report
+
+@pytest.fixture(scope='module', autouse=True)
+def log_file(tmp_path_factory):
+    """Send the importer's log to a temporary file instead of api_calls_*.log in the working directory."""
+    path = tmp_path_factory.mktemp('logs') / 'importcopy.log'
+    settings = importcopy.CONFIG['LOGGING']
+    previous = dict(settings)
+    settings.update(PATH=str(path), ASYNC=False)
+    importcopy.configure_logging()
+    yield path
+    settings.update(previous)
+
+@pytest.fixture
+def restore_config():
+    """Undo the changes `main` makes to CONFIG and to the logging setup."""
+    saved = copy.deepcopy(importcopy.CONFIG)
+    yield
+    importcopy.CONFIG.clear()
+    importcopy.CONFIG.update(saved)
+    importcopy.configure_logging()
+
+@pytest.fixture
+def start_server(tmp_path, monkeypatch):
+    """Return a function starting a mock server for agent.ai and the upload endpoints and pointing CONFIG at it."""
+    config = importcopy.CONFIG
+    started = []
+
+    def start(**options):
+        options.setdefault('reject_domains', ['rejected.example'])
+        mock = MockServer(state=MockServerState(**options)).start()
+        started.append(mock)
+        monkeypatch.setitem(config, 'SERVER_URL', mock.url)
+        monkeypatch.setitem(config, 'API_URL', mock.url + '/api/company/lite')
+        return mock
+
+    monkeypatch.setitem(config['CACHE'], 'ENABLED', False)
+    monkeypatch.setitem(config['TOKEN'], 'BACKGROUND_REFRESH', False)
+    monkeypatch.setitem(config['DEAD_LETTER'], 'PATH', str(tmp_path / 'dead_letters.ndjson'))
+    yield start
+    for mock in started:
+        mock.stop()
+    importcopy.close_dead_letters()
+
+@pytest.fixture
+def server(start_server):
+    return start_server()
+
+@pytest.fixture
+def token_manager(server):
+    manager = importcopy.TokenManager()
+    yield manager
+    manager.close()
+
+def record(domain):
+    return importcopy.map_company_data(dict(company_report(domain), clean_domain=domain))
+
+def test_batch_upload_reports_each_record(server, token_manager):
+    records = [record('first.example'), record('rejected.example'), record('second.example')]
+
+    outcomes = importcopy.send_batch_to_server(records, token_manager, importcopy.Report())
+
+    assert outcomes == [True, False, True]
+    assert [r['domain'] for r in server.state.records] == ['first.example', 'second.example']
+    # Client errors are not retried, so the accepted records were sent once
+    assert server.state.requests['bulk'] == 1
+
+def test_batch_uploader_journals_partial_failure(server, token_manager, tmp_path):
+    journal = importcopy.ProgressJournal(str(tmp_path / 'progress.journal'))
+    uploader = importcopy.BatchUploader(
+        lambda batch: importcopy.send_batch_to_server(batch, token_manager),
+        batch_size=2, max_wait=60, on_result=importcopy.upload_recorder(journal)
+    )
+    for domain in ('a.example', 'rejected.example', 'b.example'):
+        uploader.submit(record(domain))
+    uploader.close()
+    journal.close()
+
+    assert (uploader.sent, uploader.failed) == (2, 1)
+    resumed = importcopy.ProgressJournal(str(tmp_path / 'progress.journal'), resume=True)
+    try:
+        assert resumed.is_completed('a.example')
+        assert resumed.is_completed('b.example')
+        assert not resumed.is_completed('rejected.example')
+    finally:
+        resumed.close()
+
+def test_upload_is_replayed_after_401(server, token_manager):
+    token_manager.token = 'expired-token'
+    token_manager.expires_at = float('inf')
+
+    assert importcopy.send_to_server(record('relogin.example'), token_manager)
+
+    assert token_manager.token == server.state.token
+    assert server.state.requests['login'] == 1
+    assert server.state.requests['institution'] == 2
+    assert server.state.records[0]['domain'] == 'relogin.example'
+
+def test_rejected_upload_fails(server, token_manager):
+    assert not importcopy.send_to_server(record('rejected.example'), token_manager)
+    assert server.state.accepted == 0
+
+def test_fetched_response_is_mapped(server):
+    data = importcopy.call_api('https://www.mapped.example/about', importcopy.Report())
+    mapped = importcopy.map_company_data(data)
+
+    assert mapped['domain'] == 'mapped.example'
+    assert mapped['company_name'] == 'Mapped'
+    assert mapped['city'] == 'Berlin'
+    assert mapped['email'] == 'info@mapped.example'
+    assert mapped['tags'] == 'software,b2b,mapped'
+    assert json.loads(mapped['financials']) == company_report('mapped.example')['company_data']['company']['metrics']
+    assert mapped['TAX-ID'] == 'None'
+    assert mapped['sourcefound'] == 'agent.ai'
+
+def test_mapper_treats_wrong_types_as_empty():
+    mapped = importcopy.map_company_data({'clean_domain': 'broken.example', 'company_data': ['not', 'an', 'object']})
+
+    assert mapped['domain'] == 'broken.example'
+    assert mapped['company_name'] == ''
+    assert mapped['financials'] == '{}'
+
+def test_mapper_rules():
+    mapper = importcopy.compile_mapping({'fields': [
+        {'name': 'fixed', 'rule': 'const', 'value': 'x'},
+        {'name': 'name', 'rule': 'str', 'path': 'a.name', 'default': 'unknown'},
+        {'name': 'first', 'rule': 'first', 'path': 'a.items'},
+        {'name': 'joined', 'rule': 'join', 'path': 'a.items', 'separator': '|'},
+        {'name': 'short', 'rule': 'truncate', 'path': 'a.long', 'length': 3}
+    ]})
+
+    assert mapper({'a': {'items': [1, 2], 'long': 'abcdef'}}) == {
+        'fixed': 'x', 'name': 'unknown', 'first': '1', 'joined': '1|2', 'short': 'abc'
+    }
+    with pytest.raises(TypeError):
+        mapper(None)
+    with pytest.raises(ValueError):
+        importcopy.compile_mapping({'fields': [{'name': 'bad', 'rule': 'upper', 'path': 'a'}]})
+
+def test_mapper_keeps_spec_keys_out_of_the_code():
+    key = 'x", __import__("builtins").setattr(__import__("builtins"), "injected", 1), "'
+    mapper = importcopy.compile_mapping({
+        'validate': [key],
+        'fields': [{'name': 'value', 'rule': 'str', 'path': f'{key}.value'}]
+    })
+
+    assert mapper({key: 'not an object'}) == {'value': ''}
+    assert not hasattr(__import__('builtins'), 'injected')
+
+def baseline_map_company_data(data):
+    """The hand-written mapper `COMPANY_MAPPING` replaced, kept as the reference for its output."""
+    try:
+        # Validate input
+        if not isinstance(data, dict):
+            raise TypeError(f"Expected dict, got {type(data)}")
+
+        company_data = data.get('company_data', {})
+        if not isinstance(company_data, dict):
+            company_data = {}
+
+        company = company_data.get('company', {})
+        if not isinstance(company, dict):
+            company = {}
+
+        # Get domain information with validation
+        clean_domain = str(data.get('clean_domain', ''))
+        full_url = str(data.get('full_url', ''))
+
+        # Safely get nested values
+        location = company.get('location', {}) if isinstance(company.get('location'), dict) else {}
+        site = company.get('site', {}) if isinstance(company.get('site'), dict) else {}
+        linkedin = company.get('linkedin', {}) if isinstance(company.get('linkedin'), dict) else {}
+        facebook = company.get('facebook', {}) if isinstance(company.get('facebook'), dict) else {}
+        twitter = company.get('twitter', {}) if isinstance(company.get('twitter'), dict) else {}
+        metrics = company.get('metrics', {}) if isinstance(company.get('metrics'), dict) else {}
+        category = company.get('category', {}) if isinstance(company.get('category'), dict) else {}
+        identifiers = company.get('identifiers', {}) if isinstance(company.get('identifiers'), dict) else {}
+
+        # Safely get arrays
+        email_addresses = site.get('emailAddresses', []) if isinstance(site.get('emailAddresses'), list) else []
+        phone_numbers = site.get('phoneNumbers', []) if isinstance(site.get('phoneNumbers'), list) else []
+        tags = company.get('tags', []) if isinstance(company.get('tags'), list) else []
+
+        return {
+            'company_name': str(company.get('name', '')),
+            'firstCompanyName': '',
+            'street_NO': str(location.get('street', '')),
+            'domain': clean_domain,
+            'city': str(location.get('city', '')),
+            'email': str(email_addresses[0]) if email_addresses else '',
+            'linkedin': str(linkedin.get('handle', '')),
+            'logo': str(company.get('logo', '')),
+            'founded_on': str(company.get('foundedYear', '')),
+            'sourcefound': 'agent.ai',
+            'zip': str(location.get('postalCode', '')),
+            'category': str(category.get('industry', '')),
+            'slogan': str(company.get('description', '')),
+            'pressphoto': '',
+            'tags': ','.join(str(tag) for tag in tags),
+            'ceo': '',
+            'ceoid': '',
+            'news': '',
+            'awards': '',
+            'futurepredictions': '',
+            'financials': json.dumps(metrics),
+            'Company_Short': str(company.get('name', ''))[:50] if company.get('name') else '',
+            'phone': str(phone_numbers[0]) if phone_numbers else '',
+            'Rechtsform': str(company.get('type', '')),
+            'cat-tag-1-trustedshops': '',
+            'cat-tag-2-trustedshops': '',
+            'private-gov': '',
+            'Description': str(company.get('description', '')),
+            'link_agb': '',
+            'link_daten': '',
+            'tag_cat_linkedin': str(linkedin.get('industry', '')),
+            'linkedinurl': str(linkedin.get('handle', '')),
+            'facebookurl': str(facebook.get('handle', '')),
+            'instagramurl': '',
+            'Twitter': str(twitter.get('handle', '')),
+            'TAX-ID': str(identifiers.get('usEIN', '')),
+            'country': str(location.get('country', ''))
+        }
+    except Exception as e:
+        # Return empty data with required fields
+        return {
+            'company_name': '',
+            'firstCompanyName': '',
+            'street_NO': '',
+            'domain': str(data.get('clean_domain', '')) if isinstance(data, dict) else '',
+            'city': '',
+            'email': '',
+            'linkedin': '',
+            'logo': '',
+            'founded_on': '',
+            'sourcefound': 'agent.ai',
+            'zip': '',
+            'category': '',
+            'slogan': '',
+            'pressphoto': '',
+            'tags': '',
+            'ceo': '',
+            'ceoid': '',
+            'news': '',
+            'awards': '',
+            'futurepredictions': '',
+            'financials': '{}',
+            'Company_Short': '',
+            'phone': '',
+            'Rechtsform': '',
+            'cat-tag-1-trustedshops': '',
+            'cat-tag-2-trustedshops': '',
+            'private-gov': '',
+            'Description': '',
+            'link_agb': '',
+            'link_daten': '',
+            'tag_cat_linkedin': '',
+            'linkedinurl': '',
+            'facebookurl': '',
+            'instagramurl': '',
+            'Twitter': '',
+            'TAX-ID': '',
+            'country': ''
+        }
+
+
+class Unprintable:
+    def __str__(self):
+        raise ValueError('no text')
+
+def mapper_inputs():
+    """Yield API responses covering each kind of value the mapper reads: present, missing, None and mistyped."""
+    for domain in ('first.example', 'second.example', 'third.example'):
+        yield dict(company_report(domain), clean_domain=domain, full_url=f'https://{domain}')
+    yield {}
+    yield {'clean_domain': None, 'company_data': None}
+    yield {'clean_domain': 42, 'company_data': {'company': ['not', 'an', 'object']}}
+    base = dict(company_report('edge.example'), clean_domain='edge.example')
+    company = base['company_data']['company']
+    for key in list(company):
+        for value in (None, '', 0, [], {}, ['x', 1, None], 'text', {'street': 'x'}, 'ä' * 60):
+            yield dict(base, company_data={'company': dict(company, **{key: value})})
+        yield dict(base, company_data={'company': {k: v for k, v in company.items() if k != key}})
+        if isinstance(company[key], dict):
+            for inner in company[key]:
+                for value in (None, [], ['a', 'b'], {}, 7):
+                    yield dict(base, company_data={'company': dict(company, **{key: dict(company[key], **{inner: value})})})
+    yield dict(base, company_data={'company': dict(company, name=Unprintable())})
+
+def test_mapper_matches_the_hand_written_mapping():
+    inputs = list(mapper_inputs())
+
+    for data in inputs:
+        assert importcopy.map_company_data(copy.deepcopy(data)) == baseline_map_company_data(data), data
+    assert importcopy.map_many(copy.deepcopy(inputs)) == [baseline_map_company_data(data) for data in inputs]
+    for data in (None, ['not', 'a', 'dict'], 'text'):
+        assert importcopy.map_company_data(data) == baseline_map_company_data(data)
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    """Enable a response cache in a temporary file for the fetches of a test."""
+    cache = importcopy.ResponseCache(str(tmp_path / 'cache.sqlite3'), ttl=3600, negative_ttl=3600, max_entries=100)
+    monkeypatch.setitem(importcopy.CONFIG['CACHE'], 'ENABLED', True)
+    monkeypatch.setattr(importcopy, '_response_cache', cache)
+    yield cache
+    cache.close()
+
+def test_cache_entries_expire_by_their_ttl(tmp_path):
+    cache = importcopy.ResponseCache(str(tmp_path / 'cache.sqlite3'), ttl=3600, negative_ttl=0, max_entries=100)
+    try:
+        cache.put('valid.example', '{}')
+        cache.put('empty.example', '', negative=True)
+
+        assert cache.get('valid.example').fresh
+        entry = cache.get('empty.example')
+        assert entry.negative and not entry.fresh
+        assert cache.get('missing.example') is None
+    finally:
+        cache.close()
+
+def test_cache_answers_repeated_fetch(server, cache):
+    report = importcopy.Report()
+
+    first = importcopy.call_api('cached.example', report)
+    second = importcopy.call_api('cached.example', report)
+
+    assert first['company_data'] == second['company_data']
+    assert server.state.requests['company'] == 1
+    assert report.summary()['cache'] == {'hits': 1, 'misses': 1, 'stale': 0}
+
+def test_stale_entry_is_served_when_the_api_fails(start_server, cache, monkeypatch):
+    server = start_server(error_rate=1.0)
+    monkeypatch.setitem(importcopy.CONFIG['RETRY']['SERVER_ERROR'], 'TRIES', 1)
+    cache.ttl = 0
+    cache.put('stale.example', json.dumps(company_report('stale.example')))
+    report = importcopy.Report()
+
+    data = importcopy.call_api('stale.example', report)
+
+    assert data['clean_domain'] == 'stale.example'
+    assert server.state.requests['errors'] == 1
+    assert report.summary()['cache']['stale'] == 1
+
+def test_cache_write_failure_keeps_the_response(server, cache, monkeypatch):
+    class LockedConnection:
+        def execute(self, *args):
+            raise importcopy.sqlite3.OperationalError('database is locked')
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(cache, '_conn', LockedConnection())
+    report = importcopy.Report()
+
+    data = importcopy.call_api('locked.example', report)
+
+    assert data['clean_domain'] == 'locked.example'
+    summary = report.summary()
+    assert (summary['success_count'], summary['error_count']) == (1, 0)
+
+@pytest.mark.parametrize('kind, location', [('ndjson', 'records'), ('sqlite', 'records.sqlite3')])
+def test_sink_round_trip(tmp_path, kind, location):
+    records = [record(f'company{i}.example') for i in range(5)]
+    sink = importcopy.create_sink(f'{kind}:{tmp_path / location}')
+    sink.batch_size = 2
+    for item in records:
+        sink.write(item)
+    sink.close()
+
+    reader = importcopy.create_sink(f'{kind}:{tmp_path / location}')
+    try:
+        assert list(reader.read()) == records
+    finally:
+        reader.close()
+    assert sink.written == 5
+
+def test_sqlite_sink_keeps_the_latest_record_per_domain(tmp_path):
+    sink = importcopy.SQLiteSink(str(tmp_path / 'records.sqlite3'), batch_size=1)
+    sink.write({'domain': 'same.example', 'city': 'Berlin'})
+    sink.write({'domain': 'same.example', 'city': 'Hamburg'})
+    try:
+        assert list(sink.read()) == [{'domain': 'same.example', 'city': 'Hamburg'}]
+    finally:
+        sink.close()
+
+def test_unknown_sink_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        importcopy.create_sink(f'csv:{tmp_path}')
+
+def test_incomplete_sink_cannot_be_created(tmp_path):
+    class WriteOnlySink(importcopy.RecordSink):
+        def _write_batch(self, batch):
+            pass
+
+    with pytest.raises(TypeError):
+        WriteOnlySink()
+
+def test_replay_uploads_sink_records(server, token_manager, tmp_path):
+    sink = importcopy.create_sink(f'ndjson:{tmp_path}')
+    for domain in ('a.example', 'rejected.example', 'b.example'):
+        sink.write(record(domain))
+    sink.close()
+    journal = importcopy.ProgressJournal(str(tmp_path / 'progress.journal'))
+    report = importcopy.Report()
+
+    importcopy.replay_records(sink.read(), token_manager, report, journal)
+    journal.close()
+
+    assert sorted(r['domain'] for r in server.state.records) == ['a.example', 'b.example']
+    assert server.state.requests['company'] == 0
+    with open(tmp_path / 'progress.journal', encoding='utf-8') as f:
+        assert sorted(line.split()[0] for line in f) == ['U', 'U', 'u']
+
+def test_async_engine_writes_sinks_off_the_event_loop(server, token_manager, tmp_path, monkeypatch):
+    monkeypatch.setitem(importcopy.CONFIG['SINKS'], 'UPLOAD', False)
+    writers = set()
+
+    class RecordingSink(importcopy.SQLiteSink):
+        def write(self, item):
+            writers.add(threading.current_thread())
+            super().write(item)
+
+    sink = RecordingSink(str(tmp_path / 'records.sqlite3'), batch_size=2)
+    websites = [f'company{i}.example' for i in range(5)]
+    asyncio.run(importcopy.process_stream_async(iter(websites), token_manager, None, importcopy.Report(), [sink]))
+    sink.flush()
+
+    assert sorted(item['domain'] for item in sink.read()) == websites
+    assert threading.main_thread() not in writers
+    assert server.state.accepted == 0
+    sink.close()
+
+def test_report_merges_thread_shards():
+    report = importcopy.Report()
+
+    def work():
+        for _ in range(100):
+            report.update(success=True)
+            report.record_latency('map', 0.002)
+        report.record_retries(2)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report.update(success=False)
+
+    summary = report.summary()
+    assert (summary['success_count'], summary['error_count']) == (400, 1)
+    assert summary['retries'] == {'2': 4}
+    assert summary['latency']['map']['count'] == 400
+    assert 0.002 <= summary['latency']['map']['p50'] <= 0.0025
+
+def test_report_absorbs_other_processes():
+    worker = importcopy.Report()
+    worker.update(success=True)
+    worker.record_latency('fetch', 0.1)
+    coordinator = importcopy.Report()
+    coordinator.update(success=True)
+
+    coordinator.absorb('shard-0', worker.export())
+    worker.update(success=True)
+    coordinator.absorb('shard-0', worker.export())
+
+    assert coordinator.summary()['success_count'] == 3
+    assert coordinator.latency_histogram('fetch') == worker.latency_histogram('fetch')
+
+def test_request_latency_leaves_out_rate_limiter_waits(server):
+    bucket = importcopy.TokenBucket('api', rate=5, burst=1)
+    report = importcopy.Report()
+
+    for _ in range(3):
+        response = importcopy.limited_request(
+            bucket, 'POST', importcopy.CONFIG['API_URL'], body=json.dumps({'domain': 'timed.example'}), report=report
+        )
+        assert response.ok
+
+    summary = report.summary()
+    assert summary['rate_limit_wait_seconds']['api'] >= 0.3
+    assert summary['latency']['fetch']['count'] == 3
+    assert summary['latency']['fetch']['p99'] < 0.15
+
+def test_retries_are_counted_once_per_request(start_server, monkeypatch):
+    start_server(error_rate=1.0)
+    monkeypatch.setitem(importcopy.CONFIG['RETRY'], 'SERVER_ERROR', {'TRIES': 3, 'BASE_DELAY': 0.01, 'MAX_DELAY': 0.01})
+    report = importcopy.Report()
+
+    response = importcopy.limited_request(
+        importcopy.TokenBucket('api', rate=1000, burst=100), 'POST', importcopy.CONFIG['API_URL'],
+        body=json.dumps({'domain': 'failing.example'}), report=report
+    )
+
+    assert response.status == 503
+    summary = report.summary()
+    assert summary['retries'] == {'2': 1}
+    assert summary['failures']['api'] == {'server_error': 3}
+    assert summary['latency']['fetch']['count'] == 3
+
+def test_async_engine_connections_match_in_flight_fetches(start_server, token_manager, monkeypatch):
+    server = start_server(latency='const:200')
+    monkeypatch.setitem(importcopy.CONFIG['HTTP'], 'POOL_SIZE', 5)
+
+    async def fetch_all():
+        engine = importcopy.AsyncEngine(token_manager, max_fetches=40, max_uploads=10)
+        try:
+            assert engine.client.pool_size == 40
+            started = importcopy.time.monotonic()
+            responses = await asyncio.gather(*(
+                engine.client.request('POST', importcopy.CONFIG['API_URL'], body=json.dumps({'domain': f'c{i}.example'}))
+                for i in range(40)
+            ))
+            return responses, importcopy.time.monotonic() - started
+        finally:
+            await engine.close()
+
+    responses, elapsed = asyncio.run(fetch_all())
+
+    assert all(response.ok for response in responses)
+    # With 5 connections the 40 requests would take 8 rounds of 200 ms
+    assert elapsed < 1.0
+    assert server.state.requests['company'] == 40
+
+def test_journal_resume_loads_completed_and_failed_domains(tmp_path):
+    path = tmp_path / 'progress.journal'
+    path.write_text('F a.example\nU a.example\nF b.example\nu b.example\nf c.example\n'
+                    'u d.example\nU d.example\nU trunc', encoding='utf-8')
+
+    journal = importcopy.ProgressJournal(str(path), resume=True)
+    journal.record('e.example', 'upload', True)
+    journal.close()
+
+    assert journal.is_completed('a.example') and journal.is_completed('d.example')
+    assert not journal.is_completed('trunc')
+    assert journal.failed == {'b.example', 'c.example'}
+    assert path.read_text(encoding='utf-8').endswith('U e.example\n')
+
+def run_main(tmp_path, *options):
+    importcopy.main(['--input', str(tmp_path / 'urls.csv'), '--no-cache', '--journal', str(tmp_path / 'progress.journal'),
+                     '--dead-letters', str(tmp_path / 'dead_letters.ndjson'), '--log-file', str(tmp_path / 'run.log'),
+                     *options])
+
+def test_resume_skips_domains_written_to_sinks(server, tmp_path, restore_config):
+    write_urls(str(tmp_path / 'urls.csv'), 5)
+    sink = f'sqlite:{tmp_path / "records.sqlite3"}'
+
+    run_main(tmp_path, '--no-upload', '--sink', sink)
+    run_main(tmp_path, '--no-upload', '--sink', sink, '--resume')
+
+    assert server.state.requests['company'] == 5
+    assert server.state.accepted == 0
+    with open(tmp_path / 'progress.journal', encoding='utf-8') as f:
+        assert sorted(line for line in f if line.startswith('U')) == [f'U company{i}.example\n' for i in range(5)]
+
+def test_existing_journal_needs_resume_or_fresh(server, tmp_path, restore_config):
+    write_urls(str(tmp_path / 'urls.csv'), 3)
+    run_main(tmp_path)
+
+    with pytest.raises(SystemExit):
+        run_main(tmp_path)
+    assert server.state.requests['company'] == 3
+
+    run_main(tmp_path, '--fresh')
+    assert server.state.requests['company'] == 6
+
+@pytest.mark.parametrize('transport', ['curl', 'native'])
+def test_transports_return_retry_after(start_server, transport):
+    start_server(throttle_rate=1.0, retry_after=7)
+    client = importcopy.create_http_client(dict(importcopy.CONFIG['HTTP'], TRANSPORT=transport, HTTP2=False))
+    try:
+        response = client.request('POST', importcopy.CONFIG['API_URL'], headers={'Content-Type': 'application/json'},
+                                  body=json.dumps({'domain': 'throttled.example'}))
+    finally:
+        client.close()
+
+    assert response.status == 429
+    assert importcopy.parse_retry_after(response.headers) == 7
+    assert json.loads(response.body) == {'detail': 'Too many requests'}
+
+def test_curl_output_keeps_headers_of_the_final_response():
+    stdout = ('HTTP/1.1 100 Continue\r\n\r\n'
+              'HTTP/1.1 302 Found\r\nLocation: /next\r\n\r\n'
+              'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 3\r\nContent-Length: 2\r\n\r\n'
+              '{}\n503')
+
+    response = importcopy.parse_curl_output(stdout)
+
+    assert (response.status, response.body) == (503, '{}')
+    assert response.headers == {'retry-after': '3', 'content-length': '2'}
+
+def test_async_curl_transport_returns_headers(start_server):
+    start_server(throttle_rate=1.0, retry_after=2)
+
+    response = asyncio.run(importcopy.AsyncCurlTransport().request(
+        'POST', importcopy.CONFIG['API_URL'], body=json.dumps({'domain': 'throttled.example'})
+    ))
+
+    assert response.status == 429
+    assert response.headers['retry-after'] == '2'
+
+def test_deduplicator_skips_variants_of_the_same_domain():
+    dedup = importcopy.DomainDeduplicator()
+    websites = ['https://www.first.example/about', 'first.example', 'FIRST.EXAMPLE',
+                'second.example', 'done.example']
+    dedup.is_done = lambda domain: domain == 'done.example'
+
+    assert list(dedup.filter(iter(websites))) == ['https://www.first.example/about', 'second.example']
+    assert (dedup.unique, dedup.duplicates, dedup.already_done) == (2, 2, 1)
+
+def test_deduplicator_switches_to_bloom_filter():
+    dedup = importcopy.DomainDeduplicator(max_exact=10, bloom_capacity=1000, bloom_error_rate=0.001)
+    domains = [f'company{i}.example' for i in range(100)]
+
+    assert not any(dedup.seen(domain) for domain in domains)
+    assert dedup.exact is None
+    assert all(dedup.seen(domain) for domain in domains)
+
+def test_metrics_render_counters_and_latency_histogram():
+    report = importcopy.Report()
+    report.update(True, 'first.example', retries=1)
+    report.update(False, 'second.example')
+    report.record_cache('hit')
+    report.record_cache('miss')
+    report.record_latency('fetch', 0.002)
+    report.record_latency('fetch', 1000)
+
+    lines = importcopy.render_metrics(report).splitlines()
+
+    assert 'importer_requests_total{outcome="success"} 1' in lines
+    assert 'importer_requests_total{outcome="error"} 1' in lines
+    assert 'importer_cache_hit_ratio 0.5' in lines
+    assert 'importer_retries_total{retries="1"} 1' in lines
+    buckets = [line for line in lines if line.startswith('importer_stage_latency_seconds_bucket{stage="fetch"')]
+    counts = [int(line.rsplit(' ', 1)[1]) for line in buckets]
+    assert counts == sorted(counts) and counts[0] == 0 and counts[-2:] == [1, 2]
+    assert 'importer_stage_latency_seconds_count{stage="fetch"} 2' in lines
+
+def test_metrics_exporter_serves_metrics_and_snapshot(tmp_path):
+    import socket
+    import urllib.request
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    report = importcopy.Report()
+    report.update(True, 'first.example')
+    exporter = importcopy.MetricsExporter(report, port=port, snapshot_path=str(tmp_path / 'snapshot.json'),
+                                          snapshot_interval=60).start()
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+            assert 'importer_requests_total{outcome="success"} 1' in response.read().decode('utf-8')
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/snapshot') as response:
+            assert json.loads(response.read())['report']['success_count'] == 1
+    finally:
+        exporter.stop()
+
+    with open(tmp_path / 'snapshot.json', encoding='utf-8') as f:
+        assert json.load(f)['report']['success_count'] == 1
+
+def test_rate_limiter_decreases_on_throttling_and_recovers(monkeypatch):
+    bucket = importcopy.TokenBucket('api', rate=100, burst=10, min_rate=10)
+
+    bucket.on_response(200, 10)
+    assert bucket.rate == 90  # slow responses reduce the rate slightly
+    bucket.on_response(429, 0.1)
+    bucket.on_response(503, 0.1)
+    assert bucket.rate == 45  # one decrease per DECREASE_INTERVAL
+    monkeypatch.setitem(importcopy.CONFIG['RATE_LIMIT'], 'DECREASE_INTERVAL', 0)
+    for _ in range(5):
+        bucket.on_response(None, 0.1)
+    assert bucket.rate == 10  # never below min_rate
+
+    bucket.on_response(200, 0.1)
+    assert bucket.rate == pytest.approx(10.1)
+    for _ in range(10000):
+        bucket.on_response(200, 0.1)
+    assert bucket.rate == 100  # never above max_rate
+
+def test_rate_limiter_honours_retry_after():
+    bucket = importcopy.TokenBucket('api', rate=1000, burst=10)
+
+    bucket.on_response(429, 0.1, retry_after=0.3)
+
+    assert bucket.acquire() >= 0.3
+    assert bucket.acquire() < 0.1
+
+def test_rate_limiter_state_is_shared_through_its_file(tmp_path):
+    path = str(tmp_path / 'api.bucket')
+    first = importcopy.TokenBucket('api', rate=5, burst=2, state_path=path)
+    second = importcopy.TokenBucket('api', rate=5, burst=2, state_path=path)
+    try:
+        assert first.acquire() == 0 and first.acquire() == 0
+        assert second.acquire() == pytest.approx(0.2, abs=0.05)
+    finally:
+        first.close()
+        second.close()
+
+def test_retry_after_accepts_seconds_and_http_dates():
+    date = email.utils.formatdate(time.time() + 60, usegmt=True)
+
+    assert importcopy.parse_retry_after({'Retry-After': '12'}) == 12
+    assert 55 < importcopy.parse_retry_after({'retry-after': date}) <= 60
+    assert importcopy.parse_retry_after({'Retry-After': 'soon'}) is None
+    assert importcopy.parse_retry_after({}) is None
+
+@pytest.fixture
+def slow_login(token_manager, monkeypatch):
+    """Make logins take 100 ms, so concurrent callers overlap with them."""
+    refresh_token = token_manager.refresh_token
+
+    def slow_refresh_token():
+        time.sleep(0.1)
+        refresh_token()
+
+    monkeypatch.setattr(token_manager, 'refresh_token', slow_refresh_token)
+    return token_manager
+
+def test_concurrent_callers_share_one_login(server, slow_login):
+    barrier = threading.Barrier(20)
+
+    def get_token():
+        barrier.wait()
+        return slow_login.get_token()
+
+    threads = [threading.Thread(target=get_token) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert slow_login.token == server.state.token
+    assert server.state.requests['login'] == 1
+
+def test_async_uploads_rejected_with_one_token_share_one_login(server, slow_login):
+    slow_login.token = 'expired-token'
+    slow_login.expires_at = float('inf')
+
+    async def upload_all():
+        engine = importcopy.AsyncEngine(slow_login)
+        try:
+            return await asyncio.gather(*(engine.send_to_server(record(f'c{i}.example')) for i in range(20)))
+        finally:
+            await engine.close()
+
+    assert all(asyncio.run(upload_all()))
+    assert server.state.requests['login'] == 1
+    assert server.state.requests['institution'] == 40
+
+def test_token_expiry_is_read_from_the_jwt():
+    def encode(part):
+        return importcopy.base64.urlsafe_b64encode(json.dumps(part).encode()).decode().rstrip('=')
+
+    assert importcopy.jwt_expiry(f'{encode({"alg": "HS256"})}.{encode({"exp": 1700000000})}.sig') == 1700000000
+    assert importcopy.jwt_expiry(f'{encode({"alg": "HS256"})}.{encode({"sub": "x"})}.sig') is None
+    assert importcopy.jwt_expiry('mock-token') is None
+
+def test_shards_partition_domains_stably():
+    websites = [f'https://www.company{i}.example/about' for i in range(200)]
+    shards = [list(importcopy.select_shard(iter(websites), shard, 4)) for shard in range(4)]
+
+    assert sorted(sum(shards, [])) == sorted(websites)
+    assert all(shards)
+    # The assignment is part of the journal format: resumed runs rely on it
+    assert [importcopy.shard_of(f'company{i}.example', 4) for i in range(4)] == [2, 2, 1, 2]
+    assert importcopy.shard_of('company0.example', 4) == importcopy.shard_of(
+        importcopy.clean_domain('https://www.COMPANY0.example/x')[0], 4)
+
+def test_split_budget_divides_rates_and_workers(restore_config):
+    config = importcopy.CONFIG
+    config['RATE_LIMIT']['API'].update(RATE=100, MAX_RATE=None, MIN_RATE=4, BURST=2)
+    config['MAX_WORKERS'] = 5
+
+    importcopy.split_budget(4)
+
+    assert config['RATE_LIMIT']['API'] == {'RATE': 25, 'MAX_RATE': 25, 'MIN_RATE': 1, 'BURST': 1}
+    assert config['MAX_WORKERS'] == 1
+
+def test_split_budget_keeps_shared_rates(restore_config, tmp_path):
+    config = importcopy.CONFIG
+    config['RATE_LIMIT']['STATE_DIR'] = str(tmp_path)
+    limits = dict(config['RATE_LIMIT']['API'])
+
+    importcopy.split_budget(4)
+
+    assert config['RATE_LIMIT']['API'] == limits
+
+def test_merge_journals_drops_truncated_lines(tmp_path):
+    (tmp_path / 'a').write_text('U first.example\nF second.exa', encoding='utf-8')
+    (tmp_path / 'b').write_text('F third.example\n', encoding='utf-8')
+
+    importcopy.merge_journals([str(tmp_path / 'a'), str(tmp_path / 'missing'), str(tmp_path / 'b')],
+                              str(tmp_path / 'merged'))
+
+    assert (tmp_path / 'merged').read_text(encoding='utf-8') == 'U first.example\nF third.example\n'
+
+def test_sharded_run_processes_each_domain_once(server, tmp_path, restore_config):
+    write_urls(str(tmp_path / 'urls.csv'), 20)
+
+    run_main(tmp_path, '--processes', '2')
+
+    assert server.state.requests['company'] == 20
+    assert sorted(r['domain'] for r in server.state.records) == sorted(f'company{i}.example' for i in range(20))
+    with open(tmp_path / 'progress.journal', encoding='utf-8') as f:
+        assert sorted(line for line in f if line.startswith('U')) == sorted(f'U company{i}.example\n' for i in range(20))
+    assert not list(tmp_path.glob('dead_letters.ndjson.shard-*'))
+
+@pytest.mark.parametrize('name, expected', [
+    ('urls.csv', ('csv', None)),
+    ('URLS.TSV.GZ', ('csv', 'gzip')),
+    ('urls.ndjson.zst', ('ndjson', 'zstd')),
+    ('urls.jsonl', ('ndjson', None)),
+    ('urls.parquet', ('parquet', None)),
+    ('urls', ('text', None))
+])
+def test_input_format_is_detected_from_the_name(name, expected):
+    assert importcopy.detect_input_format(name) == expected
+
+def test_csv_input_is_read_by_column(tmp_path):
+    path = tmp_path / 'urls.csv'
+    path.write_text('\ufeffname,url\r\n'
+                    'First,first.example\r\n'
+                    '"Second, Inc.","second.example"\r\n'
+                    '"Multi\nline",  third.example  \r\n'
+                    'Blank,\r\n'
+                    'Short\r\n', encoding='utf-8')
+
+    assert list(importcopy.iter_websites(str(path), column='url')) == [
+        'first.example', 'second.example', 'third.example'
+    ]
+    assert list(importcopy.iter_websites(str(path), column=0)) == ['First', 'Second, Inc.', 'Multi\nline', 'Blank', 'Short']
+    with pytest.raises(ValueError):
+        list(importcopy.iter_websites(str(path), column='missing'))
+
+def test_gzip_ndjson_input_is_read_by_field(tmp_path):
+    import gzip
+
+    path = tmp_path / 'urls.ndjson.gz'
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        f.write('{"url": "first.example", "name": "First"}\n'
+                '"second.example"\n'
+                'not json\n'
+                '\n'
+                '{"name": "No url"}\n'
+                '{"url": "third.example"}')
+
+    assert list(importcopy.iter_websites(str(path), column='url')) == [
+        'first.example', 'second.example', 'third.example'
+    ]
+
+def test_text_input_yields_one_website_per_line(tmp_path):
+    path = tmp_path / 'urls.txt'
+    path.write_text('first.example\n\n second.example\r\nthird.example', encoding='utf-8')
+    (tmp_path / 'empty.txt').write_text('', encoding='utf-8')
+
+    assert list(importcopy.iter_websites(str(path))) == ['first.example', 'second.example', 'third.example']
+    assert list(importcopy.iter_websites(str(tmp_path / 'empty.txt'))) == []
+
+def transport_error(cause):
+    try:
+        raise importcopy.TransportError('request failed') from cause
+    except importcopy.TransportError as e:
+        return e
+
+@pytest.mark.parametrize('status, body, expected', [
+    (200, '{"company_data": {}}', None),
+    (200, '{"company_da', 'payload'),
+    (0, '', 'connection'),
+    (404, '', 'client_error'),
+    (408, '', 'timeout'),
+    (429, '', 'throttled'),
+    (503, '', 'server_error')
+])
+def test_responses_are_classified(status, body, expected):
+    response = importcopy.HTTPResponse(status, body)
+
+    assert importcopy.classify_failure(response, validate=importcopy.api_payload_ok) == expected
+
+def test_transport_errors_are_classified():
+    assert importcopy.classify_failure(error=transport_error(TimeoutError())) == 'timeout'
+    assert importcopy.classify_failure(error=transport_error(ConnectionResetError())) == 'connection'
+    assert importcopy.classify_failure(error=importcopy.CircuitOpenError('open')) == 'circuit_open'
+
+def test_retry_budget_depends_on_the_failure_class(monkeypatch):
+    monkeypatch.setitem(importcopy.CONFIG, 'MAX_RETRIES', 3)
+
+    assert importcopy.retry_delay('client_error', 1) is None
+    assert importcopy.retry_delay('circuit_open', 1) is None
+    assert 0 <= importcopy.retry_delay('payload', 1) <= 0.5
+    assert importcopy.retry_delay('payload', 2) is None
+    assert all(0 <= importcopy.retry_delay('server_error', 2) <= 2 for _ in range(100))
+    assert importcopy.retry_delay('server_error', 3) is None
+
+def test_circuit_opens_probes_and_closes():
+    breaker = importcopy.CircuitBreaker('api.example', failure_threshold=3, reset_timeout=0.1, max_reset_timeout=0.15)
+
+    for failure in ('server_error', 'timeout', None, 'connection', 'client_error', 'server_error', 'server_error'):
+        breaker.on_result(failure, breaker.acquire())
+    assert breaker.state == 'closed'  # successes and 4xx reset the count
+    breaker.on_result('server_error', breaker.acquire())
+    assert breaker.state == 'open'
+
+    started = time.monotonic()
+    assert breaker.acquire() is True
+    assert time.monotonic() - started >= 0.09
+    assert breaker.state == 'half_open'
+    breaker.on_result('timeout', probe=True)
+    assert breaker.state == 'open' and breaker.retry_at - time.monotonic() > 0.1  # the pause doubled, up to the cap
+
+    assert breaker.acquire() is True
+    breaker.on_result(None, probe=True)
+    assert breaker.state == 'closed'
+    assert breaker.acquire() is False
+
+def test_circuit_fails_requests_after_max_open_time():
+    breaker = importcopy.CircuitBreaker('api.example', failure_threshold=1, reset_timeout=10, max_reset_timeout=10,
+                                        max_open_time=0)
+    breaker.on_result('connection', breaker.acquire())
+
+    with pytest.raises(importcopy.CircuitOpenError):
+        breaker.acquire()
+
+def test_dead_letters_hold_transient_failures_only(start_server, token_manager, monkeypatch):
+    monkeypatch.setitem(importcopy.CONFIG['RETRY'], 'SERVER_ERROR', {'TRIES': 2, 'BASE_DELAY': 0.01, 'MAX_DELAY': 0.01})
+    report = importcopy.Report()
+
+    assert not importcopy.send_to_server(record('rejected.example'), token_manager, report)
+    start_server(error_rate=1.0)
+    assert importcopy.call_api('https://www.down.example/about', report) is None
+    importcopy.close_dead_letters()
+
+    with open(importcopy.CONFIG['DEAD_LETTER']['PATH'], encoding='utf-8') as f:
+        letters = [json.loads(line) for line in f]
+    assert [(d['website'], d['domain'], d['stage'], d['failure']) for d in letters] == [
+        ('https://www.down.example/about', 'down.example', 'fetch', 'server_error')
+    ]
+    assert report.counters()['dead_letters'] == 1
+    assert list(importcopy.iter_websites(importcopy.CONFIG['DEAD_LETTER']['PATH'])) == ['https://www.down.example/about']
+
+def test_json_log_lines_carry_extra_fields():
+    formatter = importcopy.JSONLogFormatter()
+    record = logging.makeLogRecord({'msg': 'HTTP %s for %s', 'args': (503, 'x.example'), 'levelname': 'ERROR',
+                                    'domain': 'x.example', 'stage': 'fetch', 'status': 503})
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        record.exc_info = sys.exc_info()
+
+    entry = json.loads(formatter.format(record))
+
+    assert entry['message'] == 'HTTP 503 for x.example'
+    assert entry['level'] == 'ERROR'
+    assert (entry['domain'], entry['stage'], entry['status']) == ('x.example', 'fetch', 503)
+    assert 'ValueError: boom' in entry['exception']
+    assert not {'msg', 'args', 'levelno', 'exc_info'} & set(entry)
+
+def test_async_json_log_is_written_on_shutdown(tmp_path, restore_config):
+    path = tmp_path / 'run.log'
+    importcopy.CONFIG['LOGGING'].update(PATH=str(path), FORMAT='json', ASYNC=True)
+    importcopy.configure_logging()
+
+    importcopy.log_success('Uploaded %s', 'x.example', domain='x.example', stage='upload')
+    importcopy.shutdown_logging()
+
+    entries = [json.loads(line) for line in path.read_text(encoding='utf-8').splitlines()]
+    assert [(e['message'], e['domain'], e['stage']) for e in entries] == [('Uploaded x.example', 'x.example', 'upload')]
+    assert 'sample_rate' not in entries[0]
+
+def test_success_lines_are_sampled(caplog, monkeypatch):
+    monkeypatch.setitem(importcopy.CONFIG['LOGGING'], 'SUCCESS_SAMPLE_RATE', 0)
+    with caplog.at_level(logging.INFO):
+        for _ in range(100):
+            importcopy.log_success('Uploaded %s', 'x.example', domain='x.example')
+    assert not caplog.records
+
+    monkeypatch.setitem(importcopy.CONFIG['LOGGING'], 'SUCCESS_SAMPLE_RATE', 0.25)
+    draws = iter([0.1, 0.3, 0.2, 0.9])
+    monkeypatch.setattr(importcopy.random, 'random', lambda: next(draws))
+    with caplog.at_level(logging.INFO):
+        for _ in range(4):
+            importcopy.log_success('Uploaded %s', 'x.example', domain='x.example')
+    assert [record.sample_rate for record in caplog.records] == [0.25, 0.25]
+
+def test_full_log_queue_drops_info_but_keeps_warnings():
+    handler = importcopy.LogQueueHandler(queue.Queue(2))
+
+    for level in (logging.INFO, logging.INFO, logging.DEBUG):
+        handler.emit(logging.makeLogRecord({'msg': 'x', 'levelno': level}))
+    assert handler.dropped == 1
+    handler.queue.get_nowait()
+    handler.emit(logging.makeLogRecord({'msg': 'x', 'levelno': logging.WARNING}))
+    assert handler.queue.qsize() == 2 and handler.dropped == 1
+
+@pytest.fixture
+def import_state(tmp_path):
+    state = importcopy.ImportState(str(tmp_path / 'state.sqlite3'), max_age=24 * 3600, flush_interval=60)
+    yield state
+    state.close()
+
+def test_incremental_selects_new_then_stale_domains_oldest_first(import_state):
+    now = time.time()
+    with import_state._conn:
+        import_state._conn.executemany("INSERT INTO domains (domain, fetched_at) VALUES (?, ?)", [
+            ('fresh.example', now - 3600),
+            ('stale.example', now - 2 * 24 * 3600),
+            ('staler.example', now - 3 * 24 * 3600),
+            ('replayed.example', None)
+        ])
+    report = importcopy.Report()
+
+    due = list(import_state.select_due(iter([
+        'https://stale.example', 'fresh.example', 'www.staler.example', 'replayed.example', 'new.example'
+    ]), report))
+
+    assert due == ['replayed.example', 'new.example', 'www.staler.example', 'https://stale.example']
+    assert report.counters()['incremental_fresh'] == 1
+
+def test_incremental_state_remembers_uploaded_records(import_state):
+    uploaded = record('x.example')
+    import_state.record_upload(uploaded)
+    assert not import_state.is_unchanged(uploaded)  # buffered until the next flush
+
+    import_state.flush()
+    import_state.record_fetch('x.example')
+    import_state.flush()
+
+    assert import_state.is_unchanged(copy.deepcopy(uploaded))
+    assert not import_state.is_unchanged(dict(uploaded, city='Hamburg'))
+    assert not import_state.is_unchanged(record('y.example'))
+    assert list(import_state.select_due(iter(['x.example', 'y.example']))) == ['y.example']
+
+def test_unchanged_records_are_not_uploaded_again(server, tmp_path, restore_config):
+    write_urls(str(tmp_path / 'urls.csv'), 5)
+    incremental = ('--incremental', '--state-path', str(tmp_path / 'state.sqlite3'))
+
+    run_main(tmp_path, *incremental)
+    run_main(tmp_path, *incremental, '--fresh')
+    assert server.state.requests['company'] == 5  # every domain is still fresh
+
+    run_main(tmp_path, *incremental, '--fresh', '--max-age', '0')
+    assert server.state.requests['company'] == 10
+    assert server.state.accepted == 5  # refetched, but the records did not change
+    with open(tmp_path / 'progress.journal', encoding='utf-8') as f:
+        assert sorted(line for line in f if line.startswith('U')) == [f'U company{i}.example\n' for i in range(5)]